@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Benchmarks for gal_scan components.
+
+Each subcommand times one piece of the observing pipeline in
+isolation. Blocks that are generated from flowgraph.grc are only
+available after grcc has run, so run these inside the gal_scan
+container:
+
+    /flowgraph/benchmark.py integration
+    /flowgraph/benchmark.py coords
+    /flowgraph/benchmark.py galcoord
+    /flowgraph/benchmark.py startup
+    /flowgraph/benchmark.py vectors
+    /flowgraph/benchmark.py rates
+    /flowgraph/benchmark.py spectrometers
+    /flowgraph/benchmark.py switch
+    /flowgraph/benchmark.py retune
+
+"""
+
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+def _time_work(block, vectors, chunk):
+    """Feed vectors to block.work() chunk vectors at a time.
+
+    Returns:
+        elapsed seconds
+    """
+    start = time.perf_counter()
+    for i in range(0, len(vectors), chunk):
+        block.work([vectors[i:i+chunk]], [])
+    return time.perf_counter() - start
+
+def bench_integration(args):
+    """Compare the batched integration_block against the old per-vector loop."""
+    # Generated by grcc from the integration_block epy_block.
+    import flowgraph_integration_block as integration_block
+
+    class legacy_blk(integration_block.blk):
+        """integration_block.blk as it was before batching."""
+        def work(self, input_items, output_items):
+            count = len(input_items[0])
+            if self.integration_remaining > 0:
+                if self.integration is None:
+                    self.integration = np.zeros(self.num_channels, dtype=float)
+                    return count
+                for vec in input_items[0]:
+                    self.integration += vec
+                    self.integration_remaining -= 1
+                    if not self.integration_remaining:
+                        return count
+            return count
+
+        def integrate(self, count):
+            self.integration = None
+            self.integration_count = count
+            self.integration_remaining = count
+
+    rng = np.random.default_rng(0)
+    # The legacy block throws away the first chunk, so give it one extra.
+    vectors = rng.random((args.vectors + args.chunk, args.num_channels), dtype=np.float32)
+
+    results = {}
+    for name, cls in (('legacy', legacy_blk), ('batched', integration_block.blk)):
+        block = cls(num_channels=args.num_channels)
+        block.integrate(args.vectors)
+        elapsed = _time_work(block, vectors, args.chunk)
+        if block.integrate_results() is None:
+            raise RuntimeError('%s block did not finish integrating' % (name,))
+        results[name] = args.vectors / elapsed
+        print('%-8s %12.0f vectors/s' % (name, results[name]))
+    print('speedup  %12.1fx' % (results['batched'] / results['legacy']))
+
+def bench_coords(args):
+    """Compare per-point coordinate transforms against lookups in a precomputed Track."""
+    from astropy import units as u
+    from astropy.time import TimeDelta
+    from galcoord import altaz_frame, get_time
+    import schedule
+    import survey_autoranging
+
+    it = survey_autoranging.longitude_iterator(0, 360 - args.step, args.step)
+    n = len(it.coords)
+    start = get_time()
+    t0 = time.perf_counter()
+    track = schedule.Track(it, start, args.duration)
+    print('precompute %10.2f s for %d points over %d s (%d obstimes)' % (time.perf_counter() - t0, n, args.duration, len(track.times)))
+    print('bound      %10.4f° at the midpoints between obstimes' % (track.error,))
+
+    rng = np.random.default_rng(0)
+    offsets = rng.uniform(0, args.duration, args.samples)
+    indices = rng.integers(n, size=args.samples)
+    transform = lookup = error = 0
+    for offset, index in zip(offsets, indices):
+        t = start + TimeDelta(offset*u.second)
+        t0 = time.perf_counter()
+        pos = it.coords[index]
+        pos_altaz = pos.transform_to(altaz_frame(t))
+        pos.galactic, pos.icrs
+        t1 = time.perf_counter()
+        az, el = track.azel(index, offset)
+        t2 = time.perf_counter()
+        transform += t1 - t0
+        lookup += t2 - t1
+        error = max(error, schedule._max_separation(az, el, pos_altaz.az.degree, pos_altaz.alt.degree))
+    print('transform  %10.0f us/point' % (transform / args.samples * 1e6,))
+    print('lookup     %10.0f us/point' % (lookup / args.samples * 1e6,))
+    print('error      %10.4f° worst of %d random points' % (error, args.samples))
+
+def _rate(func, n, repeat):
+    """Return calls of func per second, over at least repeat calls."""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return repeat * n / (time.perf_counter() - start)
+
+def bench_galcoord(args):
+    """Compare galcoord's fast transforms against astropy."""
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    import galcoord
+
+    rng = np.random.default_rng(0)
+    t = galcoord.get_time()
+    aaf = galcoord.altaz_frame(t)
+    print('%10s %14s %14s %9s %12s' % ('points', 'astropy/s', 'fast/s', 'speedup', 'error'))
+    for n in args.points:
+        l = rng.uniform(0, 360, n)
+        b = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n)))
+        repeat = max(1, 1000 // n)
+        astropy_rate = _rate(lambda: SkyCoord(l=l*u.degree, b=b*u.degree, frame='galactic').transform_to(aaf), n, min(repeat, 10))
+        fast_rate = _rate(lambda: galcoord.fast_gal_to_altaz(l, b, t), n, repeat)
+        # Check both directions against astropy.
+        exact = SkyCoord(l=l*u.degree, b=b*u.degree, frame='galactic').transform_to(aaf)
+        az, el = galcoord.fast_gal_to_altaz(l, b, t)
+        error = SkyCoord(az=az*u.degree, alt=el*u.degree, frame=aaf).separation(exact).arcsec.max()
+        l2, b2 = galcoord.fast_altaz_to_gal(exact.az.degree, exact.alt.degree, t)
+        error = max(error, SkyCoord(l=l2*u.degree, b=b2*u.degree, frame='galactic').separation(exact.galactic).arcsec.max())
+        print('%10d %14.0f %14.0f %8.0fx %11.4f"' % (n, astropy_rate, fast_rate, fast_rate / astropy_rate, error))
+
+def bench_startup(args):
+    """Time importing modules in a fresh interpreter."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    print('%-20s %10s %10s' % ('module', 'median s', 'worst s'))
+    for module in args.modules:
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', 'import ' + module], cwd=here, check=True)
+            times.append(time.perf_counter() - start)
+        print('%-20s %10.2f %10.2f' % (module, np.median(times), max(times)))
+
+def bench_vectors(args):
+    """Compare writing vectors.csv with writing vectors.bin."""
+    from astropy import units as u
+    from astropy.coordinates import Latitude, Longitude
+    import storage
+
+    rng = np.random.default_rng(0)
+    freqs = np.linspace(1419.4, 1421.4, args.channels)*u.MHz
+    rows = []
+    for number in range(args.points):
+        rows.append({
+            'number': number,
+            'time': (1.6e9 + number*args.int_time)*u.second,
+            'azimuth': Longitude(rng.uniform(0, 360)*u.degree),
+            'elevation': Latitude(rng.uniform(0, 90)*u.degree),
+            'longitude': Longitude(rng.uniform(0, 360)*u.degree),
+            'latitude': Latitude(rng.uniform(-90, 90)*u.degree),
+            'ra': Longitude(rng.uniform(0, 360)*u.degree),
+            'dec': Latitude(rng.uniform(-90, 90)*u.degree),
+            'rci_azimuth': rng.uniform(0, 360)*u.degree,
+            'rci_elevation': rng.uniform(0, 90)*u.degree,
+            'vels': np.linspace(-200, 200, args.channels)*u.km/u.s,
+            'data': rng.random(args.channels, dtype=np.float32)*u.mW/u.Hz,
+        })
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'vectors.csv')
+        start = time.perf_counter()
+        # As _run_survey used to write it.
+        with open(csv_path, 'w') as file:
+            writer = csv.writer(file)
+            writer.writerow(['# Integration time: %d seconds Center frequency: %s' % (args.int_time, np.mean(freqs))])
+            writer.writerow(list(storage.POSITION_FIELDS) + [str(f) for f in freqs]*2)
+            for row in rows:
+                writer.writerow([str(row[x]) for x in storage.POSITION_FIELDS] + [str(f) for f in row['vels']] + [str(f) for f in row['data']])
+        csv_time = time.perf_counter() - start
+
+        bin_path = os.path.join(directory, storage.VECTORS_FILE)
+        start = time.perf_counter()
+        with storage.VectorWriter(bin_path, np.mean(freqs), freqs, args.int_time) as writer:
+            for row in rows:
+                writer.write(row)
+        bin_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        storage.vectors_to_csv(bin_path, os.path.join(directory, 'converted.csv'))
+        convert_time = time.perf_counter() - start
+
+        print('%d observations of %d channels' % (args.points, args.channels))
+        print('%-12s %10s %12s' % ('', 'seconds', 'MB'))
+        print('%-12s %10.2f %12.2f' % ('vectors.csv', csv_time, os.path.getsize(csv_path) / 1e6))
+        print('%-12s %10.3f %12.2f' % ('vectors.bin', bin_time, os.path.getsize(bin_path) / 1e6))
+        print('%-12s %10.2f' % ('bin -> csv', convert_time))
+
+def bench_rates(args):
+    """Time the receive chain at each bandwidth, as planned and at the old fixed sample rate."""
+    from gnuradio import blocks, gr
+    import rateplan
+    import spectrometer
+
+    rng = np.random.default_rng(0)
+    noise = (rng.standard_normal(args.block) + 1j*rng.standard_normal(args.block)).astype(np.complex64) * 0.01
+    print('%-6s %-6s %-28s %10s %10s %8s %8s' % ('MHz', 'chain', 'plan', 'Msps', 'MS/s', 'realtime', 'cores'))
+    for bandwidth in args.bandwidths:
+        chains = [('plan', rateplan.plan(bandwidth))]
+        if bandwidth*rateplan.IF_OVERSAMPLE <= rateplan.LEGACY_SAMP_RATE/2:
+            chains.append(('fixed', rateplan.plan(bandwidth, rateplan.LEGACY_SAMP_RATE, cpus=1, split=False)))
+        for name, plan in chains:
+            samples = int(args.seconds * plan.samp_rate)
+            tb = gr.top_block()
+            source = blocks.vector_source_c(noise, True)
+            head = blocks.head(gr.sizeof_gr_complex, samples)
+            channel_filter = spectrometer.channel_filter(plan, plan.if_samp_rate/2 + rateplan.OFFSET_GUARD)
+            spectra = spectrometer.spectrometer(
+                args.num_channels, spectrometer.integration_dec_rate(1, plan.if_samp_rate, args.num_channels),
+                plan.if_samp_rate, fft_threads=plan.fft_threads)
+            sink = blocks.null_sink(gr.sizeof_float*args.num_channels)
+            tb.connect(source, head, channel_filter, spectra, sink)
+            wall, cpu = time.perf_counter(), time.process_time()
+            tb.run()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            # Seconds of LimeSDR samples processed per second; below 1 the SDR would overflow.
+            realtime = args.seconds / wall
+            print('%-6g %-6s %-28s %10.2f %10.1f %7.1fx %8.2f%s' % (
+                bandwidth/1e6, name,
+                '/'.join(str(stage.decimation) for stage in plan.stages) + ', %d thread(s)' % plan.filter_threads,
+                plan.samp_rate/1e6, samples/wall/1e6, realtime, cpu/args.seconds,
+                '' if realtime >= 1 else '  overflow'))
+    print('cores is CPU seconds per second of samples, including the source.')
+
+def bench_spectrometers(args):
+    """Time each spectrometer front end and measure its noise on white noise."""
+    from gnuradio import blocks, gr
+    import spectrometer
+
+    if_samp_rate = args.bandwidth*1.1
+    rng = np.random.default_rng(0)
+    def noise(n):
+        return ((rng.standard_normal(n) + 1j*rng.standard_normal(n))/np.sqrt(2)).astype(np.complex64)
+    repeated = noise(args.block)
+    print('%-6s %8s %10s %12s %10s %8s' % ('method', 'channels', 'cores/Msps', 'resolution', 'SNR 1s', 'speedup'))
+    for num_channels in args.num_channels:
+        baseline = None
+        for method in spectrometer.METHODS:
+            # CPU time per million IF samples.
+            samples = int(args.seconds*if_samp_rate)
+            tb = gr.top_block()
+            source = blocks.vector_source_c(repeated, True)
+            head = blocks.head(gr.sizeof_gr_complex, samples)
+            spectra = spectrometer.spectrometer(
+                num_channels, spectrometer.integration_dec_rate(1, if_samp_rate, num_channels), if_samp_rate, method=method)
+            tb.connect(source, head, spectra, blocks.null_sink(gr.sizeof_float*num_channels))
+            cpu = time.process_time()
+            tb.run()
+            cpu = time.process_time() - cpu
+
+            # Fractional noise of short sub-integrations of fresh noise, scaled to one second.
+            tb = gr.top_block()
+            source = blocks.vector_source_c(noise(args.frames*num_channels*args.sub_integrations), False)
+            spectra = spectrometer.spectrometer(num_channels, args.frames, if_samp_rate, method=method)
+            sink = blocks.vector_sink_f(num_channels)
+            tb.connect(source, spectra, sink)
+            tb.run()
+            # Skip the sub-integrations that started before the filters filled.
+            data = np.array(sink.data()).reshape(-1, num_channels)[spectrometer.PFB_TAPS_PER_CHANNEL:]
+            sub_int_time = args.frames*num_channels/if_samp_rate
+            snr = np.median(data.mean(axis=0)/data.std(axis=0))/np.sqrt(sub_int_time)
+            baseline = baseline or snr
+            print('%-6s %8d %10.3f %9.2f kHz %10.0f %7.2fx' % (
+                method, num_channels, cpu/samples*1e6, spectra.noise_bandwidth*if_samp_rate/num_channels/1e3,
+                snr, (snr/baseline)**2))
+    print('cores/Msps is CPU seconds per million IF samples, including the source.')
+    print('resolution is the equivalent noise bandwidth of each channel.')
+    print('SNR 1s is the mean over the standard deviation of a channel after 1 s of white noise;')
+    print('speedup is how many times faster than fft a line wider than a channel reaches the same SNR.')
+
+def bench_switch(args):
+    """Time switching a running simulated telescope between spectrometer settings."""
+    import simulator
+
+    client = simulator.SimulatedClient(speedup=args.speedup)
+    tb = simulator.SimulatedTelescope(client=client, speedup=args.speedup, rfi=())
+    tb.start()
+    print('%8s %-14s %8s %10s %10s %12s' % ('channels', 'window', 'sub-int', 'build ms', 'locked ms', 'first vec s'))
+    try:
+        for _ in range(args.repeat):
+            for num_channels in args.num_channels:
+                start = time.perf_counter()
+                tb.prepare_spectrometer(num_channels, args.window, args.sub_int_time)
+                build = time.perf_counter() - start
+                latency = tb.configure_spectrometer(num_channels, args.window, args.sub_int_time, timeout=10*args.sub_int_time)
+                if latency is None:
+                    continue
+                print('%8d %-14s %8g %10.2f %10.2f %12.2f' % (
+                    num_channels, args.window, tb.sub_integration_time(), build*1e3, latency.locked*1e3, latency.first_vector))
+    finally:
+        tb.stop()
+        tb.wait()
+        client.close()
+    print('build is the time to set up a spectrometer the first time; later switches reuse it.')
+    print('first vec is from taking the lock to the first sub-integration, at %gx real time.' % (args.speedup,))
+
+def bench_retune(args):
+    """Time simulated retunes and how long each takes to deliver valid data."""
+    import simulator
+
+    client = simulator.SimulatedClient(speedup=args.speedup)
+    tb = simulator.SimulatedTelescope(client=client, speedup=args.speedup, rfi=(), integration_time=args.sub_int_time)
+    tb.start()
+    frequency = tb.get_sdr_frequency()
+    latencies = []
+    try:
+        for i in range(args.retunes):
+            start = time.perf_counter()
+            tb.set_sdr_frequency(frequency + (i % 2 + 1)*args.step)
+            retune = time.perf_counter() - start
+            latencies.append((retune, tb.retune_latency(timeout=10*args.sub_int_time)))
+    finally:
+        tb.stop()
+        tb.wait()
+        client.close()
+    retune, valid = np.array(latencies, dtype=float).T
+    print('%d retunes by %g Hz with %g sec sub-integrations at %gx real time:' % (args.retunes, args.step, tb.sub_integration_time(), args.speedup))
+    print('%-18s %10s %10s' % ('', 'median', 'max'))
+    print('%-18s %9.2fms %9.2fms' % ('set_sdr_frequency', np.median(retune)*1e3, retune.max()*1e3))
+    print('%-18s %9.2fs %9.2fs' % ('valid data', np.median(valid), valid.max()))
+    print('valid data is from the retune until the first sub-integration of only new samples.')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gal_scan components')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    p = subparsers.add_parser('integration', help='integration_block throughput')
+    p.add_argument('--vectors', type=int, default=100000, help='vectors to integrate')
+    p.add_argument('--chunk', type=int, default=64, help='vectors per work() call')
+    p.add_argument('--num-channels', type=int, default=512, help='vector length')
+    p.set_defaults(func=bench_integration)
+
+    p = subparsers.add_parser('coords', help='precomputed survey positions')
+    p.add_argument('--step', type=float, default=2.5, help='galactic longitude step')
+    p.add_argument('--duration', type=float, default=4*3600, help='seconds of survey to precompute')
+    p.add_argument('--samples', type=int, default=100, help='points to compare')
+    p.set_defaults(func=bench_coords)
+
+    p = subparsers.add_parser('galcoord', help='galactic to altaz transforms')
+    p.add_argument('--points', type=int, nargs='+', default=[1, 1000, 1000000], help='points per transform')
+    p.set_defaults(func=bench_galcoord)
+
+    p = subparsers.add_parser('startup', help='module import time')
+    p.add_argument('--modules', nargs='+', default=['galcoord', 'plot', 'run'], help='modules to import')
+    p.add_argument('--repeat', type=int, default=5, help='imports per module')
+    p.set_defaults(func=bench_startup)
+
+    p = subparsers.add_parser('vectors', help='per-observation log writing')
+    p.add_argument('--points', type=int, default=1000, help='observations to write')
+    p.add_argument('--channels', type=int, default=512, help='channels per observation')
+    p.add_argument('--int-time', type=int, default=30, help='integration time')
+    p.set_defaults(func=bench_vectors)
+
+    p = subparsers.add_parser('rates', help='receive chain CPU headroom per bandwidth')
+    p.add_argument('--bandwidths', type=float, nargs='+', default=[0.5e6, 1e6, 2e6, 3e6, 4e6, 5e6, 6e6, 8e6], help='bandwidths to plan for')
+    p.add_argument('--seconds', type=float, default=5, help='seconds of samples to process')
+    p.add_argument('--num-channels', type=int, default=512, help='channels per spectrum')
+    p.add_argument('--block', type=int, default=1 << 20, help='length of the repeated noise source')
+    p.set_defaults(func=bench_rates)
+
+    p = subparsers.add_parser('spectrometers', help='spectrometer front end CPU use and sensitivity')
+    p.add_argument('--bandwidth', type=float, default=2e6, help='IF bandwidth')
+    p.add_argument('--num-channels', type=int, nargs='+', default=[256, 512, 1024], help='channels per spectrum')
+    p.add_argument('--seconds', type=float, default=10, help='seconds of samples to time')
+    p.add_argument('--frames', type=int, default=16, help='spectra per sub-integration for the noise measurement')
+    p.add_argument('--sub-integrations', type=int, default=1000, help='sub-integrations for the noise measurement')
+    p.add_argument('--block', type=int, default=1 << 20, help='length of the repeated noise source')
+    p.set_defaults(func=bench_spectrometers)
+
+    p = subparsers.add_parser('switch', help='spectrometer reconfiguration latency')
+    p.add_argument('--num-channels', type=int, nargs='+', default=[256, 512, 1024, 2048], help='channels per spectrum to switch between')
+    p.add_argument('--window', default='blackmanharris', help='FFT window')
+    p.add_argument('--sub-int-time', type=float, default=1, metavar='seconds', help='sub-integration time')
+    p.add_argument('--repeat', type=int, default=2, help='times to cycle through the settings')
+    p.add_argument('--speedup', type=float, default=1, help='how many times faster than real time the simulated SDR runs')
+    p.set_defaults(func=bench_switch)
+
+    p = subparsers.add_parser('retune', help='retune latency')
+    p.add_argument('--retunes', type=int, default=10, help='simulated retunes')
+    p.add_argument('--step', type=float, default=1e5, metavar='Hz', help='simulated retune step')
+    p.add_argument('--sub-int-time', type=float, default=0.1, metavar='seconds', help='simulated sub-integration time')
+    p.add_argument('--speedup', type=float, default=1, help='how many times faster than real time the simulated SDR runs')
+    p.set_defaults(func=bench_retune)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
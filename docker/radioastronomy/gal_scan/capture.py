@@ -0,0 +1,108 @@
+"""Raw IQ recordings in SigMF format.
+
+A recording NAME is a pair of files. NAME.sigmf-data holds the SDR's
+complex samples as interleaved little-endian int16 I and Q, scaled by
+SCALE. NAME.sigmf-meta describes them in SigMF's JSON format
+(https://github.com/gnuradio/SigMF). Each retune starts a new entry in
+`captures`, and the dish's pointing is kept in an annotation covering
+the whole recording. Fields that SigMF doesn't define are in the
+gal_scan namespace.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import datetime
+import json
+import os
+
+SIGMF_VERSION = '1.0.0'
+DATATYPE = 'ci16_le'
+# Bytes in each complex sample.
+SAMPLE_SIZE = 4
+# int16 value of a full-scale sample from the LimeSDR.
+SCALE = 32767
+DATA_SUFFIX = '.sigmf-data'
+META_SUFFIX = '.sigmf-meta'
+NAMESPACE = 'gal_scan'
+
+def data_path(name):
+    return name + DATA_SUFFIX
+
+def meta_path(name):
+    return name + META_SUFFIX
+
+def isoformat(timestamp):
+    """Return a Unix timestamp as a SigMF (ISO 8601, UTC) datetime."""
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+def parse_datetime(value):
+    """Return the Unix timestamp of a SigMF datetime."""
+    value = value.rstrip('Z')
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+    return (datetime.datetime.strptime(value, fmt) - datetime.datetime(1970, 1, 1)).total_seconds()
+
+def _namespaced(fields):
+    return {'%s:%s' % (NAMESPACE, key): value for key, value in fields.items()}
+
+class Recording(object):
+    """Metadata of a recording in progress.
+
+    samp_rate, bandwidth, sdr_gain and offset_frequency are the
+    flowgraph's settings when the recording started; the SDR is tuned
+    offset_frequency below sdr_frequency. pointing is saved as an
+    annotation of the whole recording.
+    """
+    def __init__(self, name, samp_rate, bandwidth, sdr_gain, offset_frequency, pointing=None):
+        self.name = name
+        self.samp_rate = samp_rate
+        self.bandwidth = bandwidth
+        self.sdr_gain = sdr_gain
+        self.offset_frequency = offset_frequency
+        self.pointing = pointing or {}
+        self.captures = []
+
+    def retune(self, sample_start, timestamp, sdr_frequency):
+        """Record that samples from sample_start on were taken at sdr_frequency."""
+        self.captures.append({
+            'core:sample_start': int(sample_start),
+            'core:frequency': sdr_frequency - self.offset_frequency,
+            'core:datetime': isoformat(timestamp),
+            NAMESPACE + ':sdr_frequency': sdr_frequency,
+        })
+
+    def write(self):
+        """Write NAME.sigmf-meta for the samples now in NAME.sigmf-data."""
+        sample_count = os.path.getsize(data_path(self.name)) // SAMPLE_SIZE
+        meta = {
+            'global': dict({
+                'core:datatype': DATATYPE,
+                'core:sample_rate': self.samp_rate,
+                'core:version': SIGMF_VERSION,
+                'core:recorder': 'gal_scan',
+                'core:hw': 'LimeSDR',
+                'core:extensions': [{'name': NAMESPACE, 'version': '1.0.0', 'optional': True}],
+            }, **_namespaced({
+                'scale': SCALE,
+                'bandwidth': self.bandwidth,
+                'sdr_gain': self.sdr_gain,
+                'offset_frequency': self.offset_frequency,
+            })),
+            'captures': [c for c in self.captures if c['core:sample_start'] < sample_count] or self.captures[:1],
+            'annotations': [dict({
+                'core:sample_start': 0,
+                'core:sample_count': sample_count,
+            }, **_namespaced(self.pointing))] if self.pointing else [],
+        }
+        with open(meta_path(self.name), 'w') as file:
+            json.dump(meta, file, indent=2, sort_keys=True)
+        return sample_count
+
+def read_meta(name):
+    """Return the parsed NAME.sigmf-meta."""
+    with open(meta_path(name)) as file:
+        meta = json.load(file)
+    if meta['global']['core:datatype'] != DATATYPE:
+        raise ValueError('%s: unsupported datatype %s' % (meta_path(name), meta['global']['core:datatype']))
+    return meta
@@ -2,55 +2,124 @@
 
 #gives the aziumuth and elevation for galactic coordinates
 #position is the MIT radome
-from astropy.utils import iers
-#iers.conf.iers_auto_url = "ftp://cddis.gsfc.nasa.gov/pub/products/iers/finals2000A.all"
-iers.conf.iers_auto_url = "https://datacenter.iers.org/data/9/finals2000A.all"
-from astropy.coordinates import SkyCoord
-from astropy.coordinates import Angle
-from astropy.coordinates import ICRS
-from astropy.coordinates import GCRS
-from astropy.coordinates import Galactic
-from astropy.coordinates import Galactocentric
-from astropy.coordinates import UnitSphericalRepresentation
-import astropy.coordinates as coord
-from astropy import units as u
-from astropy.constants import c
-from astropy.time import Time
-from astroplan import Observer
+#
+# astropy.coordinates and astroplan are slow to import, and transforms
+# need Earth orientation (IERS) data, so none of them are loaded until
+# first use. IERS tables come from CACHE_DIR rather than the network;
+# run "python3 galcoord.py refresh" while online to update them.
+import argparse
+import logging
+import os
+import shutil
+import time as _time
 import numpy as np
+from astropy import units as u
 
-coord.galactocentric_frame_defaults.set('latest')
-from astroplan import download_IERS_A
-download_IERS_A()
-
-#from astroplan import FixedTarget
-#Mars = FixedTarget.from_name("mars")
+logger = logging.getLogger('galcoord')
+
+# Directory holding downloaded IERS tables and ephemerides.
+CACHE_DIR = os.environ.get('GAL_SCAN_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'gal_scan'))
+# Days after which the cached tables should be refreshed. IERS-A
+# predictions are good to a few ms of UT1 for weeks, so this is a
+# reminder rather than a hard limit.
+MAX_CACHE_AGE = 14
+IERS_A_FILE = 'finals2000A.all'
+#IERS_A_URL = "ftp://cddis.gsfc.nasa.gov/pub/products/iers/finals2000A.all"
+IERS_A_URL = "https://datacenter.iers.org/data/9/finals2000A.all"
+LEAP_SECOND_FILE = 'Leap_Second.dat'
+LEAP_SECOND_URL = "https://hpiers.obspm.fr/iers/bul/bulc/Leap_Second.dat"
+# JPL ephemeris used for solar system bodies if it is in CACHE_DIR
+# (needs jplephem); otherwise astropy's built-in ephemeris is used.
+EPHEMERIS_FILE = 'de432s.bsp'
+EPHEMERIS_URL = "https://naif.jpl.nasa.gov/pub/naif/generic_kernels/spk/planets/de432s.bsp"
 
 #observer-specific coordinates
 mitlat=42.3601*u.degree
 mitlong=-71.0942*u.degree
 radome_elevation=100*u.m #roughly 100m above sea level
 
-#define an observer and an altaz frame
-radome_observer=Observer(latitude=mitlat,longitude=mitlong, elevation=radome_elevation, name='radome', timezone='US/Eastern')
-icrs_frame=ICRS()
-galactic_frame=Galactic()
+_setup_done = False
+
+def setup():
+    """Configure astropy to use the cached data files. Runs once."""
+    global _setup_done
+    if _setup_done:
+        return
+    _setup_done = True
+    from astropy.utils import iers
+    import astropy.coordinates as coord
+    # Never block on the network; fall back to the tables bundled with
+    # astropy, with a warning, for dates they don't cover.
+    iers.conf.auto_download = False
+    iers.conf.iers_degraded_accuracy = 'warn'
+    coord.galactocentric_frame_defaults.set('latest')
+
+    path = os.path.join(CACHE_DIR, IERS_A_FILE)
+    if not os.path.exists(path):
+        logger.warning('No IERS-A table in %s; using the tables bundled with astropy. Run "galcoord.py refresh" while online.', CACHE_DIR)
+    else:
+        iers.earth_orientation_table.set(iers.IERS_A.open(path))
+        age = (_time.time() - os.path.getmtime(path)) / 86400
+        if age > MAX_CACHE_AGE:
+            logger.warning('IERS-A table in %s is %d days old. Run "galcoord.py refresh" while online.', CACHE_DIR, age)
+    path = os.path.join(CACHE_DIR, LEAP_SECOND_FILE)
+    if os.path.exists(path):
+        # astropy uses whichever known leap second file expires last.
+        iers.conf.system_leap_second_file = path
+    path = os.path.join(CACHE_DIR, EPHEMERIS_FILE)
+    if os.path.exists(path):
+        coord.solar_system_ephemeris.set(path)
+
+def refresh(ephemeris=False):
+    """Download the IERS tables (and optionally the ephemeris) into CACHE_DIR."""
+    from astropy.utils.data import download_file
+    from astropy.utils import iers
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    files = [(IERS_A_URL, IERS_A_FILE, iers.IERS_A.open), (LEAP_SECOND_URL, LEAP_SECOND_FILE, iers.LeapSeconds.open)]
+    if ephemeris:
+        files.append((EPHEMERIS_URL, EPHEMERIS_FILE, None))
+    for url, name, check in files:
+        logger.info('Downloading %s', url)
+        tmp = download_file(url, cache=False)
+        if check:
+            # Make sure the file parses before replacing a good one.
+            check(tmp)
+        shutil.move(tmp, os.path.join(CACHE_DIR, name))
+
+_radome_observer = None
+
+def get_radome_observer():
+    """Return the astroplan Observer for the radome."""
+    global _radome_observer
+    if _radome_observer is None:
+        setup()
+        from astroplan import Observer
+        #define an observer and an altaz frame
+        _radome_observer=Observer(latitude=mitlat,longitude=mitlong, elevation=radome_elevation, name='radome', timezone='US/Eastern')
+    return _radome_observer
+
+def __getattr__(name):
+    # Create module attributes that need astropy or astroplan on first use.
+    if name == 'radome_observer':
+        return get_radome_observer()
+    if name == 'icrs_frame':
+        from astropy.coordinates import ICRS
+        return ICRS()
+    if name == 'galactic_frame':
+        from astropy.coordinates import Galactic
+        return Galactic()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 #print radome_observer.sun_altaz(time)
 
 HYDROGEN_FREQ = 1420.406*u.MHz
 
-def freqs_to_vel(center_freq, fs, sc):
-    """Convert frequency to radial Doppler velocity.
+def velocity_corrections(sc):
+    """Return the velocity corrections that freqs_to_vel applies toward sc.
 
-    Accounts for movement of the earth relative to the sun and the sun relative to galactic center.
-
-    Args:
-        center_freq: frequency at zero velocity
-        fs: Quantity object representing frequencies
-        sc: SkyCoord object representing one or many coordinates (must have obstime and location set)
+    Returns:
+        (barycentric correction, solar velocity projected toward sc)
     """
-
     # Convert from earth reference frame to solar reference frame using
     # https://docs.astropy.org/en/stable/coordinates/velocities.html#radial-velocity-corrections
     # Then convert from solar reference frame to Galactic Standard of Rest using
@@ -58,10 +127,29 @@ def freqs_to_vel(center_freq, fs, sc):
     pos_gal = sc.galactic
     v_to_bary = pos_gal.radial_velocity_correction(kind='barycentric')
     # Calculate the sun's velocity projected in the observing direction.
+    setup()
+    from astropy.coordinates import Galactocentric
     v_sun = Galactocentric().galcen_v_sun.to_cartesian()
     cart_data = pos_gal.data.to_cartesian()
     unit_vector = cart_data / cart_data.norm()
     v_proj = v_sun.dot(unit_vector)
+    return v_to_bary, v_proj
+
+def freqs_to_vel(center_freq, fs, sc, corrections=None):
+    """Convert frequency to radial Doppler velocity.
+
+    Accounts for movement of the earth relative to the sun and the sun relative to galactic center.
+
+    Args:
+        center_freq: frequency at zero velocity
+        fs: Quantity object representing frequencies
+        sc: SkyCoord object representing one or many coordinates (must have obstime and location set)
+        corrections: velocity_corrections(sc), if already known (sc is then unused)
+    """
+    from astropy.constants import c
+    if corrections is None:
+        corrections = velocity_corrections(sc)
+    v_to_bary, v_proj = corrections
 
     doppler_shift = u.doppler_radio(center_freq)
 
@@ -72,54 +160,267 @@ def freqs_to_vel(center_freq, fs, sc):
 
 def altaz_frame(time=None, obswl=None):
     if not time:
-        time=Time.now()
-    return radome_observer.altaz(time, obswl=obswl)
+        time=get_time()
+    return get_radome_observer().altaz(time, obswl=obswl)
 
 def get_time():
+    setup()
+    from astropy.time import Time
     time=Time.now()
     return time
 
 def gcrs_to_altaz(ra,dec):
+    from astropy.coordinates import SkyCoord
     gcrs_frame=update_GCRS()
     pos_gcrs=SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame=gcrs_frame)
     pos_altaz=pos_gcrs.transform_to(altaz_frame())
     return (pos_altaz.az.degree, pos_altaz.alt.degree)
 
 def gal_to_altaz(lcoord,bcoord): #galactic coords in degrees
-    #define a galactic position
-    pos_gal=SkyCoord(l=lcoord*u.degree, b=bcoord*u.degree, frame='galactic')
-    #transform the galactic position to an altaz one
-    pos_altaz=pos_gal.transform_to(altaz_frame())
-    #print(pos_altaz.to_string())
-    return (pos_altaz.az.degree, pos_altaz.alt.degree)
+    return fast_gal_to_altaz(lcoord, bcoord)
 
 def radec_to_altaz(ra,dec):
-    pos_icrs=SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame=icrs_frame)
-    pos_altaz=pos_icrs.transform_to(altaz_frame())
-    return (pos_altaz.az.degree, pos_altaz.alt.degree)
+    return fast_icrs_to_altaz(ra, dec)
 
 def altaz_to_radec(az,el):
-    #define the position
-    pos_altaz=SkyCoord(az=az*u.degree, alt=el*u.degree, frame=altaz_frame())
-    #transform to RA DEC
-    pos_icrs=pos_altaz.transform_to(icrs_frame)
-    return(pos_icrs.ra.degree, pos_icrs.dec.degree)
-
+    return fast_altaz_to_icrs(az, el)
 
 def altaz_to_gal(az, el):
-    pos_altaz=SkyCoord(az=az*u.degree, alt=el*u.degree, frame=altaz_frame())
-    pos_gal=pos_altaz.transform_to(galactic_frame)
-    return (pos_gal.l.degree, pos_gal.b.degree)
+    return fast_altaz_to_gal(az, el)
+
+# Fast transforms
+#
+# astropy recomputes the whole ERFA astrometry context (ephemerides,
+# precession/nutation, Earth rotation, refraction constants) for every
+# transform. The fast_* functions compute it once per FAST_BUCKET
+# seconds of obstime and apply it to arrays of coordinates with NumPy,
+# advancing the Earth rotation angle from the middle of the bucket.
+# They follow astropy's ICRS<->AltAz transforms for distant sources
+# (erfa.atciqz/atioq and their inverses) to well under an arcsecond.
+
+# Seconds of obstime that share one astrometry context.
+FAST_BUCKET = 600
+# Earth rotation angle rate in radians per (UT1) second.
+EARTH_ROTATION_RATE = 2*np.pi*1.00273781191135448/86400
+# Schwarzschild radius of the Sun in au, as used by ERFA.
+SRS = 1.97412574336e-8
+
+_fast_contexts = {}
+
+def _fast_context(bucket, obswl):
+    """Return (reference unix time, astrom, rotation, horizon) for an obstime bucket.
+
+    rotation takes GCRS vectors to CIRS with the Earth rotation angle
+    (plus longitude) at the reference time applied; see _horizon_matrix
+    for horizon.
+    """
+    # Refraction depends on the observer's weather, which web.py updates.
+    observer = get_radome_observer()
+    weather = tuple(getattr(q, 'value', q) for q in (observer.pressure, observer.temperature, observer.relative_humidity))
+    key = (bucket, None if obswl is None else obswl.to_value(u.m)) + weather
+    context = _fast_contexts.get(key)
+    if context is None:
+        from astropy.coordinates.erfa_astrom import erfa_astrom
+        from astropy.time import Time
+        t_ref = (bucket + 0.5) * FAST_BUCKET
+        astrom = erfa_astrom.get().apco(altaz_frame(Time(t_ref, format='unix'), obswl=obswl))
+        c, s = np.cos(astrom['eral']), np.sin(astrom['eral'])
+        rotation = np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]]) @ astrom['bpn']
+        if len(_fast_contexts) > 64:
+            _fast_contexts.clear()
+        context = _fast_contexts[key] = (t_ref, astrom, rotation, _horizon_matrix(astrom))
+    return context
+
+def _horizon_matrix(astrom):
+    """Matrix taking -HA/Dec vectors to az/el vectors (S=0, E=90), including polar motion."""
+    sphi, cphi, xpl, ypl = astrom['sphi'], astrom['cphi'], astrom['xpl'], astrom['ypl']
+    polar = np.array([[1, 0, xpl], [0, 1, -ypl], [-xpl, ypl, 1]])
+    return np.array([[sphi, 0, -cphi], [0, 1, 0], [cphi, 0, sphi]]) @ polar
+
+def _unit(v):
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+def _deflect_and_aberrate(p, astrom):
+    """Apply light deflection by the Sun and annual aberration (erfa.ld, erfa.ab)."""
+    e, em, v, bm1 = astrom['eh'], astrom['em'], astrom['v'], astrom['bm1']
+    dlim = 1e-6 / max(em*em, 1)
+    pde = p @ e
+    w = SRS / em / np.maximum(pde + 1, dlim)
+    # p x (e x p), for unit p
+    pnat = p + w[..., np.newaxis] * (e - pde[..., np.newaxis] * p)
+    pdv = pnat @ v
+    w1 = 1 + pdv / (1 + bm1)
+    w2 = SRS / em
+    return _unit(pnat * bm1 + w1[..., np.newaxis] * v + w2 * (v - pdv[..., np.newaxis] * pnat))
+
+def _rotate_era(v, delta):
+    """Rotate vectors about the pole by a further delta radians of Earth rotation."""
+    c, s = np.cos(delta), np.sin(delta)
+    x, y = v[..., 0], v[..., 1]
+    return np.stack([c*x + s*y, c*y - s*x, v[..., 2]], axis=-1)
+
+def _refract(v, astrom):
+    """Apply diurnal aberration and refraction to az/el vectors (as erfa.atioq)."""
+    f = 1 - astrom['diurab'] * v[..., 1]
+    v = f[..., np.newaxis] * (v + [0, astrom['diurab'], 0])
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    r = np.maximum(np.hypot(x, y), 1e-6)
+    zc = np.maximum(z, 0.05)
+    tz = r / zc
+    w = astrom['refb'] * tz * tz
+    d = (astrom['refa'] + w) * tz / (1 + (astrom['refa'] + 3*w) / (zc*zc))
+    cosdel = 1 - d*d/2
+    f = cosdel - d*zc/r
+    return np.stack([x*f, y*f, cosdel*z + d*r], axis=-1)
+
+def _unrefract(v, astrom):
+    """Remove refraction and diurnal aberration from az/el vectors (as erfa.atoiq)."""
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    r = np.maximum(np.hypot(x, y), 1e-6)
+    zc = np.maximum(z, 0.05)
+    tz = r / zc
+    d = (astrom['refa'] + astrom['refb'] * tz * tz) * tz
+    cosdel = 1 - d*d/2
+    f = cosdel + d*zc/r
+    v = np.stack([x*f, y*f, cosdel*z - d*r], axis=-1)
+    f = 1 + astrom['diurab'] * v[..., 1]
+    return f[..., np.newaxis] * (v - [0, astrom['diurab'], 0])
+
+def _icrs_to_altaz_vectors(p, t, obswl):
+    """Transform ICRS unit vectors p (..., 3) at unix times t to az/el vectors."""
+    out = np.empty(np.broadcast(p, t[..., np.newaxis]).shape)
+    p = np.broadcast_to(p, out.shape)
+    t = np.broadcast_to(t, out.shape[:-1])
+    buckets = np.floor(t / FAST_BUCKET)
+    for bucket in np.unique(buckets):
+        mask = buckets == bucket
+        t_ref, astrom, rotation, horizon = _fast_context(bucket, obswl)
+        v = _deflect_and_aberrate(p[mask], astrom) @ rotation.T
+        v = _rotate_era(v, EARTH_ROTATION_RATE * (t[mask] - t_ref))
+        out[mask] = _refract(v @ horizon.T, astrom)
+    return out
+
+def _altaz_to_icrs_vectors(v, t, obswl):
+    """Transform az/el vectors v (..., 3) at unix times t to ICRS unit vectors."""
+    out = np.empty(np.broadcast(v, t[..., np.newaxis]).shape)
+    v = np.broadcast_to(v, out.shape)
+    t = np.broadcast_to(t, out.shape[:-1])
+    buckets = np.floor(t / FAST_BUCKET)
+    for bucket in np.unique(buckets):
+        mask = buckets == bucket
+        t_ref, astrom, rotation, horizon = _fast_context(bucket, obswl)
+        w = _unrefract(v[mask], astrom) @ horizon
+        w = _rotate_era(w, -EARTH_ROTATION_RATE * (t[mask] - t_ref)) @ rotation
+        # Aberration and deflection are small; invert them by iteration.
+        p = w
+        for _ in range(3):
+            p = _unit(p + w - _deflect_and_aberrate(p, astrom))
+        out[mask] = p
+    return out
+
+def _galactic_matrix():
+    """Return the matrix taking ICRS vectors to Galactic ones."""
+    global _GALACTIC_MATRIX
+    if _GALACTIC_MATRIX is None:
+        from astropy.coordinates import ICRS, Galactic, SkyCoord
+        axes = SkyCoord(x=[1, 0, 0], y=[0, 1, 0], z=[0, 0, 1], representation_type='cartesian', frame=ICRS())
+        _GALACTIC_MATRIX = axes.transform_to(Galactic()).cartesian.xyz.value
+    return _GALACTIC_MATRIX
+_GALACTIC_MATRIX = None
+
+def _to_vectors(lon, lat):
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.stack(np.broadcast_arrays(np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)), axis=-1)
+
+def _from_vectors(v):
+    return np.rad2deg(np.arctan2(v[..., 1], v[..., 0])) % 360, np.rad2deg(np.arcsin(np.clip(v[..., 2], -1, 1)))
+
+def _to_azel(v):
+    # Az/el vectors have S=0, E=90.
+    return np.rad2deg(np.arctan2(v[..., 1], -v[..., 0])) % 360, np.rad2deg(np.arcsin(np.clip(v[..., 2], -1, 1)))
+
+def _from_azel(az, el):
+    v = _to_vectors(-np.asarray(az), el)
+    v[..., 0] *= -1
+    v[..., 1] *= -1
+    return v
+
+def _unix(time):
+    if time is None:
+        time = get_time()
+    return np.asarray(time.unix)
+
+def _have_erfa_astrom():
+    """Return whether astropy provides erfa_astrom (4.2 and later), which _fast_context needs."""
+    global _HAVE_ERFA_ASTROM
+    if _HAVE_ERFA_ASTROM is None:
+        try:
+            from astropy.coordinates import erfa_astrom
+            _HAVE_ERFA_ASTROM = True
+        except ImportError:
+            import astropy
+            logger.warning('astropy %s has no erfa_astrom; coordinate transforms take the slower astropy path', astropy.__version__)
+            _HAVE_ERFA_ASTROM = False
+    return _HAVE_ERFA_ASTROM
+_HAVE_ERFA_ASTROM = None
+
+def _astropy_to_altaz(lon, lat, t, frame, obswl):
+    """Transform lon/lat in frame to az/el with astropy, for when erfa_astrom is missing."""
+    from astropy.coordinates import SkyCoord
+    from astropy.time import Time
+    lon, lat, t = np.broadcast_arrays(lon, lat, t)
+    altaz = SkyCoord(lon.ravel()*u.deg, lat.ravel()*u.deg, frame=frame).transform_to(
+        altaz_frame(Time(t.ravel(), format='unix'), obswl=obswl))
+    return altaz.az.degree.reshape(lon.shape), altaz.alt.degree.reshape(lon.shape)
+
+def _astropy_from_altaz(az, el, t, frame, obswl):
+    """Transform az/el to lon/lat in frame with astropy; see _astropy_to_altaz."""
+    from astropy.coordinates import SkyCoord, UnitSphericalRepresentation
+    from astropy.time import Time
+    az, el, t = np.broadcast_arrays(az, el, t)
+    altaz = altaz_frame(Time(t.ravel(), format='unix'), obswl=obswl)
+    sc = SkyCoord(az=az.ravel()*u.deg, alt=el.ravel()*u.deg, frame=altaz).transform_to(frame)
+    sph = sc.represent_as(UnitSphericalRepresentation)
+    return sph.lon.degree.reshape(az.shape) % 360, sph.lat.degree.reshape(az.shape)
+
+def fast_icrs_to_altaz(ra, dec, time=None, obswl=None):
+    """Transform ICRS ra/dec to az/el (all in degrees) for the radome.
 
+    Args:
+        ra, dec: arrays or scalars
+        time: Time of the observation; may be an array that broadcasts with ra/dec (default now)
+        obswl: observing wavelength, for refraction
+    """
+    if not _have_erfa_astrom():
+        return _astropy_to_altaz(ra, dec, _unix(time), 'icrs', obswl)
+    return _to_azel(_icrs_to_altaz_vectors(_to_vectors(ra, dec), _unix(time), obswl))
+
+def fast_altaz_to_icrs(az, el, time=None, obswl=None):
+    """Transform az/el to ICRS ra/dec; see fast_icrs_to_altaz."""
+    if not _have_erfa_astrom():
+        return _astropy_from_altaz(az, el, _unix(time), 'icrs', obswl)
+    return _from_vectors(_altaz_to_icrs_vectors(_from_azel(az, el), _unix(time), obswl))
+
+def fast_gal_to_altaz(l, b, time=None, obswl=None):
+    """Transform Galactic l/b to az/el; see fast_icrs_to_altaz."""
+    if not _have_erfa_astrom():
+        return _astropy_to_altaz(l, b, _unix(time), 'galactic', obswl)
+    return _to_azel(_icrs_to_altaz_vectors(_to_vectors(l, b) @ _galactic_matrix(), _unix(time), obswl))
+
+def fast_altaz_to_gal(az, el, time=None, obswl=None):
+    """Transform az/el to Galactic l/b; see fast_icrs_to_altaz."""
+    if not _have_erfa_astrom():
+        return _astropy_from_altaz(az, el, _unix(time), 'galactic', obswl)
+    return _from_vectors(_altaz_to_icrs_vectors(_from_azel(az, el), _unix(time), obswl) @ _galactic_matrix().T)
 
 def get_sun_altaz():
-    time=Time.now()    #print time
-    pos=radome_observer.sun_altaz(time)
+    time=get_time()    #print time
+    pos=get_radome_observer().sun_altaz(time)
     return (pos.az.degree, pos.alt.degree)
 
 def get_moon_altaz():
-    time=Time.now()    #print time
-    pos=radome_observer.moon_altaz(time)
+    time=get_time()    #print time
+    pos=get_radome_observer().moon_altaz(time)
     return (pos.az.degree, pos.alt.degree)
 
 #def get_mars_altaz():
@@ -129,6 +430,7 @@ def get_moon_altaz():
 
 # From AstroPy 4.0 (not compatible with Python 2.7)
 def directional_offset_by(coord, position_angle, separation):
+    from astropy.coordinates import SkyCoord, UnitSphericalRepresentation
     slat = coord.represent_as(UnitSphericalRepresentation).lat
     slon = coord.represent_as(UnitSphericalRepresentation).lon
 
@@ -139,6 +441,7 @@ def directional_offset_by(coord, position_angle, separation):
     return SkyCoord(newlon, newlat, frame=coord.frame)
 
 def offset_by(lon, lat, posang, distance):
+    from astropy.coordinates import Angle
     # Calculations are done using the spherical trigonometry sine and cosine rules
     # of the triangle A at North Pole,   B at starting point,   C at final point
     # with angles     A (change in lon), B (posang),            C (not used, but negative reciprocal posang)
@@ -182,3 +485,17 @@ def offset_by(lon, lat, posang, distance):
     outlat = Angle(np.arcsin(cos_b), u.radian).to(u.deg)
 
     return outlon, outlat
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Manage cached astronomical data')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    p = subparsers.add_parser('refresh', help='download fresh IERS tables to %s' % (CACHE_DIR,))
+    p.add_argument('--ephemeris', action='store_true', help='also download the %s ephemeris' % (EPHEMERIS_FILE,))
+    args = parser.parse_args()
+    if args.command == 'refresh':
+        refresh(ephemeris=args.ephemeris)
+
+if __name__ == '__main__':
+    main()
@@ -14,10 +14,14 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 import glob
+import logging
+import multiprocessing
 import sys
 import os.path
+import threading
 import numpy as np
 from numpy.polynomial.polynomial import polyfit, polyval
 try:
@@ -30,8 +34,8 @@ from astropy.table import QTable, Column, ColumnGroups
 from astropy.time import Time
 from astropy.io import fits
 from astropy.io.registry import IORegistryError
-from scipy import ndimage
-from scipy.interpolate import griddata
+import storage
+from stats import CORRECTION_POLY_POINTS
 import matplotlib as mpl
 if 'matplotlib.backends' not in sys.modules:
     mpl.use('Agg')
@@ -67,6 +71,61 @@ def plot_velocity(vel_range, data, title, filename):
         plt.savefig(filename)
         plt.close()
 
+def plot_drift(drift, title, filename):
+    """Plot band-averaged power against longitude offset for a drift scan."""
+    plt.figure()
+    plt.title(title)
+    plt.xlabel('Longitude Offset (%s)' % (drift['skyoffset_longitude'].unit,))
+    plt.ylabel('Power at Feed (%s)' % (drift['power'].unit,))
+    plt.plot(drift['skyoffset_longitude'], drift['power'], lw=0.5)
+    plt.axvline(x=0, color='black', ls='--')
+    if filename:
+        plt.savefig(filename)
+        plt.close()
+
+# Processes that render plots for BackgroundPlotter.
+PLOT_WORKERS = 1
+# Plots that may be waiting or rendering before BackgroundPlotter.submit blocks.
+PLOT_BACKLOG = 8
+
+class BackgroundPlotter(object):
+    """Render plots in worker processes while the caller carries on.
+
+    matplotlib isn't thread-safe, so plots are made in separate
+    processes, spawned rather than forked since the caller may have
+    threads running. submit() blocks while PLOT_BACKLOG plots are
+    outstanding, so slow rendering holds up the caller instead of
+    queueing without bound. A plot that fails is logged and skipped.
+    """
+    logger = logging.getLogger('plot')
+
+    def __init__(self, workers=PLOT_WORKERS, backlog=PLOT_BACKLOG):
+        self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        self._slots = threading.BoundedSemaphore(backlog)
+
+    def submit(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in a worker; func must be picklable."""
+        self._slots.acquire()
+        self._executor.submit(func, *args, **kwargs).add_done_callback(self._done)
+
+    def _done(self, future):
+        self._slots.release()
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.logger.warning('Background plot failed', exc_info=exc)
+
+    def close(self):
+        """Wait for outstanding plots and stop the workers."""
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 AXIS_NAMES = {
     'azimuth': 'Azimuth',
     'elevation': 'Elevation',
@@ -286,6 +345,7 @@ def oned2twod(xdata, ydata, zdata):
     # If it's a sparse grid something weird might have happened
     print("2D data is sparse (%d of %d points missing); wrong coordinate frame?" % (np.isnan(zz).sum(), zz.size))
     yy, xx = np.meshgrid(ydata,xdata)
+    from scipy.interpolate import griddata
     zz = griddata((xdata,ydata), zdata, (xx,yy), method='linear')
     return xx, yy, zz * zdata.unit, True
 
@@ -320,11 +380,6 @@ def plot_sample_grid(xdata, ydata):
     #segs2 = segs1.transpose(1, 0, 2)
     #ax.add_collection(mpl.collections.LineCollection(segs2))
 
-# Hand-tuned points that fall outside the region of interest.
-# These indices are used to estimate background noise level.
-CORRECTION_POLY_POINTS = np.array([75, 100, 125, 150, 175])
-# dsheen had 200, 225, 250 but those are within real data
-
 def normalize_data(all_data, visualize=False):
     """dsheen@'s polynomial fit algorithm
 
@@ -372,7 +427,7 @@ def average_data(all_data, keys, velocity_correction=True):
         if col.info.name in keep:
             # Keep columns get passed through
             new_col = col[i0s]
-        elif col.info.name in ('data', 'normalized_data', 'calibrated_data', 'average_power'):
+        elif col.info.name in ('data', 'reference_data', 'normalized_data', 'calibrated_data', 'average_power'):
             # Data gets averaged (with optional velocity correction)
             if len(col.shape) > 1 and velocity_correction and 'vels' in all_data.columns:
                 data = np.vstack(tuple(
@@ -436,6 +491,7 @@ def average_point(scans, vels):
         for j in range(num_samples):
             indices[:,i,j] = [i, np.float128(vels[0,j] - sample_vel_offset[i])/np.float128(sample_vel_slope[i])]
 
+    from scipy import ndimage
     scans_shifted = ndimage.map_coordinates(scans, indices)
 
     return u.Quantity(np.mean(scans_shifted, 0), unit=scans.unit)
@@ -509,6 +565,12 @@ def load_data(savefolder='.'):
     except (IOError, IORegistryError):
         # Revert to loading legacy data
         pass
+    store_path = os.path.join(savefolder, storage.STORE_DIR)
+    if os.path.exists(os.path.join(store_path, storage.METADATA_FILE)):
+        # The survey didn't finish; read the observations it stored.
+        all_data = storage.ObservationStore.open(store_path).table()
+        all_data['time'] = Time(all_data['time'].to_value(u.second), format='unix')
+        return all_data
     try:
         a = np.load(os.path.join(savefolder, 'all_data.npy'))
     except IOError:
@@ -536,9 +598,23 @@ def load_data(savefolder='.'):
 def apply_darksky(all_data):
     """Apply darksky corrections.
 
+    Each observation is paired with the darksky observation that has
+    the same number, or with the one numbered darksky_number when
+    surveys reuse cached darksky references.
+
     Returns:
         (observations with added calibrated_data column, darksky observations)
     """
+    if 'darksky_number' in all_data.colnames:
+        darksky_obs = all_data[all_data['darksky']]
+        calibrated_obs = all_data[~all_data['darksky']]
+        references = {number: i for i, number in enumerate(darksky_obs['number'])}
+        # Keep only observations that have a darksky calibration.
+        calibrated_obs = calibrated_obs[[number in references for number in calibrated_obs['darksky_number']]]
+        reference = [references[number] for number in calibrated_obs['darksky_number']]
+        calibrated_obs['calibrated_data'] = calibrated_obs['data'] - darksky_obs['data'][reference]
+        return calibrated_obs, darksky_obs
+
     # Keep only observations that have a darksky calibration.
     all_data = all_data.group_by('number').groups.filter(lambda t, _: len(t) == 2)
 
@@ -658,6 +734,7 @@ def project_image(all_data, xaxis):
         ]
     )
 
+    from scipy.interpolate import griddata
     proj = griddata((points[0], points[1]), all_data['data'].value.flatten(), (grid[1], grid[0]), method='linear')
 
     fu = lambda unit: u.format.Fits().to_string(unit)
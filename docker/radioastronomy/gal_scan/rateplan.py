@@ -0,0 +1,147 @@
+"""LimeSDR sample rates and decimation chains for a requested bandwidth.
+
+flowgraph.grc used to sample at a fixed 33.5 Msps and decimate to the
+IF in one sharp filter. That spends most of the CPU filtering samples
+it throws away at narrow bandwidths, and leaves too little for wide
+ones. plan() picks the lowest sample rate that covers the IF and its
+tuning offset. It then splits the decimation into two stages: the
+frequency-translating filter, whose transition band only has to keep
+aliases out of the final passband, and a sharp final filter at the
+lower rate.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from collections import namedtuple
+import math
+import os
+
+# IF sample rate per Hz of requested bandwidth, as in flowgraph.grc.
+IF_OVERSAMPLE = 1.1
+# Hz between the LO and the bottom of the IF, keeping the LimeSDR's DC
+# spike out of the band (flowgraph.grc's offset_frequency).
+OFFSET_GUARD = 1e5
+# Width of the LimeSDR's digital filter relative to the band it passes.
+FILTER_MARGIN = 1.25
+# Sample rate relative to the width of the LimeSDR's digital filter.
+SAMP_RATE_MARGIN = 1.1
+# Sample rates the LimeSDR can stream to the host.
+MIN_SAMP_RATE = 2.5e6
+MAX_SAMP_RATE = 61.44e6
+# Each channel's limit when both of the LimeSDR's receive channels stream.
+MAX_DUAL_SAMP_RATE = MAX_SAMP_RATE/2
+# The fixed sample rate flowgraph.grc used before rate planning.
+LEGACY_SAMP_RATE = 33554432
+# The final filter passes if_samp_rate/PASSBAND_DIVISOR with a
+# transition of if_samp_rate/TRANSITION_DIVISOR, as in flowgraph.grc.
+PASSBAND_DIVISOR = 2.05
+TRANSITION_DIVISOR = 10
+# firdes.low_pass' taps per sample rate/transition width with a
+# Blackman-Harris window (92 dB / 22).
+TAPS_PER_TRANSITION = 92/22
+# Input samples per second that one filter or FFT thread keeps up with
+# comfortably; see `benchmark.py rates`.
+SAMPLES_PER_THREAD = 20e6
+
+# One filter stage: its input sample rate, its decimation, and
+# firdes.low_pass' cutoff and transition width (None for a stage that
+# passes samples through).
+Stage = namedtuple('Stage', ['samp_rate', 'decimation', 'cutoff', 'transition'])
+
+def _divisors(n):
+    return [d for d in range(1, n + 1) if n % d == 0]
+
+def _cost(stages):
+    """Return the multiply-accumulates per second of direct FIRs for stages."""
+    return sum(
+        stage.samp_rate * TAPS_PER_TRANSITION * stage.samp_rate / stage.transition / stage.decimation
+        for stage in stages if stage.transition)
+
+def _stages(samp_rate, decimation, if_samp_rate, split=True):
+    """Return the cheapest two-stage split of decimation, or a single stage unless split."""
+    cutoff = if_samp_rate/PASSBAND_DIVISOR
+    transition = if_samp_rate/TRANSITION_DIVISOR
+    # Highest frequency the final filter lets through.
+    stop = cutoff + transition/2
+    best = None
+    for final in _divisors(decimation) if split else [1]:
+        first = decimation // final
+        if final == 1:
+            stages = [Stage(samp_rate, first, cutoff, transition), Stage(if_samp_rate, 1, None, None)]
+        else:
+            # Everything between stop and mid - stop is removed by the final filter.
+            mid = samp_rate/first
+            stages = [Stage(samp_rate, first, mid/2, mid - 2*stop), Stage(mid, final, cutoff, transition)]
+        if best is None or _cost(stages) < _cost(best):
+            best = stages
+    return best
+
+class RatePlan(object):
+    """Sample rate, filter stages and thread counts for one bandwidth.
+
+    stages[0] is the frequency-translating filter and stages[1] the
+    final filter; the IF sample rate is samp_rate/decimation.
+    """
+    def __init__(self, bandwidth, samp_rate, decimation, cpus=None, split=True):
+        self.bandwidth = bandwidth
+        self.samp_rate = samp_rate
+        self.decimation = decimation
+        self.if_samp_rate = samp_rate/decimation
+        self.stages = _stages(samp_rate, decimation, self.if_samp_rate, split)
+        # The IF sits OFFSET_GUARD above the LO, so the LimeSDR has to pass twice its top edge.
+        self.digital_bandwidth = 2*(self.if_samp_rate + OFFSET_GUARD)*FILTER_MARGIN
+        cpus = cpus or os.cpu_count() or 1
+        self.filter_threads = min(cpus, int(math.ceil(samp_rate/SAMPLES_PER_THREAD)))
+        self.fft_threads = min(cpus, int(math.ceil(self.if_samp_rate/SAMPLES_PER_THREAD)))
+
+    def taps(self, i):
+        """Return the taps of stage i."""
+        stage = self.stages[i]
+        if not stage.transition:
+            return [1.0]
+        from gnuradio.filter import firdes
+        return firdes.low_pass(1, stage.samp_rate, stage.cutoff, stage.transition, firdes.WIN_BLACKMAN_HARRIS)
+
+    def cost(self):
+        """Return the estimated multiply-accumulates per second of the stages."""
+        return _cost(self.stages)
+
+    def __repr__(self):
+        return 'RatePlan(%g Hz: %g sps / %s = %g sps, %d filter threads)' % (
+            self.bandwidth, self.samp_rate, ' / '.join(str(stage.decimation) for stage in self.stages),
+            self.if_samp_rate, self.filter_threads)
+
+def min_samp_rate(bandwidth):
+    """Return the lowest sample rate that can carry bandwidth Hz through the tuning offset."""
+    if_samp_rate = IF_OVERSAMPLE*bandwidth
+    return max(MIN_SAMP_RATE, 2*(if_samp_rate + OFFSET_GUARD)*FILTER_MARGIN*SAMP_RATE_MARGIN)
+
+# Widest bandwidth a plan can be made for; wide IFs are decimated by
+# 2*FILTER_MARGIN*SAMP_RATE_MARGIN rounded up.
+MAX_BANDWIDTH = MAX_SAMP_RATE/(math.ceil(2*FILTER_MARGIN*SAMP_RATE_MARGIN)*IF_OVERSAMPLE)
+
+def plan(bandwidth, samp_rate=None, cpus=None, split=True):
+    """Return a RatePlan for bandwidth Hz.
+
+    Without samp_rate, the lowest LimeSDR sample rate that is a whole
+    multiple of the IF sample rate is chosen. With samp_rate (e.g. of
+    a recording), the decimation is the largest that keeps the IF
+    sample rate at least IF_OVERSAMPLE*bandwidth, as in flowgraph.grc.
+    Unless split, all of the decimation happens in the first stage.
+    Raises ValueError if the bandwidth can't be reached.
+    """
+    if bandwidth <= 0:
+        raise ValueError('bandwidth must be positive')
+    if_samp_rate = IF_OVERSAMPLE*bandwidth
+    if samp_rate is None:
+        decimation = int(math.ceil(min_samp_rate(bandwidth)/if_samp_rate))
+        samp_rate = decimation*if_samp_rate
+        if samp_rate > MAX_SAMP_RATE:
+            raise ValueError('bandwidth must be at most %g Hz' % (MAX_BANDWIDTH,))
+    else:
+        decimation = int(samp_rate/if_samp_rate)
+        if decimation < 1:
+            raise ValueError('%g sps is too slow for a bandwidth of %g Hz' % (samp_rate, bandwidth))
+    return RatePlan(bandwidth, samp_rate, decimation, cpus, split)
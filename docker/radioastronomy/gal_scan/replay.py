@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Reprocess raw IQ recordings through the gal_scan integration chain.
+
+Recordings made with --capture-time (see capture.py) are run through
+flowgraph.grc's channel filter stages and the spectrometer as fast as
+the CPU allows, optionally with a different number of channels,
+window, spectrometer front end, bandwidth or sub-integration time. The
+sub-integrations of each recording NAME are saved to NAME_replay.npz in
+the same format as observation_N_subint.npz, with an extra
+sdr_frequency field, and the throughput of the chain is printed.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import os
+import time
+import numpy as np
+from gnuradio import blocks, gr
+import capture
+import rateplan
+import spectrometer
+
+class replay(gr.top_block):
+    """flowgraph.grc's receive chain fed from the recording name.
+
+    bandwidth defaults to the bandwidth that was recorded.
+    """
+    def __init__(self, name, num_channels=512, integration_time=1, window_name='blackmanharris', bandwidth=None, method='fft'):
+        gr.top_block.__init__(self, "Replay")
+        meta = capture.read_meta(name)
+        self.meta = meta
+        g = meta['global']
+        first = meta['captures'][0]
+        self.samp_rate = g['core:sample_rate']
+        self.bandwidth = bandwidth or g['gal_scan:bandwidth']
+        self.sdr_gain = g['gal_scan:sdr_gain']
+        self.offset_frequency = g['gal_scan:offset_frequency']
+        self.sdr_frequency = first['gal_scan:sdr_frequency']
+        self.num_channels = num_channels
+        self.rate_plan = rateplan.plan(self.bandwidth, self.samp_rate)
+        self.if_filter_decimation_rate = self.rate_plan.decimation
+        self.if_samp_rate = self.output_vector_bandwidth = self.rate_plan.if_samp_rate
+        self.integration_dec_rate = spectrometer.integration_dec_rate(integration_time, self.if_samp_rate, num_channels)
+        self.gain_correction_lin = spectrometer.gain_correction(self.sdr_gain) / g['gal_scan:scale']
+
+        self.blocks_file_source_0 = blocks.file_source(gr.sizeof_short*1, capture.data_path(name), False)
+        self.blocks_interleaved_short_to_complex_0 = blocks.interleaved_short_to_complex(False, False)
+        self.channel_filter = spectrometer.channel_filter(self.rate_plan, self.offset_frequency)
+        self.blocks_multiply_const_xx_0 = blocks.multiply_const_cc(self.gain_correction_lin)
+        self.spectrometer = spectrometer.spectrometer(num_channels, self.integration_dec_rate, self.if_samp_rate, window_name, method=method)
+        self.blocks_vector_sink_0 = blocks.vector_sink_f(num_channels)
+        self.connect(
+            self.blocks_file_source_0,
+            self.blocks_interleaved_short_to_complex_0,
+            self.channel_filter,
+            self.blocks_multiply_const_xx_0,
+            self.spectrometer,
+            self.blocks_vector_sink_0)
+
+    def sub_integration_time(self):
+        return self.integration_dec_rate * self.num_channels / self.if_samp_rate
+
+    def results(self):
+        """Return a dict of the sub-integrations, like observation_N_subint.npz.
+
+        time is when the last sample of each sub-integration was
+        recorded and sdr_frequency is the frequency the SDR was tuned
+        to for its first sample.
+        """
+        data = np.array(self.blocks_vector_sink_0.data(), dtype=np.float32).reshape(-1, self.num_channels)
+        counter = np.arange(len(data))
+        # Samples at the SDR's rate in each sub-integration.
+        span = self.integration_dec_rate * self.num_channels * self.if_filter_decimation_rate
+        captures = self.meta['captures']
+        starts = np.array([c['core:sample_start'] for c in captures])
+        segment = np.searchsorted(starts, counter*span, side='right') - 1
+        start_time = capture.parse_datetime(captures[0]['core:datetime'])
+        half_band = self.output_vector_bandwidth/2
+        return {
+            'time': start_time + (counter + 1)*span/self.samp_rate,
+            'counter': counter,
+            'data': data,
+            'freqs': np.linspace(self.sdr_frequency - half_band, self.sdr_frequency + half_band, self.num_channels)/1e6,
+            'sdr_frequency': np.array([captures[i]['gal_scan:sdr_frequency'] for i in segment]),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess raw IQ recordings')
+    parser.add_argument('names', metavar='NAME', nargs='+',
+                        help='recording to replay, with or without .sigmf-meta')
+    parser.add_argument('--channels', type=int, default=512, help='channels per spectrum')
+    parser.add_argument('--window', default='blackmanharris', choices=spectrometer.WINDOWS, help='FFT window')
+    parser.add_argument('--spectrometer', default='fft', choices=spectrometer.METHODS, help='spectrometer front end')
+    parser.add_argument('--sub-int-time', type=float, default=1, metavar='seconds', help='length of each sub-integration')
+    parser.add_argument('--bandwidth', type=float, metavar='Hz', help='filter bandwidth (default: as recorded)')
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name.endswith(capture.META_SUFFIX) or name.endswith(capture.DATA_SUFFIX):
+            name = os.path.splitext(name)[0]
+        tb = replay(name, args.channels, args.sub_int_time, args.window, args.bandwidth, args.spectrometer)
+        samples = os.path.getsize(capture.data_path(name)) // capture.SAMPLE_SIZE
+        start = time.perf_counter()
+        tb.run()
+        elapsed = time.perf_counter() - start
+        results = tb.results()
+        np.savez(name + '_replay.npz', **results)
+        print('%s: %d sub-integrations of %.2f sec from %.1f sec of IQ in %.1f sec (%.1f MS/s, %.1fx real time)' % (
+            name, len(results['data']), tb.sub_integration_time(), samples / tb.samp_rate, elapsed,
+            samples / elapsed / 1e6, samples / tb.samp_rate / elapsed))
+
+if __name__ == '__main__':
+    main()
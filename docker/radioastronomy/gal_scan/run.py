@@ -5,14 +5,17 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import logging
-import numpy as np
 import argparse
 import inspect
 import os
 import sys
-import time
 import survey_autoranging
 from survey_autoranging import Survey, Mode, AZ_OFFSET, EL_OFFSET
+import rateplan
+import schedule
+import spectrometer
+import storage
+from telescope import Telescope
 from astropy.coordinates import solar_system_ephemeris
 
 ##################################################
@@ -26,44 +29,80 @@ import rci.client
 
 from flowgraph import flowgraph
 
-class radiotelescope(flowgraph):
-    logger = logging.getLogger('radiotelescope')
+# limesdr.source channel_mode that streams channels A and B.
+DUAL_CHANNEL_MODE = 2
+# Product name of channel B's spectra in dual-channel mode.
+CHANNEL_B_PRODUCT = 'ch1'
+# Channel B's LNA and calibration, as limesdr_source_2 sets for channel A.
+CHANNEL_B_LNA_PATH = 2
+CHANNEL_B_CALIBRATION_BANDWIDTH = 15e6
 
-    def __init__(self, client, **kwargs):
-        super(radiotelescope, self).__init__(**kwargs)
-        self.client = client
-        self.darksky = None
-
-    def snapshot(self, int_time): #straight snapshot over a certain integration time.
-        self.logger.info('Snapshot %d sec', int_time)
-        self.integration_block.integrate(int_time)
-        vec = None
-        while vec is None:
-            time.sleep(1)
-            vec = self.integration_block.integrate_results()
-        return np.array(vec)
-
-    observe = snapshot
+class radiotelescope(Telescope, flowgraph):
+    """A Telescope that receives through the LimeSDR flowgraph.
 
-    def point(self, az,el):
-        """Point the dish at a particular azimuth and elevation.
+    spectrometer_method is one of spectrometer.METHODS and window_name
+    one of spectrometer.WINDOWS; unless they are flowgraph.grc's 'fft'
+    and 'blackmanharris', its FFT chain is replaced with a
+    spectrometer.spectrometer before the flowgraph starts. products
+    are spectrometer.Products computed from the same IF with the same
+    method. With channel_mode DUAL_CHANNEL_MODE, channel B gets the
+    same settings and receive chain as channel A, and its spectra are
+    recorded as the product CHANNEL_B_PRODUCT.
+    """
+    def __init__(self, spectrometer_method='fft', window_name='blackmanharris', products=(), **kwargs):
+        super(radiotelescope, self).__init__(**kwargs)
+        self.spectrometer_method = spectrometer_method
+        self.window_name = window_name
+        self.spectrometer = None
+        if self.channel_mode == DUAL_CHANNEL_MODE:
+            source = self.limesdr_source_2
+            source.set_antenna(CHANNEL_B_LNA_PATH, 1)
+            source.set_bandwidth(self.if_bandwidth_0, 1)
+            source.set_digital_filter(self.rate_plan.digital_bandwidth, 1)
+            source.set_gain(self.sdr_gain, 1)
+            source.calibrate(CHANNEL_B_CALIBRATION_BANDWIDTH, 1)
+            self.add_product(
+                spectrometer.channel_branch(
+                    CHANNEL_B_PRODUCT, self.rate_plan, self.offset_frequency, self.gain_correction_lin,
+                    self.num_channels, self.integration_dec_rate, spectrometer_method, window_name),
+                (source, 1))
+        if spectrometer_method != 'fft' or window_name != Telescope.window_name:
+            self.disconnect(*self.spectrometer_chain() + [self.integration_block])
+            self.spectrometer = spectrometer.spectrometer(
+                self.num_channels, self.integration_dec_rate, self.if_samp_rate, window_name,
+                fft_threads=self.rate_plan.fft_threads, method=spectrometer_method)
+            self.connect(*self.spectrometer_chain() + [self.integration_block])
+        for product in products:
+            self.add_product(
+                spectrometer.product_branch(product, self.if_samp_rate, spectrometer_method),
+                self.blocks_multiply_const_xx_0)
 
-        Blocks until the dish has stopped moving.
-        """
+    def spectrometer_chain(self):
+        if self.spectrometer is not None:
+            return [self.blocks_multiply_const_xx_0, self.spectrometer]
+        return [
+            self.blocks_multiply_const_xx_0,
+            self.blocks_stream_to_vector_0,
+            self.fft_vxx_0,
+            self.blocks_complex_to_mag_squared_0,
+            self.blocks_integrate_xx_0_0,
+            self.blocks_multiply_const_vxx_0,
+        ]
 
-        self.logger.info('Moving to position %s, %s.', az, el)
-        while True:
-            self.client.set_azimuth_position(az)
-            self.client.set_elevation_position(el)
-            time.sleep(1)
-            status = self.client.status
-            if not status.get("Moving"):
-                return
-            self.logger.debug('Still moving, current position (%g, %g).', self.client.azimuth_position, self.client.elevation_position)
+    def configure_spectrometer(self, num_channels=None, window_name=None, integration_time=None, **kwargs):
+        if self.channel_mode == DUAL_CHANNEL_MODE:
+            # Channel B's branch is built with channel A's settings and
+            # can't follow a switch, so both would stop matching.
+            current = self.spectrometer_settings()
+            if any(new is not None and new != old for new, old in zip((num_channels, window_name, integration_time), current)):
+                raise ValueError("the spectrometer settings can't change in dual-channel mode")
+        return super(radiotelescope, self).configure_spectrometer(num_channels, window_name, integration_time, **kwargs)
 
-    def park(self):
-        self.logger.info("Parking")
-        self.point(250,50)
+    def set_sdr_gain(self, sdr_gain):
+        super(radiotelescope, self).set_sdr_gain(sdr_gain)
+        if self.channel_mode == DUAL_CHANNEL_MODE:
+            self.limesdr_source_2.set_gain(sdr_gain, 1)
+            self.products[CHANNEL_B_PRODUCT].set_gain_correction_lin(self.gain_correction_lin)
 
 
 flowgraph_defaults = {
@@ -82,12 +121,36 @@ arg_groups = {
                        bokeh=dict(low=1)),
         'ref': dict(default=False, action='store_true', help='measure 50Ω reference load'),
     },
+    'Adaptive integration': {
+        'target-snr': dict(type=float, help='stop integrating once the line reaches this SNR; int-time becomes the limit', metavar='SNR',
+                           bokeh=dict(low=0)),
+        'target-noise': dict(type=float, help='stop integrating once the fractional noise in line-free channels falls to this', metavar='fraction',
+                             bokeh=dict(low=0)),
+        'min-int-time': dict(type=float, default=5, help='shortest adaptive integration', metavar='seconds',
+                             bokeh=dict(low=0)),
+    },
+    'Frequency switching': {
+        'freq-switch-offset': dict(type=float, default=0, help='switch to this offset for a reference spectrum instead of a darksky position', metavar='Hz'),
+        'freq-switch-period': dict(type=float, default=5, help='time at each frequency', metavar='seconds',
+                                   bokeh=dict(low=0)),
+    },
+    'Spectrometer': {
+        'channels': dict(type=int, default=flowgraph_defaults['num_channels'], help='channels per spectrum', metavar='N',
+                         bokeh=dict(low=16)),
+        'window': dict(default=Telescope.window_name, choices=spectrometer.WINDOWS, help='FFT window'),
+        'sub-int-time': dict(type=float, help='save sub-integrations of this length for each observation', metavar='seconds',
+                             bokeh=dict(low=0)),
+    },
+    'Capture': {
+        'capture-time': dict(type=float, default=0, help='record this much raw IQ at the start of each observation', metavar='seconds',
+                             bokeh=dict(low=0)),
+    },
     'RF': {
         'sdr-frequency': dict(type=float, metavar='Hz', default=flowgraph_defaults['sdr_frequency'], help='center frequency'),
         'bandwidth': dict(type=float, metavar='Hz', default=flowgraph_defaults['bandwidth'], help='filter bandwidth',
                           bokeh=dict(
-                              max=5e6,
-                              # TODO: Remove when bandwidth calculations work without killing LimeSDR.
+                              max=rateplan.MAX_BANDWIDTH,
+                              # Surveys use the flowgraph's bandwidth, set with web.py --bandwidth; see Telescope.set_bandwidth.
                               writable=False,
                           )),
     },
@@ -97,8 +160,19 @@ arg_groups = {
         'stop': dict(type=float, default=360, help='end'),
         'step': dict(type=float, default=2.5, help='step'),
         'darksky-offset': dict(type=float, default=0, help='darksky offset', metavar='°'),
+        'darksky-max-age': dict(type=float, default=0, help='reuse darksky references at a similar elevation for this long', metavar='seconds',
+                                bokeh=dict(low=0)),
+        'darksky-el-bin': dict(type=float, default=5, help='elevation bin for reusing darksky references', metavar='°',
+                               bokeh=dict(low=0)),
     },
-    'mode=grid': {
+    'Schedule': {
+        'order': dict(default='row', choices=schedule.ORDERS, help='observing order'),
+        'az-rate': dict(type=float, default=schedule.AZ_SLEW_RATE, help='azimuth slew rate', metavar='°/s',
+                        bokeh=dict(low=0)),
+        'el-rate': dict(type=float, default=schedule.EL_SLEW_RATE, help='elevation slew rate', metavar='°/s',
+                        bokeh=dict(low=0)),
+    },
+    'mode=grid,otf_grid': {
         'obj-name': dict(help='named object'),
         'lat': dict(type=float, help='center galactic latitude', metavar='°',
                     bokeh=dict(low=-180, high=180)),
@@ -107,7 +181,7 @@ arg_groups = {
         'rotation': dict(type=float, help='grid rotation', metavar='°'),
         'rotation-frame': dict(default='icrs', choices=('icrs', 'galactic'), help='grid rotation frame'),
     },
-    'mode=solar_grid': {
+    'mode=solar_grid,otf_solar_grid,drift': {
         'body-name': dict(help='solar body', choices=solar_system_ephemeris.bodies, default='sun'),
     }
 }
@@ -120,40 +194,85 @@ class LoggingArgumentParser(argparse.ArgumentParser):
 
 def parse_args(args, defaults={}):
     parser = LoggingArgumentParser(description='Galactic sky scan')
-    parser.add_argument('output_dir', metavar='DIRECTORY',
+    parser.add_argument('output_dir', metavar='DIRECTORY', nargs='?',
                         help='output directory to write scan results')
+    parser.add_argument('--resume', metavar='DIRECTORY',
+                        help='continue an interrupted survey in DIRECTORY, with its original arguments')
+    parser.add_argument('--spectrometer', default='fft', choices=spectrometer.METHODS,
+                        help='spectrometer front end: non-overlapping FFTs, 50%% overlapped FFTs, or a polyphase filterbank')
+    parser.add_argument('--dual-channel', action='store_true',
+                        help="also integrate the LimeSDR's second receive channel, in %s_data columns" % (CHANNEL_B_PRODUCT,))
+    parser.add_argument('--product', action='append', default=[], metavar='NAME:OFFSET:BANDWIDTH:CHANNELS[:SUB_INT_TIME]',
+                        help='also record a spectrum of BANDWIDTH Hz centered OFFSET Hz from the SDR frequency, in NAME_data columns; may be repeated')
     for group_name, group_args in arg_groups.items():
         group = parser.add_argument_group(group_name)
         for arg_name, kwargs in group_args.items():
-            if 'bokeh' in kwargs:
-                del kwargs['bokeh']
-            group.add_argument('--'+arg_name, **kwargs)
+            # web.py reads the bokeh settings, so leave them in arg_groups.
+            group.add_argument('--'+arg_name, **{k: v for k, v in kwargs.items() if k != 'bokeh'})
     parser.set_defaults(**defaults)
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.resume:
+        # Arguments given now override the ones the survey was started with.
+        store = storage.ObservationStore.open(os.path.join(parsed.resume, storage.STORE_DIR))
+        restored = dict(store.meta['args'])
+        # --product appends to its default, and the store's columns follow
+        # the original products, so they can only be repeated unchanged.
+        if parsed.product:
+            if parsed.product != restored.get('product', []):
+                parser.error('--product must match the products the survey was started with')
+            restored['product'] = []
+        parser.set_defaults(**restored)
+        parsed = parser.parse_args(args)
+        parsed.output_dir = parsed.resume
+    elif parsed.output_dir is None:
+        parser.error('DIRECTORY or --resume is required')
+    names = {CHANNEL_B_PRODUCT} if parsed.dual_channel else set()
+    for spec in parsed.product:
+        try:
+            name = spectrometer.parse_product(spec).name
+        except ValueError as e:
+            parser.error(str(e))
+        if name in names:
+            parser.error('spectral product name %s is already in use' % (name,))
+        names.add(name)
+    return parsed
+
+def top_block_kwargs(args):
+    """Return the flowgraph arguments for a survey's parsed args."""
+    tbkwargs = {'sdr_gain': args.gain}
+    if args.sdr_frequency:
+        tbkwargs['sdr_frequency'] = args.sdr_frequency
+    if args.bandwidth:
+        # Raises ValueError for bandwidths the LimeSDR can't reach.
+        rateplan.plan(args.bandwidth)
+        tbkwargs['bandwidth'] = args.bandwidth
+    if args.sub_int_time:
+        tbkwargs['integration_time'] = args.sub_int_time
+    if args.channels:
+        tbkwargs['num_channels'] = args.channels
+    tbkwargs['spectrometer_method'] = args.spectrometer
+    tbkwargs['window_name'] = args.window
+    tbkwargs['products'] = [spectrometer.parse_product(spec) for spec in args.product]
+    if args.dual_channel:
+        if rateplan.plan(args.bandwidth or flowgraph_defaults['bandwidth']).samp_rate > rateplan.MAX_DUAL_SAMP_RATE:
+            raise ValueError('both LimeSDR channels can only stream up to %g sps each' % (rateplan.MAX_DUAL_SAMP_RATE,))
+        tbkwargs['channel_mode'] = DUAL_CHANNEL_MODE
+    return tbkwargs
 
 def main(top_block_cls=radiotelescope, options=None):
     logging.basicConfig(
         format="%(asctime)-15s %(levelname)-8s [%(name)s] [%(module)s:%(funcName)s] %(message)s",
         level=logging.DEBUG,
     )
-    args = parse_args(sys.argv)
+    args = parse_args(sys.argv[1:])
 
     client = rci.client.Client(client_name='gal_scan')
     client.set_offsets(AZ_OFFSET, EL_OFFSET)
 
-    tbkwargs = {}
-    if args.sdr_frequency:
-        tbkwargs['sdr_frequency'] = args.sdr_frequency
-    if args.bandwidth:
-        if args.bandwidth > 5e6:
-            raise ValueError("bandwidth must be <5e6")
-        tbkwargs['bandwidth'] = args.bandwidth
-
     tb = top_block_cls(
         client=client,
-        sdr_gain=args.gain,
         file_sink_path=os.path.join(args.output_dir, 'receive_block_sink'),
-        **tbkwargs
+        **top_block_kwargs(args)
     )
     tb.start()
     logging.info('Receiving ...')
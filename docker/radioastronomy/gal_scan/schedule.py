@@ -0,0 +1,312 @@
+"""Observation planning for stop-and-stare surveys.
+
+Track precomputes where every survey point will be on the sky while the
+survey runs, so that positions can be looked up instead of transformed
+one at a time. The survey iterators emit points in row-major order;
+given a Track, plan() reorders each pass over the points to reduce the
+time spent slewing and to reach points before they set.
+"""
+
+import logging
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.time import TimeDelta
+import galcoord
+from galcoord import altaz_frame, velocity_corrections
+
+ORDERS = ('row', 'serpentine', 'nearest', '2opt')
+
+# Default dish slew rates, in degrees per second.
+AZ_SLEW_RATE = 2.0
+EL_SLEW_RATE = 1.0
+# Seconds spent settling on each point after a slew.
+SETTLE_TIME = 2.0
+# Initial seconds between samples of the predicted positions of each point.
+TRACK_STEP = 600
+# Degrees that interpolated positions may be off by.
+TRACK_TOLERANCE = 0.01
+# Most obstimes to sample positions at while refining.
+TRACK_MAX_SAMPLES = 4097
+# Track columns that wrap at 360°.
+LONGITUDES = ('az', 'ra', 'l')
+# Improvement passes made by 2-opt before giving up.
+TWO_OPT_PASSES = 20
+
+logger = logging.getLogger('schedule')
+
+def slew_time(az0, el0, az1, el1, az_rate=AZ_SLEW_RATE, el_rate=EL_SLEW_RATE):
+    """Return seconds to slew between positions, with both axes moving at once."""
+    daz = np.abs((np.asarray(az1) - az0 + 180) % 360 - 180)
+    return np.maximum(daz / az_rate, np.abs(np.asarray(el1) - el0) / el_rate)
+
+class Track(object):
+    """Predicted positions of every point of an iterator over a span of time.
+
+    Positions of all points are computed for a grid of obstimes in one
+    vectorized transform and linearly interpolated in between. The grid
+    is refined until interpolated az/el are within TRACK_TOLERANCE
+    degrees of exact ones at the midpoints between samples, where
+    interpolation is worst. The largest error found there is kept as
+    error.
+
+    Columns (in degrees, or km/s for velocities) are az, el, ra, dec,
+    l and b, plus v_bary and v_proj (see galcoord.velocity_corrections)
+    unless the points are fixed in az/el.
+    """
+    def __init__(self, iterator, start, duration, step=TRACK_STEP, obswl=None):
+        self.iterator = iterator
+        self.start = start
+        self.obswl = obswl
+        self.times = np.linspace(0, duration, max(2, int(np.ceil(duration / step)) + 1))
+        columns = self._sample(self.times)
+        while True:
+            mid = (self.times[1:] + self.times[:-1]) / 2
+            exact = self._sample(mid)
+            self.error = _max_separation(
+                _midpoints(columns['az']), _midpoints(columns['el']),
+                exact['az'], exact['el'])
+            if self.error <= TRACK_TOLERANCE or len(self.times) >= TRACK_MAX_SAMPLES:
+                break
+            # Halve the step, keeping the midpoints we already have.
+            self.times = _interleave(self.times, mid)
+            columns = {k: _interleave(v, exact[k]) for k, v in columns.items()}
+        if self.error > TRACK_TOLERANCE:
+            logger.warning('Interpolated positions may be off by %.3f°', self.error)
+        self.columns = columns
+
+    def _sample(self, times):
+        """Return columns at times seconds after start, each of shape (len(times), len(self))."""
+        t = self.start + TimeDelta(times[:, np.newaxis]*u.second)
+        aaf = altaz_frame(t, obswl=self.obswl)
+        pos = self.iterator.coords_at(t)
+        fixed = pos.frame.name == 'altaz'
+        if fixed:
+            shape = (len(times), len(pos))
+            altaz = SkyCoord(np.broadcast_to(pos.az.degree, shape)*u.degree,
+                             np.broadcast_to(pos.alt.degree, shape)*u.degree, frame=aaf)
+            pos = altaz
+        else:
+            altaz = pos.transform_to(aaf)
+        icrs = pos.icrs
+        gal = icrs.galactic
+        columns = {
+            'az': altaz.az.degree,
+            'el': altaz.alt.degree,
+            'ra': icrs.ra.degree,
+            'dec': icrs.dec.degree,
+            'l': gal.l.degree,
+            'b': gal.b.degree,
+        }
+        if not fixed:
+            v_bary, v_proj = velocity_corrections(SkyCoord(gal, obstime=t, location=galcoord.radome_observer.location))
+            columns['v_bary'] = v_bary.to_value(u.km/u.s)
+            columns['v_proj'] = v_proj.to_value(u.km/u.s)
+        shape = np.broadcast(*columns.values()).shape
+        columns = {k: np.broadcast_to(v, shape) for k, v in columns.items()}
+        for k in LONGITUDES:
+            columns[k] = np.rad2deg(np.unwrap(np.deg2rad(columns[k]), axis=0))
+        return columns
+
+    def __len__(self):
+        return self.columns['az'].shape[1]
+
+    @property
+    def end(self):
+        """Seconds after start covered by the track."""
+        return self.times[-1]
+
+    def at(self, indices, t, names=None):
+        """Return interpolated columns for points indices, t seconds after start.
+
+        Args:
+            names: columns to return (default all)
+        """
+        k = np.interp(t, self.times, np.arange(len(self.times)))
+        i = min(int(k), len(self.times) - 2)
+        f = k - i
+        values = {}
+        for name in names or self.columns:
+            column = self.columns[name]
+            values[name] = column[i, indices] * (1 - f) + column[i+1, indices] * f
+            if name in LONGITUDES:
+                values[name] %= 360
+        return values
+
+    def azel(self, indices, t):
+        """Return (az, el) in degrees of points indices, t seconds after start."""
+        values = self.at(indices, t, ('az', 'el'))
+        return values['az'], values['el']
+
+def _midpoints(column):
+    return (column[1:] + column[:-1]) / 2
+
+def _interleave(a, b):
+    """Return a with b's rows in between."""
+    out = np.empty((len(a) + len(b),) + a.shape[1:], dtype=a.dtype)
+    out[0::2] = a
+    out[1::2] = b
+    return out
+
+def _max_separation(az0, el0, az1, el1):
+    """Return the largest separation in degrees between two sets of az/el, for small separations."""
+    daz = (az1 - az0 + 180) % 360 - 180
+    return np.max(np.hypot(daz*np.cos(np.deg2rad(el0)), el1 - el0), initial=0)
+
+class Schedule(object):
+    """Simulated execution of an observing order.
+
+    Attributes:
+        order: point indices in observing order
+        slew_time: predicted total seconds spent slewing
+        missed: indices of points that will be below the horizon when reached
+        duration: predicted seconds for the whole order
+    """
+    def __init__(self, track, order, dwell, start_azel, min_el,
+                 az_rate=AZ_SLEW_RATE, el_rate=EL_SLEW_RATE, settle=SETTLE_TIME, start=0):
+        self.order = list(order)
+        self.slew_time = 0
+        self.missed = []
+        az, el = start_azel
+        t = start
+        for i in self.order:
+            target = track.azel(i, t)
+            # Aim for where the point will be when the slew finishes.
+            target = track.azel(i, t + slew_time(az, el, *target, az_rate, el_rate))
+            if target[1] < min_el:
+                self.missed.append(i)
+                continue
+            s = slew_time(az, el, *target, az_rate, el_rate)
+            self.slew_time += s
+            t += s + settle + dwell
+            az, el = target
+        self.end_azel = (az, el)
+        self.end = t
+        self.duration = t - start
+
+    def cost(self):
+        """Return a key that sorts better schedules first."""
+        return (len(self.missed), self.slew_time)
+
+def serpentine(n, row_length):
+    """Return range(n) with every other row of row_length points reversed.
+
+    The last row may be shorter than row_length.
+    """
+    order = []
+    for i, start in enumerate(range(0, n, row_length)):
+        row = list(range(start, min(start + row_length, n)))
+        order += row[::-1] if i % 2 else row
+    return order
+
+def nearest(track, points, dwell, start_azel, min_el,
+            az_rate=AZ_SLEW_RATE, el_rate=EL_SLEW_RATE, settle=SETTLE_TIME, start=0):
+    """Order points by always slewing to the closest one next.
+
+    Points that will set before the rest of the points could be
+    observed are visited first, closest first.
+    """
+    remaining = list(points)
+    set_times = []
+    for i in remaining:
+        below = track.columns['el'][:, i] < min_el
+        # Time at which the point is last above the horizon, or inf if it stays up.
+        after = np.flatnonzero(~below)
+        set_times.append(track.times[after[-1]] if below[-1] and len(after) else np.inf)
+    set_times = dict(zip(remaining, set_times))
+    order = []
+    az, el = start_azel
+    t = start
+    while remaining:
+        r = np.array(remaining)
+        taz, tel = track.azel(r, t)
+        cost = slew_time(az, el, taz, tel, az_rate, el_rate)
+        visible = tel >= min_el
+        if not visible.any():
+            # Nothing is up now; leave the rest in their original order.
+            order.extend(remaining)
+            break
+        work = len(remaining) * (dwell + settle)
+        urgent = visible & (np.array([set_times[i] for i in remaining]) - t < work)
+        candidates = urgent if urgent.any() else visible
+        best = np.flatnonzero(candidates)[np.argmin(cost[candidates])]
+        order.append(remaining.pop(best))
+        t += cost[best] + settle + dwell
+        az, el = taz[best], tel[best]
+    return order
+
+def two_opt(track, order, t, az_rate=AZ_SLEW_RATE, el_rate=EL_SLEW_RATE):
+    """Improve an order by reversing segments that shorten the path.
+
+    Slew times are evaluated at a single time t, so the result must be
+    checked with Schedule.
+    """
+    order = np.array(order)
+    n = len(order)
+    if n < 4:
+        return list(order)
+    az, el = track.azel(np.arange(len(track)), t)
+    for _ in range(TWO_OPT_PASSES):
+        improved = False
+        for i in range(n - 2):
+            a, b = order[i], order[i+1]
+            c = order[i+2:]
+            d = np.append(order[i+3:], -1)
+            # Reversing order[i+1:j+1] replaces edges a-b and c-d with a-c and b-d.
+            old = slew_time(az[a], el[a], az[b], el[b], az_rate, el_rate) + np.where(
+                d >= 0, slew_time(az[c], el[c], az[d], el[d], az_rate, el_rate), 0)
+            new = slew_time(az[a], el[a], az[c], el[c], az_rate, el_rate) + np.where(
+                d >= 0, slew_time(az[b], el[b], az[d], el[d], az_rate, el_rate), 0)
+            gain = old - new
+            j = np.argmax(gain)
+            if gain[j] > 1e-9:
+                j += i + 2
+                order[i+1:j+1] = order[i+1:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return list(order)
+
+def plan(track, n, repeat, method, dwell, start_azel, min_el, row_length=None,
+         az_rate=AZ_SLEW_RATE, el_rate=EL_SLEW_RATE, settle=SETTLE_TIME):
+    """Plan repeat passes over n points.
+
+    Each pass visits every point once and starts where the previous one
+    ended.
+
+    Returns:
+        (Schedule for method, Schedule for the row-major order); orders
+        index the points of all passes, 0 to n*repeat-1
+    """
+    kwargs = dict(min_el=min_el, az_rate=az_rate, el_rate=el_rate, settle=settle)
+    naive = Schedule(track, [], dwell, start_azel, **kwargs)
+    planned = Schedule(track, [], dwell, start_azel, **kwargs)
+    for p in range(repeat):
+        points = range(n)
+        if method == 'row':
+            order = list(points)
+        elif method == 'serpentine':
+            order = serpentine(n, row_length) if row_length else list(points)
+            if p % 2:
+                order = order[::-1]
+        elif method in ('nearest', '2opt'):
+            order = nearest(track, points, dwell, planned.end_azel, start=planned.end, **kwargs)
+            if method == '2opt':
+                s = Schedule(track, order, dwell, planned.end_azel, start=planned.end, **kwargs)
+                improved = two_opt(track, order, (s.end + planned.end) / 2, az_rate, el_rate)
+                if Schedule(track, improved, dwell, planned.end_azel, start=planned.end, **kwargs).cost() <= s.cost():
+                    order = improved
+        else:
+            raise ValueError('unknown order %r' % (method,))
+        naive_pass = Schedule(track, points, dwell, naive.end_azel, start=naive.end, **kwargs)
+        planned_pass = Schedule(track, order, dwell, planned.end_azel, start=planned.end, **kwargs)
+        for s, part in ((naive, naive_pass), (planned, planned_pass)):
+            s.order += [i + p*n for i in part.order]
+            s.missed += [i + p*n for i in part.missed]
+            s.slew_time += part.slew_time
+            s.end_azel = part.end_azel
+            s.end = part.end
+            s.duration = s.end
+    logger.info('Predicted slew time %.0f sec with %d points below the horizon in %s order, vs %.0f sec with %d in row order',
+                planned.slew_time, len(planned.missed), method, naive.slew_time, len(naive.missed))
+    return planned, naive
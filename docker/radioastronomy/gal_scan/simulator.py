@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+"""Hardware-free stand-ins for the dish and the SDR.
+
+SimulatedClient replaces rci.client.Client: it slews a simulated dish
+at configurable rates, settles, and reports 'Moving' like the dish
+controller. SkyModel synthesizes complex IF samples containing the
+galactic HI line for the dish's current pointing, receiver and ground
+noise, and RFI. SimulatedTelescope runs those samples through the same
+integration chain as flowgraph.grc.
+
+Running this file runs a survey against them at accelerated time and
+reports its duty cycle and per-stage latencies. Arguments that the
+simulator doesn't recognize are passed to run.py:
+
+    /flowgraph/simulator.py --speedup 10 --mode=gal --step=10 --int-time=30 /tmp/sim
+
+The dish and the sample stream run --speedup times faster than real
+time, so stop-and-stare surveys finish that much sooner. On-the-fly
+and drift scans are clocked by the host and still take real time.
+GNU Radio and the blocks generated from flowgraph.grc are needed, so
+run it inside the gal_scan container.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import argparse
+import csv
+import logging
+import os
+import threading
+import time
+import numpy as np
+from gnuradio import blocks, gr
+import galcoord
+import rateplan
+import run
+import schedule
+import spectrometer
+import survey_autoranging
+from survey_autoranging import Survey
+from telescope import Telescope
+# Generated by grcc from the integration_block epy_block.
+import flowgraph_integration_block
+
+# Boltzmann's constant in mW/Hz/K.
+BOLTZMANN = 1.380649e-20
+# Receiver noise temperature in K.
+RECEIVER_TEMPERATURE = 100
+# Physical temperature of the 50Ω reference load in K.
+LOAD_TEMPERATURE = 290
+# Ground spillover at the horizon in K, falling off exponentially over
+# GROUND_SCALE_HEIGHT degrees of elevation.
+GROUND_TEMPERATURE = 30
+GROUND_SCALE_HEIGHT = 10
+# Fraction of the sky's brightness temperature seen by the receiver.
+BEAM_EFFICIENCY = 0.5
+# A flat rotation curve for the galactic HI disc: the Sun's distance
+# from the galactic center (kpc) and the rotation speed (km/s).
+SUN_RADIUS = 8.5
+ROTATION_SPEED = 220
+# Outer edge (kpc), Gaussian scale height (kpc), and scale length
+# beyond the solar circle (kpc) of the HI density.
+DISC_RADIUS = 15
+DISC_SCALE_HEIGHT = 0.15
+DISC_SCALE_LENGTH = 3
+# Spin temperature (K), velocity dispersion (km/s), and optical depth
+# of a kpc of gas at the solar circle per km/s of line width.
+SPIN_TEMPERATURE = 125
+VELOCITY_DISPERSION = 10
+OPACITY = 10
+# Step (kpc) and length (kpc) of the lines of sight through the disc.
+SIGHT_STEP = 0.1
+SIGHT_LENGTH = 30
+# Narrowband interferers as (frequency in Hz, temperature in K,
+# fraction of the time on, period of the on/off cycle in seconds).
+RFI = (
+    (1419.8e6, 200, 1, 1),
+    (1420.95e6, 1000, 0.2, 60),
+)
+# Degrees the pointing must change by before the sky spectrum is recomputed.
+SKY_UPDATE_DISTANCE = 0.05
+# Seconds between simulated RCI status updates.
+STATUS_INTERVAL = 0.1
+# Where the simulated dish starts, as (azimuth, elevation).
+PARK_POSITION = (250, 50)
+# Speed of light in km/s.
+SPEED_OF_LIGHT = 299792.458
+
+def hi_brightness(l, b, vels):
+    """Return the HI brightness temperature in K toward galactic l, b.
+
+    l and b are in degrees and vels are LSR velocities in km/s. The gas
+    is a disc with a flat rotation curve, and each step along the line
+    of sight adds optical depth at its radial velocity.
+    """
+    d = np.arange(SIGHT_STEP/2, SIGHT_LENGTH, SIGHT_STEP)
+    l, b = np.deg2rad(l), np.deg2rad(b)
+    x, z = d*np.cos(b), d*np.sin(b)
+    R = np.sqrt(SUN_RADIUS**2 + x**2 - 2*SUN_RADIUS*x*np.cos(l))
+    density = np.where(R < DISC_RADIUS, np.exp(-0.5*(z/DISC_SCALE_HEIGHT)**2 - np.maximum(R - SUN_RADIUS, 0)/DISC_SCALE_LENGTH), 0)
+    v = ROTATION_SPEED*(SUN_RADIUS/R - 1)*np.sin(l)*np.cos(b)
+    profile = np.exp(-0.5*((np.asarray(vels)[:, np.newaxis] - v)/VELOCITY_DISPERSION)**2) / (np.sqrt(2*np.pi)*VELOCITY_DISPERSION)
+    tau = OPACITY * (profile * density * SIGHT_STEP).sum(axis=1)
+    return SPIN_TEMPERATURE*(1 - np.exp(-tau))
+
+class SimulatedClient(object):
+    """Stand-in for rci.client.Client that drives a simulated dish.
+
+    Each axis slews towards its commanded position at az_rate or
+    el_rate degrees per second and then reports 'Moving' for another
+    settle_time seconds. The dish runs speedup times faster than real
+    time. Status updates arrive every STATUS_INTERVAL seconds and
+    notify _cv, as they do from the real client.
+    """
+    def __init__(self, az_rate=schedule.AZ_SLEW_RATE, el_rate=schedule.EL_SLEW_RATE, settle_time=schedule.SETTLE_TIME, speedup=1, position=PARK_POSITION):
+        self.az_rate = az_rate
+        self.el_rate = el_rate
+        self.settle_time = settle_time
+        self.speedup = speedup
+        self._cv = threading.Condition()
+        self.azimuth_position, self.elevation_position = position
+        self._command = position
+        self._settle_remaining = 0
+        location = galcoord.get_radome_observer().location
+        self.status = {
+            'Moving': False,
+            'AzPos': self.azimuth_position,
+            'ElPos': self.elevation_position,
+            'CommandAzFlags': 'NONE',
+            'CommandElFlags': 'NONE',
+            'CommandAzPos': self.azimuth_position,
+            'CommandElPos': self.elevation_position,
+            'Latitude': location.lat.degree,
+            'Longitude': location.lon.degree,
+            'Sequencer': {'Bands': [{'CommandRX': False}]},
+        }
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='simulated_rci', daemon=True)
+        self._thread.start()
+
+    def set_offsets(self, az_offset, el_offset):
+        """Accepted for compatibility; simulated positions have no offsets."""
+
+    def set_azimuth_position(self, az):
+        with self._cv:
+            self._command = (az % 360, self._command[1])
+            self.status.update(CommandAzFlags='POSITION', CommandAzPos=self._command[0])
+
+    def set_elevation_position(self, el):
+        with self._cv:
+            self._command = (self._command[0], el)
+            self.status.update(CommandElFlags='POSITION', CommandElPos=el)
+
+    def set_band_rx(self, band, rx):
+        with self._cv:
+            self.status['Sequencer']['Bands'][band]['CommandRX'] = rx
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stop.wait(STATUS_INTERVAL):
+            now = time.monotonic()
+            with self._cv:
+                self._step((now - last) * self.speedup)
+                self._cv.notify_all()
+            last = now
+
+    def _step(self, dt):
+        """Advance the dish by dt simulated seconds."""
+        az_command, el_command = self._command
+        daz = (az_command - self.azimuth_position + 180) % 360 - 180
+        delev = el_command - self.elevation_position
+        slewing = bool(daz or delev)
+        if abs(daz) <= self.az_rate*dt:
+            self.azimuth_position = az_command
+        else:
+            self.azimuth_position = (self.azimuth_position + np.sign(daz)*self.az_rate*dt) % 360
+        if abs(delev) <= self.el_rate*dt:
+            self.elevation_position = el_command
+        else:
+            self.elevation_position += np.sign(delev)*self.el_rate*dt
+        if slewing:
+            self._settle_remaining = self.settle_time
+        else:
+            self._settle_remaining = max(0, self._settle_remaining - dt)
+        self.status.update(
+            Moving=slewing or self._settle_remaining > 0,
+            AzPos=self.azimuth_position,
+            ElPos=self.elevation_position,
+        )
+
+class SkyModel(object):
+    """Synthesizes the complex IF that the integration chain receives.
+
+    Samples are calibrated so that the chain's output is in mW/Hz, so
+    the SDR gain has no effect. The spectrum follows the telescope's
+    client: the HI line for its pointing plus receiver and ground
+    noise and rfi, or a flat spectrum from the 50Ω load when the
+    receiver is disabled.
+    """
+    def __init__(self, telescope, num_channels, samp_rate, rfi=RFI, seed=None):
+        self.telescope = telescope
+        self.num_channels = num_channels
+        self.samp_rate = samp_rate
+        self.rfi = rfi
+        self.rng = np.random.default_rng(seed)
+        self.produced = 0
+        self._key = None
+        # Computing tones is as slow as the noise, so each is computed once per block length.
+        self._tones = {}
+        # The window flowgraph.grc's calibration assumes, a 4-term
+        # Blackman-Harris; the spectrometer rescales other channel
+        # counts and front ends to it, so the IF doesn't depend on them.
+        m = spectrometer.REFERENCE_CHANNELS
+        n = np.arange(m)
+        w = 0.35875 - 0.48829*np.cos(2*np.pi*n/(m-1)) + 0.14128*np.cos(4*np.pi*n/(m-1)) - 0.01168*np.cos(6*np.pi*n/(m-1))
+        self.window_power = np.sum(w**2)
+        self.window_gain = np.sum(w)
+
+    def temperature(self, frequency, az, el, rx):
+        """Return the system temperature in K at each FFT bin, in numpy.fft order, excluding RFI."""
+        if not rx:
+            return np.full(self.num_channels, LOAD_TEMPERATURE + RECEIVER_TEMPERATURE, dtype=float)
+        freqs = frequency + np.fft.fftfreq(self.num_channels, 1/self.samp_rate)
+        vels = SPEED_OF_LIGHT * (1 - freqs / galcoord.HYDROGEN_FREQ.to_value('Hz'))
+        l, b = galcoord.fast_altaz_to_gal(az, el)
+        ground = GROUND_TEMPERATURE * np.exp(-max(el, 0) / GROUND_SCALE_HEIGHT)
+        return RECEIVER_TEMPERATURE + ground + BEAM_EFFICIENCY * hi_brightness(l, b, vels)
+
+    def _amplitudes(self):
+        """Return the noise amplitude at each FFT bin for the current pointing and tuning."""
+        client = self.telescope.client
+        key = (self.telescope.get_sdr_frequency(), client.status['Sequencer']['Bands'][0]['CommandRX'])
+        az, el = client.azimuth_position, client.elevation_position
+        if self._key != key or max(abs((az - self._az + 180) % 360 - 180), abs(el - self._el)) > SKY_UPDATE_DISTANCE:
+            self._key, self._az, self._el = key, az, el
+            t = self.temperature(key[0], az, el, key[1])
+            # The windowed FFT of noise with bin power P has power P*window_power in each bin.
+            self._noise = np.sqrt(BOLTZMANN * t * self.samp_rate / spectrometer.REFERENCE_CHANNELS / self.window_power)
+        return self._noise
+
+    def _tone(self, offset, length):
+        """Return a unit tone at offset Hz, starting at phase 0."""
+        key = (offset, length)
+        if key not in self._tones:
+            self._tones[key] = np.exp(2j*np.pi*offset*np.arange(length)/self.samp_rate)
+        return self._tones[key]
+
+    def samples(self, chunks):
+        """Return the next chunks*num_channels samples."""
+        n = self.num_channels
+        noise = self._amplitudes()
+        spectra = self.rng.standard_normal((chunks, n, 2), dtype=np.float32).view(np.complex64)[..., 0]
+        spectra *= noise / np.sqrt(2)
+        out = np.fft.ifft(spectra, axis=1) * np.sqrt(n)
+        out = out.ravel()
+        tuning, rx = self._key
+        if rx:
+            start = self.produced / self.samp_rate
+            for frequency, temperature, duty, period in self.rfi:
+                offset = frequency - tuning
+                if abs(offset) >= self.samp_rate/2 or (start % period) >= duty*period:
+                    continue
+                amplitude = np.sqrt(BOLTZMANN * temperature * self.samp_rate / spectrometer.REFERENCE_CHANNELS) / self.window_gain
+                out += amplitude * np.exp(2j*np.pi*offset*start) * self._tone(offset, chunks*n)
+        self.produced += chunks*n
+        return out.astype(np.complex64)
+
+class sky_source(gr.sync_block):
+    """GNU Radio source of a SkyModel's samples."""
+    def __init__(self, model, max_chunks=64):
+        gr.sync_block.__init__(self, name='Sky Source', in_sig=None, out_sig=[np.complex64])
+        self.model = model
+        self.max_chunks = max_chunks
+        self.set_output_multiple(model.num_channels)
+
+    def work(self, input_items, output_items):
+        out = output_items[0]
+        n = self.model.num_channels
+        chunks = min(len(out) // n, self.max_chunks)
+        out[:chunks*n] = self.model.samples(chunks)
+        return chunks*n
+
+class SimulatedFlowgraph(gr.top_block):
+    """flowgraph.grc's integration chain fed by a SkyModel instead of the LimeSDR.
+
+    The model produces the IF directly, so the SDR and the channel
+    filter are left out; samples are throttled to speedup times the
+    IF sample rate. The variables that the survey reads have the same
+    names and values as in flowgraph.grc.
+    """
+    def __init__(self, bandwidth=2e6, integration_time=1, sdr_frequency=1420.406e6, sdr_gain=45, num_channels=512, spectrometer_method='fft', window_name='blackmanharris', file_sink_path=None, speedup=1, rfi=RFI, seed=None):
+        gr.top_block.__init__(self, "Simulated Flowgraph")
+        self.bandwidth = bandwidth
+        self.integration_time = integration_time
+        self.sdr_frequency = sdr_frequency
+        self.sdr_gain = sdr_gain
+        self.rate_plan = rateplan.plan(bandwidth)
+        self.samp_rate = self.rate_plan.samp_rate
+        self.num_channels = num_channels
+        self.spectrometer_method = spectrometer_method
+        self.window_name = window_name
+        self.if_filter_decimation_rate = self.rate_plan.decimation
+        self.if_samp_rate = self.output_vector_bandwidth = self.rate_plan.if_samp_rate
+        self.integration_dec_rate = spectrometer.integration_dec_rate(integration_time, self.if_samp_rate, self.num_channels)
+
+        self.sky_source = sky_source(SkyModel(self, self.num_channels, self.if_samp_rate, rfi=rfi, seed=seed))
+        self.blocks_throttle_0 = blocks.throttle(gr.sizeof_gr_complex*1, self.if_samp_rate*speedup, True)
+        self.spectrometer = spectrometer.spectrometer(self.num_channels, self.integration_dec_rate, self.if_samp_rate, window_name, method=spectrometer_method)
+        self.integration_block = flowgraph_integration_block.blk(num_channels=self.num_channels)
+        self.connect(self.sky_source, self.blocks_throttle_0, self.spectrometer, self.integration_block)
+
+    def spectrometer_chain(self):
+        return [self.blocks_throttle_0, self.spectrometer]
+
+    def get_bandwidth(self):
+        return self.bandwidth
+
+    def set_bandwidth(self, bandwidth):
+        # The sky model and throttle run at the plan's IF sample rate, as the LimeSDR does in flowgraph.grc.
+        if bandwidth != self.bandwidth:
+            raise ValueError("the simulated flowgraph can't change bandwidth")
+
+    def get_integration_time(self):
+        return self.integration_time
+
+    def get_sdr_frequency(self):
+        return self.sdr_frequency
+
+    def set_sdr_frequency(self, sdr_frequency):
+        self.sdr_frequency = sdr_frequency
+
+    def get_sdr_gain(self):
+        return self.sdr_gain
+
+    def set_sdr_gain(self, sdr_gain):
+        self.sdr_gain = sdr_gain
+
+    def get_samp_rate(self):
+        return self.samp_rate
+
+    def get_num_channels(self):
+        return self.num_channels
+
+    def get_if_samp_rate(self):
+        return self.if_samp_rate
+
+    def get_output_vector_bandwidth(self):
+        return self.output_vector_bandwidth
+
+    def get_integration_dec_rate(self):
+        return self.integration_dec_rate
+
+class SimulatedTelescope(Telescope, SimulatedFlowgraph):
+    """A Telescope that observes the SkyModel through a SimulatedClient.
+
+    products are spectrometer.Products computed from the model's IF.
+    The simulated SDR has a single channel.
+    """
+    def __init__(self, products=(), channel_mode=0, **kwargs):
+        if channel_mode:
+            raise ValueError('the simulator only simulates one SDR channel')
+        super(SimulatedTelescope, self).__init__(**kwargs)
+        for product in products:
+            self.add_product(
+                spectrometer.product_branch(product, self.if_samp_rate, self.spectrometer_method),
+                self.blocks_throttle_0)
+
+def _percentile(values, q):
+    return np.percentile(values, q) if len(values) else float('nan')
+
+def report(output_dir, elapsed, speedup, achieved, estimate):
+    """Print the duty cycle and stage latencies of a finished survey in output_dir.
+
+    achieved is how many times faster than real time the samples were
+    actually produced; below speedup, the simulation was CPU-bound and
+    the integrations took longer than the dish's motion implies.
+    """
+    print('Survey took %.0f sec (estimated %.0f sec at real time, %.0f sec at %.1fx).' % (elapsed, estimate, estimate/speedup, speedup))
+    print('Sky model ran at %.1fx real time (asked for %.1fx).' % (achieved, speedup))
+    if achieved < 0.9*speedup:
+        print('The simulation was CPU-bound; lower --speedup for realistic duty cycles.')
+    path = os.path.join(output_dir, survey_autoranging.TIMINGS_FILE)
+    if not os.path.exists(path):
+        print('No per-observation timings for this mode.')
+        return
+    with open(path) as file:
+        rows = list(csv.DictReader(file))
+    timings = {field: np.array([float(row[field]) for row in rows]) for field in survey_autoranging.TIMINGS_FIELDS}
+    integrated = timings['integrate'].sum()
+    print('%d observations; duty cycle %.1f%% (%.0f of %.0f sec integrating).' % (len(rows), 100*integrated/elapsed, integrated, elapsed))
+    print('%-10s %10s %10s %10s' % ('stage', 'median', '95%', 'max'))
+    for field in survey_autoranging.TIMINGS_FIELDS[2:]:
+        values = timings[field]
+        print('%-10s %9.2fs %9.2fs %9.2fs' % (field, _percentile(values, 50), _percentile(values, 95), values.max() if len(values) else float('nan')))
+    print('Stage times are wall-clock seconds.')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a gal_scan survey against a simulated dish and SDR',
+        epilog='Other arguments are passed to run.py.')
+    parser.add_argument('--speedup', type=float, default=10, help='how many times faster than real time the dish and SDR run')
+    parser.add_argument('--dish-az-rate', type=float, default=schedule.AZ_SLEW_RATE, metavar='°/s', help='simulated azimuth slew rate')
+    parser.add_argument('--dish-el-rate', type=float, default=schedule.EL_SLEW_RATE, metavar='°/s', help='simulated elevation slew rate')
+    parser.add_argument('--settle-time', type=float, default=schedule.SETTLE_TIME, metavar='seconds', help='simulated settling time after each slew')
+    parser.add_argument('--no-rfi', action='store_true', help="don't inject RFI")
+    parser.add_argument('--seed', type=int, help='random seed for the simulated noise')
+    sim_args, rest = parser.parse_known_args()
+
+    logging.basicConfig(
+        format="%(asctime)-15s %(levelname)-8s [%(name)s] [%(module)s:%(funcName)s] %(message)s",
+        level=logging.INFO,
+    )
+    args = run.parse_args(rest)
+
+    client = SimulatedClient(sim_args.dish_az_rate, sim_args.dish_el_rate, sim_args.settle_time, sim_args.speedup)
+    tb = SimulatedTelescope(
+        client=client,
+        speedup=sim_args.speedup,
+        rfi=() if sim_args.no_rfi else RFI,
+        seed=sim_args.seed,
+        **run.top_block_kwargs(args)
+    )
+    tb.start()
+    survey = Survey(args)
+    estimate = survey.time_remaining.sec
+    start = time.monotonic()
+    try:
+        survey.run(tb)
+    finally:
+        tb.stop()
+        tb.wait()
+        client.close()
+    elapsed = time.monotonic() - start
+    achieved = tb.sky_source.model.produced / tb.get_if_samp_rate() / elapsed
+    report(args.output_dir, elapsed, sim_args.speedup, achieved, estimate)
+
+if __name__ == '__main__':
+    main()
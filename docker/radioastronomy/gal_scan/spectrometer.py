@@ -0,0 +1,240 @@
+"""The receive chain from flowgraph.grc as hierarchical blocks.
+
+flowgraph.grc decimates the SDR's samples to the IF in the stages of
+its rateplan.RatePlan, then turns the IF into integrated power spectra
+with stream_to_vector -> fft_vxx -> complex_to_mag_squared ->
+integrate_xx -> multiply_const_vxx before they reach the integration
+block. channel_filter and spectrometer build the same chain in Python
+for flowgraphs that are not generated from flowgraph.grc, so that
+their vectors match the ones run.py records.
+
+spectrometer can also replace the non-overlapping FFT frames with one
+of two front ends that waste less of the signal. 'welch' adds a second
+set of frames offset by half a frame, so that samples the window
+suppresses at the edges of one frame are in the middle of another.
+'pfb' is a polyphase filterbank (pfb.channelizer_ccf): every sample is
+weighted by a filter PFB_TAPS_PER_CHANNEL frames long, and each channel
+is about one channel wide instead of the two of a Blackman-Harris FFT.
+`benchmark.py spectrometers` compares their CPU use and sensitivity.
+
+product_branch computes a Product, another spectrum of part of the IF
+with its own bandwidth, channels and sub-integration time, alongside
+the main one. channel_branch runs the whole receive chain on another
+SDR channel, and looks like a product with the main spectrum's
+settings.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from collections import namedtuple
+import re
+import numpy as np
+from gnuradio import blocks, fft, filter, gr
+from gnuradio.fft import window
+from gnuradio.filter import pfb
+import rateplan
+
+# fft.window functions that spectrometer accepts.
+WINDOWS = ('blackmanharris', 'blackman', 'hamming', 'hanning', 'flattop', 'rectangular')
+# Front ends that spectrometer accepts; 'fft' is flowgraph.grc's.
+METHODS = ('fft', 'welch', 'pfb')
+# Length of the polyphase filterbank's prototype filter, in frames.
+PFB_TAPS_PER_CHANNEL = 8
+# flowgraph.grc's calibration assumes its 512-channel Blackman-Harris window.
+REFERENCE_CHANNELS = 512
+REFERENCE_WINDOW_POWER = np.sum(np.square(window.blackmanharris(REFERENCE_CHANNELS)))
+
+# Constants that flowgraph.grc uses to calibrate the LimeSDR's samples.
+RF_PATH_GAIN_CORRECTION_LINEAR = 211.67
+SDR_POWER_OFFSET = np.sqrt(50)
+
+def gain_correction(sdr_gain):
+    """Return flowgraph.grc's scale from LimeSDR samples at sdr_gain dB to calibrated volts."""
+    return 1/(RF_PATH_GAIN_CORRECTION_LINEAR*10**(sdr_gain/20)*SDR_POWER_OFFSET)
+
+# A spectrum computed alongside the main one: a name for its columns,
+# its center in Hz from the SDR frequency, its bandwidth in Hz, its
+# number of channels and its sub-integration time in seconds.
+Product = namedtuple('Product', ['name', 'offset', 'bandwidth', 'num_channels', 'integration_time'])
+
+def parse_product(text):
+    """Return the Product described by NAME:OFFSET:BANDWIDTH:CHANNELS[:SUB_INT_TIME]."""
+    fields = text.split(':')
+    if len(fields) not in (4, 5) or not re.match(r'[A-Za-z]\w*$', fields[0]):
+        raise ValueError('spectral product %r is not NAME:OFFSET:BANDWIDTH:CHANNELS[:SUB_INT_TIME]' % (text,))
+    return Product(fields[0], float(fields[1]), float(fields[2]), int(fields[3]), float(fields[4]) if len(fields) == 5 else 1.0)
+
+def window_correction(taps, num_channels):
+    """Return the scale that puts num_channels-channel spectra taken through taps in flowgraph.grc's units.
+
+    White noise gives num_channels*sum(taps**2) times its power per Hz,
+    for FFT windows and polyphase prototype filters alike.
+    """
+    return REFERENCE_CHANNELS*REFERENCE_WINDOW_POWER/(num_channels*np.sum(np.square(taps)))
+
+def noise_bandwidth(taps, num_channels):
+    """Return the equivalent noise bandwidth of each channel, in channels."""
+    return num_channels*np.sum(np.square(taps))/np.square(np.sum(taps))
+
+def pfb_taps(num_channels, window_name='blackmanharris'):
+    """Return the prototype filter of a num_channels polyphase filterbank: a windowed sinc one channel wide."""
+    n = np.arange(PFB_TAPS_PER_CHANNEL*num_channels) - (PFB_TAPS_PER_CHANNEL*num_channels - 1)/2
+    return (np.sinc(n/num_channels)*getattr(window, window_name)(len(n))).tolist()
+
+def integration_dec_rate(integration_time, if_samp_rate, num_channels):
+    """Return flowgraph.grc's number of FFTs summed into each sub-integration."""
+    return int(integration_time*if_samp_rate/num_channels)
+
+class channel_filter(gr.hier_block2):
+    """flowgraph.grc's decimation from the SDR to the IF, for a rateplan.RatePlan.
+
+    The first stage also shifts offset_frequency to the center of the IF.
+    """
+    def __init__(self, rate_plan, offset_frequency):
+        gr.hier_block2.__init__(
+            self, 'channel_filter',
+            gr.io_signature(1, 1, gr.sizeof_gr_complex),
+            gr.io_signature(1, 1, gr.sizeof_gr_complex))
+        self.rate_plan = rate_plan
+        self.freq_xlating_fft_filter_ccc_0 = filter.freq_xlating_fft_filter_ccc(
+            rate_plan.stages[0].decimation, rate_plan.taps(0), offset_frequency, rate_plan.samp_rate)
+        self.freq_xlating_fft_filter_ccc_0.set_nthreads(rate_plan.filter_threads)
+        self.fft_filter_xxx_0 = filter.fft_filter_ccc(rate_plan.stages[1].decimation, rate_plan.taps(1), 1)
+        self.connect(self, self.freq_xlating_fft_filter_ccc_0, self.fft_filter_xxx_0, self)
+
+class spectrometer(gr.hier_block2):
+    """Integrated power spectra of a complex IF stream.
+
+    Each output vector sums integration_dec_rate spectra of
+    num_channels channels and scales them to power per Hz of the
+    if_samp_rate/num_channels wide channels, like flowgraph.grc.
+    method is one of METHODS and window_name one of WINDOWS; for 'pfb'
+    the window shapes the prototype filter. The scale is corrected for
+    the window's power relative to flowgraph.grc's, so that spectra
+    with other front ends, windows or channel counts stay in the same
+    units. noise_bandwidth is the width of each channel in channels.
+    """
+    def __init__(self, num_channels=512, integration_dec_rate=4296, if_samp_rate=2.2e6, window_name='blackmanharris', fft_threads=1, method='fft'):
+        gr.hier_block2.__init__(
+            self, 'spectrometer',
+            gr.io_signature(1, 1, gr.sizeof_gr_complex),
+            gr.io_signature(1, 1, gr.sizeof_float*num_channels))
+        if window_name not in WINDOWS:
+            raise ValueError('unknown window %r' % (window_name,))
+        if method not in METHODS:
+            raise ValueError('unknown spectrometer %r' % (method,))
+        self.method = method
+        self.num_channels = num_channels
+        self.integration_dec_rate = integration_dec_rate
+        if method == 'pfb':
+            taps = pfb_taps(num_channels, window_name)
+        else:
+            taps = getattr(window, window_name)(num_channels)
+        self.noise_bandwidth = noise_bandwidth(taps, num_channels)
+        # Welch's method sums two FFTs per frame.
+        spectra = integration_dec_rate*(2 if method == 'welch' else 1)
+        integration_bandwidth = if_samp_rate/num_channels
+        self.integration_scale_factor = np.full((num_channels), float(window_correction(taps, num_channels)/(spectra*integration_bandwidth)), dtype=float)
+
+        self.blocks_complex_to_mag_squared_0 = blocks.complex_to_mag_squared(num_channels)
+        self.blocks_integrate_xx_0_0 = blocks.integrate_ff(integration_dec_rate, num_channels)
+        self.blocks_multiply_const_vxx_0 = blocks.multiply_const_vff(self.integration_scale_factor)
+        self.connect(self.blocks_integrate_xx_0_0, self.blocks_multiply_const_vxx_0, self)
+
+        if method == 'pfb':
+            self.pfb_channelizer_ccf_0 = pfb.channelizer_ccf(num_channels, taps, 1.0, 0)
+            # Channel 0 is DC; put the most negative frequency first, like fft_vxx's shift.
+            self.pfb_channelizer_ccf_0.set_channel_map([(i + num_channels//2) % num_channels for i in range(num_channels)])
+            self.blocks_streams_to_vector_0 = blocks.streams_to_vector(gr.sizeof_gr_complex*1, num_channels)
+            self.connect(self, self.pfb_channelizer_ccf_0)
+            for i in range(num_channels):
+                self.connect((self.pfb_channelizer_ccf_0, i), (self.blocks_streams_to_vector_0, i))
+            self.connect(self.blocks_streams_to_vector_0, self.blocks_complex_to_mag_squared_0, self.blocks_integrate_xx_0_0)
+            return
+
+        self.blocks_stream_to_vector_0 = blocks.stream_to_vector(gr.sizeof_gr_complex*1, num_channels)
+        self.fft_vxx_0 = fft.fft_vcc(num_channels, True, taps, True, fft_threads)
+        self.connect(self, self.blocks_stream_to_vector_0, self.fft_vxx_0, self.blocks_complex_to_mag_squared_0)
+        if method == 'fft':
+            self.connect(self.blocks_complex_to_mag_squared_0, self.blocks_integrate_xx_0_0)
+            return
+
+        # The same frames half a frame later, summed with the first before integration.
+        self.blocks_delay_0 = blocks.delay(gr.sizeof_gr_complex*1, num_channels//2)
+        self.blocks_stream_to_vector_1 = blocks.stream_to_vector(gr.sizeof_gr_complex*1, num_channels)
+        self.fft_vxx_1 = fft.fft_vcc(num_channels, True, taps, True, fft_threads)
+        self.blocks_complex_to_mag_squared_1 = blocks.complex_to_mag_squared(num_channels)
+        self.blocks_add_xx_0 = blocks.add_ff(num_channels)
+        self.connect(self, self.blocks_delay_0, self.blocks_stream_to_vector_1, self.fft_vxx_1, self.blocks_complex_to_mag_squared_1)
+        self.connect(self.blocks_complex_to_mag_squared_0, (self.blocks_add_xx_0, 0))
+        self.connect(self.blocks_complex_to_mag_squared_1, (self.blocks_add_xx_0, 1))
+        self.connect(self.blocks_add_xx_0, self.blocks_integrate_xx_0_0)
+
+class product_branch(gr.hier_block2):
+    """A Product's integrated spectra from a calibrated IF sampled at if_samp_rate.
+
+    The product's band is shifted to the center and decimated in the
+    stages that rateplan.plan gives for it, then fed to a spectrometer
+    using method. Raises ValueError if the band doesn't fit in the IF.
+    """
+    def __init__(self, product, if_samp_rate, method='fft'):
+        gr.hier_block2.__init__(
+            self, 'product_branch',
+            gr.io_signature(1, 1, gr.sizeof_gr_complex),
+            gr.io_signature(1, 1, gr.sizeof_float*product.num_channels))
+        self.product = product
+        self.rate_plan = rateplan.plan(product.bandwidth, if_samp_rate)
+        self.if_samp_rate = self.rate_plan.if_samp_rate
+        if abs(product.offset) + self.if_samp_rate/2 > if_samp_rate/2:
+            raise ValueError('spectral product %s extends beyond the %g Hz IF' % (product.name, if_samp_rate))
+        self.integration_dec_rate = integration_dec_rate(product.integration_time, self.if_samp_rate, product.num_channels)
+        if self.integration_dec_rate < 1:
+            raise ValueError('spectral product %s has sub-integrations shorter than one spectrum' % (product.name,))
+        self.channel_filter = channel_filter(self.rate_plan, product.offset)
+        self.spectrometer = spectrometer(
+            product.num_channels, self.integration_dec_rate, self.if_samp_rate,
+            fft_threads=self.rate_plan.fft_threads, method=method)
+        self.connect(self, self.channel_filter, self.spectrometer, self)
+
+    def sub_integration_time(self):
+        return self.integration_dec_rate * self.product.num_channels / self.if_samp_rate
+
+    def freqs(self, sdr_frequency):
+        """Return the frequency in Hz of each channel when the SDR is tuned to sdr_frequency."""
+        center = sdr_frequency + self.product.offset
+        return np.linspace(center - self.if_samp_rate/2, center + self.if_samp_rate/2, self.product.num_channels)
+
+class channel_branch(gr.hier_block2):
+    """flowgraph.grc's receive chain for another channel of the SDR, as a Product called name.
+
+    The SDR's samples are decimated as in rate_plan, shifted by
+    offset_frequency and scaled by gain_correction_lin, then fed to a
+    spectrometer with the main spectrum's settings.
+    """
+    def __init__(self, name, rate_plan, offset_frequency, gain_correction_lin, num_channels=512, integration_dec_rate=4296, method='fft', window_name='blackmanharris'):
+        gr.hier_block2.__init__(
+            self, 'channel_branch',
+            gr.io_signature(1, 1, gr.sizeof_gr_complex),
+            gr.io_signature(1, 1, gr.sizeof_float*num_channels))
+        self.rate_plan = rate_plan
+        self.if_samp_rate = rate_plan.if_samp_rate
+        self.integration_dec_rate = integration_dec_rate
+        self.product = Product(name, 0, rate_plan.bandwidth, num_channels, integration_dec_rate*num_channels/self.if_samp_rate)
+        self.channel_filter = channel_filter(rate_plan, offset_frequency)
+        self.blocks_multiply_const_xx_0 = blocks.multiply_const_cc(gain_correction_lin)
+        self.spectrometer = spectrometer(
+            num_channels, integration_dec_rate, self.if_samp_rate, window_name,
+            fft_threads=rate_plan.fft_threads, method=method)
+        self.connect(self, self.channel_filter, self.blocks_multiply_const_xx_0, self.spectrometer, self)
+
+    def set_gain_correction_lin(self, gain_correction_lin):
+        self.blocks_multiply_const_xx_0.set_k(gain_correction_lin)
+
+    def sub_integration_time(self):
+        return self.integration_dec_rate * self.product.num_channels / self.if_samp_rate
+
+    def freqs(self, sdr_frequency):
+        """Return the frequency in Hz of each channel when the SDR is tuned to sdr_frequency."""
+        return np.linspace(sdr_frequency - self.if_samp_rate/2, sdr_frequency + self.if_samp_rate/2, self.product.num_channels)
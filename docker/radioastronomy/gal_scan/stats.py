@@ -0,0 +1,76 @@
+"""Statistics of spectra that don't need the plotting stack.
+
+RunningSpectrum keeps the per-channel mean and variance that adaptive
+integration checks while observing; plot uses the same line-free
+channels to fit the background.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import numpy as np
+from numpy.polynomial.polynomial import polyfit, polyval
+
+# Hand-tuned points that fall outside the region of interest.
+# These indices are used to estimate background noise level.
+CORRECTION_POLY_POINTS = np.array([75, 100, 125, 150, 175])
+# dsheen had 200, 225, 250 but those are within real data
+
+def line_free_channels(num_channels):
+    """Return CORRECTION_POLY_POINTS scaled to a spectrum of num_channels channels."""
+    return CORRECTION_POLY_POINTS * num_channels // 512
+
+class RunningSpectrum(object):
+    """Per-channel running mean and variance of a stream of spectra.
+
+    Batches of spectra are merged with Chan et al.'s pairwise update,
+    so the statistics can be kept up to date while integrating without
+    holding on to the spectra.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, vectors):
+        """Add a (count, channels) array of spectra."""
+        n = len(vectors)
+        if not n:
+            return
+        vectors = np.asarray(vectors, dtype=np.float64)
+        mean = vectors.mean(axis=0)
+        m2 = ((vectors - mean)**2).sum(axis=0)
+        if not self.count:
+            self.count, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * (n / total)
+        self.m2 += m2 + delta**2 * (self.count * n / total)
+        self.count = total
+
+    @property
+    def variance(self):
+        """Per-channel sample variance of the spectra."""
+        return self.m2 / (self.count - 1)
+
+    def _standard_error(self, points):
+        return np.mean(np.sqrt(self.variance[points] / self.count))
+
+    def noise(self):
+        """Return the fractional standard error of the mean spectrum in the line-free channels."""
+        points = line_free_channels(len(self.mean))
+        return self._standard_error(points) / np.mean(self.mean[points])
+
+    def snr(self):
+        """Return the line's signal-to-noise ratio in the mean spectrum.
+
+        Like normalize_data, the background is a first-order fit to
+        the line-free channels; the signal is the peak above it and the
+        noise is the standard error of the mean in those channels.
+        """
+        points = line_free_channels(len(self.mean))
+        coefficients = polyfit(points, self.mean[points], 1)
+        signal = self.mean - polyval(np.arange(len(self.mean)), coefficients)
+        return np.max(signal) / self._standard_error(points)
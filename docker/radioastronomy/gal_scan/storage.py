@@ -0,0 +1,357 @@
+"""Append-only on-disk storage for survey observations.
+
+An ObservationStore is a directory holding one preallocated .npy file
+per column of the observation table (so the spectra are a single
+(rows, channels) array), opened as memory maps. Each appended row is
+written straight into the maps, so a crash loses at most the
+observation in progress instead of the whole survey. store.json
+records the columns, their units, and how many rows are complete; it
+is replaced atomically after each append, so it never counts a
+partially written row.
+
+Rows may leave out columns, or add new ones, like the lists of dicts
+QTable accepts; the missing values are masked, or NaN in Quantity
+columns, which QTable can't mask before astropy 5.
+
+VectorWriter streams the per-observation log, vectors.bin: one JSON
+header line followed by fixed-size little-endian records of each
+observation's position, velocities and spectrum. vectors_to_csv turns
+it into the legacy vectors.csv; run "python3 storage.py csv DIRECTORY".
+"""
+
+import argparse
+import csv
+import json
+import os
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle, Latitude, Longitude
+from astropy.table import MaskedColumn, QTable
+
+# Directory of the store inside a survey's output directory.
+STORE_DIR = 'store'
+METADATA_FILE = 'store.json'
+# Rows to preallocate when the caller doesn't know how many it needs.
+DEFAULT_CAPACITY = 1024
+# Shortest string column, in characters.
+MIN_STRING_LENGTH = 32
+
+# Quantity subclasses that are kept when rows are read back.
+QUANTITY_CLASSES = {cls.__name__: cls for cls in (u.Quantity, Angle, Latitude, Longitude)}
+
+class ObservationStore(object):
+    """Columns of observations, appended one row at a time.
+
+    Rows are dicts like the ones that make up the table saved by
+    plot.save_data: Quantities (scalar or 1D), numbers, bools and
+    strings.
+    """
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        self._columns = {
+            name: np.load(self._column_path(name), mmap_mode='r+')
+            for name in metadata['columns']
+        }
+        # True where a row has no value for the column.
+        self._masks = {
+            name: np.load(self._column_path(name + '.mask'), mmap_mode='r+')
+            for name, spec in metadata['columns'].items() if spec['masked']
+        }
+
+    @classmethod
+    def create(cls, path, capacity=DEFAULT_CAPACITY, meta=None):
+        """Create an empty store at path, replacing any existing one.
+
+        Args:
+            capacity: rows to preallocate; the store grows as needed
+            meta: JSON-serializable dict saved with the store
+        """
+        os.makedirs(path, exist_ok=True)
+        store = cls(path, {'count': 0, 'capacity': max(1, capacity), 'columns': {}, 'meta': meta or {}})
+        store._save_metadata()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        """Open an existing store."""
+        with open(os.path.join(path, METADATA_FILE)) as file:
+            return cls(path, json.load(file))
+
+    @property
+    def meta(self):
+        return self.metadata['meta']
+
+    def __len__(self):
+        return self.metadata['count']
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _save_metadata(self):
+        tmp = os.path.join(self.path, METADATA_FILE + '.tmp')
+        with open(tmp, 'w') as file:
+            json.dump(self.metadata, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, os.path.join(self.path, METADATA_FILE))
+
+    def _open_memmap(self, name, dtype, shape):
+        return np.lib.format.open_memmap(
+            self._column_path(name), mode='w+', dtype=dtype,
+            shape=(self.metadata['capacity'],) + tuple(shape))
+
+    def _add_mask(self, name, missing):
+        """Start masking column name; missing says whether rows so far lack it."""
+        self.metadata['columns'][name]['masked'] = True
+        mask = self._masks[name] = self._open_memmap(name + '.mask', bool, ())
+        mask[:len(self)] = missing
+
+    def _add_column(self, name, value):
+        columns = self.metadata['columns']
+        spec = {'unit': None, 'class': None, 'masked': False}
+        if isinstance(value, u.Quantity):
+            spec['unit'] = value.unit.to_string()
+            spec['class'] = type(value).__name__ if type(value).__name__ in QUANTITY_CLASSES else 'Quantity'
+            value = value.value
+        value = np.asarray(value)
+        dtype = value.dtype
+        if dtype.kind == 'U':
+            dtype = np.dtype('U%d' % max(MIN_STRING_LENGTH, dtype.itemsize // 4))
+        spec.update(dtype=dtype.str, shape=list(value.shape))
+        columns[name] = spec
+        self._columns[name] = self._open_memmap(name, dtype, value.shape)
+        if len(self):
+            self._add_mask(name, True)
+
+    def _grow(self):
+        """Double the capacity of every column."""
+        capacity = self.metadata['capacity'] * 2
+        files = list(self._columns.items()) + [(name + '.mask', mask) for name, mask in self._masks.items()]
+        self._columns, self._masks = {}, {}
+        for name, column in files:
+            tmp = self._column_path(name + '.tmp')
+            grown = np.lib.format.open_memmap(tmp, mode='w+', dtype=column.dtype, shape=(capacity,) + column.shape[1:])
+            grown[:len(self)] = column[:len(self)]
+            grown.flush()
+            del grown, column
+            os.replace(tmp, self._column_path(name))
+            if name.endswith('.mask'):
+                self._masks[name[:-len('.mask')]] = np.load(self._column_path(name), mmap_mode='r+')
+            else:
+                self._columns[name] = np.load(self._column_path(name), mmap_mode='r+')
+        self.metadata['capacity'] = capacity
+
+    def append(self, row):
+        """Write row to disk.
+
+        Raises ValueError, without writing anything, if a string is
+        longer than its column.
+        """
+        for name, value in row.items():
+            column = self._columns.get(name)
+            if column is not None and column.dtype.kind == 'U' and len(str(value)) > column.dtype.itemsize // 4:
+                raise ValueError('%r is longer than the %d characters of column %s' % (value, column.dtype.itemsize // 4, name))
+        if len(self) == self.metadata['capacity']:
+            self._grow()
+        index = len(self)
+        for name, value in row.items():
+            if name not in self._columns:
+                self._add_column(name, value)
+            unit = self.metadata['columns'][name]['unit']
+            if unit is not None:
+                value = u.Quantity(value).to_value(unit)
+            self._columns[name][index] = value
+        for name in self._columns:
+            if name not in row and name not in self._masks:
+                self._add_mask(name, False)
+            if name in self._masks:
+                self._masks[name][index] = name not in row
+        for column in list(self._columns.values()) + list(self._masks.values()):
+            column.flush()
+        self.metadata['count'] = index + 1
+        self._save_metadata()
+
+    def truncate(self, count):
+        """Forget every row after the first count."""
+        self.metadata['count'] = min(count, len(self))
+        self._save_metadata()
+
+    def _wrap(self, name, value):
+        spec = self.metadata['columns'][name]
+        if spec['unit'] is None:
+            return value
+        return QUANTITY_CLASSES[spec['class']](value, spec['unit'])
+
+    def row(self, index):
+        """Return row index as a dict, leaving out masked values."""
+        index = range(len(self))[index]
+        return {
+            name: self._wrap(name, column[index])
+            for name, column in self._columns.items()
+            if name not in self._masks or not self._masks[name][index]
+        }
+
+    def table(self):
+        """Return every row as a QTable."""
+        table = QTable()
+        for name, column in self._columns.items():
+            value = np.array(column[:len(self)])
+            if name in self._masks:
+                mask = np.array(self._masks[name][:len(self)])
+                mask = np.broadcast_to(mask.reshape(mask.shape + (1,)*(value.ndim-1)), value.shape)
+                if self.metadata['columns'][name]['unit'] is not None:
+                    value = value.astype(np.float64)
+                    value[mask] = np.nan
+                else:
+                    value = MaskedColumn(value, mask=mask)
+            table[name] = self._wrap(name, value)
+        return table
+
+VECTORS_FILE = 'vectors.bin'
+VECTORS_FORMAT = 'gal_scan vectors'
+VECTORS_VERSION = 1
+# Records start at a multiple of this many bytes.
+VECTORS_ALIGNMENT = 64
+POSITION_FIELDS = ('time', 'azimuth', 'elevation', 'longitude', 'latitude', 'ra', 'dec', 'rci_azimuth', 'rci_elevation')
+# Units of the vectors.bin fields.
+VECTORS_UNITS = dict(
+    {field: 'deg' for field in POSITION_FIELDS},
+    time='s', vels='km / s', data='mW / Hz')
+# Classes used to format positions in the legacy CSV.
+LEGACY_CLASSES = {
+    'azimuth': Longitude,
+    'elevation': Latitude,
+    'longitude': Longitude,
+    'latitude': Latitude,
+    'ra': Longitude,
+    'dec': Latitude,
+}
+
+def vectors_dtype(channels):
+    """Return the dtype of a vectors.bin record."""
+    return np.dtype(
+        [('number', '<i4'), ('darksky', 'u1')]
+        + [(field, '<f8') for field in POSITION_FIELDS]
+        + [('vels', '<f4', (channels,)), ('data', '<f4', (channels,))])
+
+def _read_vectors_header(file):
+    header = json.loads(file.readline())
+    if header.get('format') != VECTORS_FORMAT or header.get('version') != VECTORS_VERSION:
+        raise ValueError('%s is not a version %d vectors file' % (file.name, VECTORS_VERSION))
+    return header, file.tell()
+
+class VectorWriter(object):
+    """Append observations to vectors.bin as they are made.
+
+    Records hold number, darksky (0 or 1), POSITION_FIELDS as float64,
+    then vels and data as float32 arrays of one value per channel, in
+    VECTORS_UNITS. vels is NaN when it wasn't calculated. The header
+    records the dtype, units, channel frequencies and integration time.
+    """
+    def __init__(self, path, center_frequency, freqs, int_time, keep=None):
+        """
+        Args:
+            center_frequency: Quantity tuned frequency
+            freqs: Quantity array of channel frequencies
+            int_time: seconds of integration per observation
+            keep: append to an existing file after its first keep records,
+                instead of replacing it
+        """
+        self.path = path
+        self.dtype = vectors_dtype(len(freqs))
+        if keep is not None and os.path.exists(path):
+            with open(path, 'rb') as file:
+                _, offset = _read_vectors_header(file)
+            # Also drops a record that was cut short.
+            with open(path, 'r+b') as file:
+                file.truncate(min(os.path.getsize(path), offset + keep*self.dtype.itemsize))
+            self.file = open(path, 'ab')
+            return
+        header = json.dumps({
+            'format': VECTORS_FORMAT,
+            'version': VECTORS_VERSION,
+            'dtype': self.dtype.descr,
+            'units': VECTORS_UNITS,
+            'freqs': freqs.to_value(u.Hz).tolist(),
+            'center_frequency': center_frequency.to_value(u.Hz),
+            'int_time': int_time,
+        })
+        # Pad so records are aligned when the file is memory mapped.
+        length = -(-(len(header) + 1) // VECTORS_ALIGNMENT) * VECTORS_ALIGNMENT
+        self.file = open(path, 'wb')
+        self.file.write((header.ljust(length - 1) + '\n').encode('ascii'))
+        self.file.flush()
+
+    def write(self, row):
+        """Append the observation in row, a dict like an ObservationStore row."""
+        record = np.zeros((), self.dtype)
+        record['number'] = row['number']
+        record['darksky'] = row.get('darksky', False)
+        for field in POSITION_FIELDS:
+            record[field] = u.Quantity(row[field]).to_value(VECTORS_UNITS[field])
+        record['vels'] = row['vels'].to_value(VECTORS_UNITS['vels']) if 'vels' in row else np.nan
+        record['data'] = row['data'].to_value(VECTORS_UNITS['data'])
+        self.file.write(record.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_vectors(path):
+    """Read a vectors.bin file.
+
+    Returns:
+        (header dict, structured array of complete records)
+    """
+    with open(path, 'rb') as file:
+        header, offset = _read_vectors_header(file)
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+def vectors_to_csv(path, csv_path):
+    """Write vectors.bin at path in the legacy vectors.csv format.
+
+    Darksky observations are left out, as they always were. The
+    frequency header is repeated for the velocity columns only when
+    velocities were calculated. Velocities and data are written as the
+    shortest strings that read back as the same float32 values.
+    """
+    header, records = read_vectors(path)
+    units = header['units']
+    freqs = header['freqs']*u.Hz
+    records = records[records['darksky'] == 0]
+    has_vels = len(records) and not np.isnan(records['vels']).all()
+    with open(csv_path, 'w') as file:
+        writer = csv.writer(file)
+        writer.writerow(['# Integration time: %d seconds Center frequency: %s' % (header['int_time'], header['center_frequency']*u.Hz)])
+        writer.writerow(list(POSITION_FIELDS) + [str(f) for f in freqs]*(2 if has_vels else 1))
+        # Formatted as str(Quantity) is, without making one per value.
+        vels_unit = ' ' + units['vels']
+        data_unit = ' ' + units['data']
+        for record in records:
+            row = [str(LEGACY_CLASSES.get(field, u.Quantity)(record[field], units[field])) for field in POSITION_FIELDS]
+            if has_vels:
+                row += [str(v) + vels_unit for v in record['vels']]
+            row += [str(v) + data_unit for v in record['data']]
+            writer.writerow(row)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert survey output files')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    p = subparsers.add_parser('csv', help='write vectors.csv from vectors.bin')
+    p.add_argument('directory', metavar='DIRECTORY', help='survey output directory')
+    args = parser.parse_args()
+    if args.command == 'csv':
+        vectors_to_csv(os.path.join(args.directory, VECTORS_FILE), os.path.join(args.directory, 'vectors.csv'))
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,8 @@ __metaclass__ = type
 
 import matplotlib as mpl
 mpl.use('Agg')
+import galcoord
 from galcoord import HYDROGEN_FREQ
-from galcoord import radome_observer
 from galcoord import altaz_frame
 from galcoord import freqs_to_vel
 from galcoord import directional_offset_by
@@ -14,19 +14,22 @@ import numpy as np
 from galcoord import get_time
 import logging
 import os.path
-import itertools
+import csv
 import time
 import threading
-import csv
 from collections import namedtuple
 import plot
-from astropy.coordinates import SkyCoord, SkyOffsetFrame, get_body
+import schedule
+import storage
+from astropy.coordinates import Angle, Latitude, Longitude, SkyCoord, SkyOffsetFrame, get_body
 from astropy import units as u
 from astropy.table import QTable, Column
-from astropy.time import TimeDelta
+from astropy.time import Time, TimeDelta
 
 AZ_OFFSET=5.5
 EL_OFFSET=-5.5
+# Seconds to wait beyond the integration time before assuming the SDR has stalled.
+OBSERVE_TIMEOUT_MARGIN=30
 
 class iterator(object):
     """iterator emits a series of SkyCoord objects that represent observation positions."""
@@ -52,6 +55,14 @@ class iterator(object):
             return SkyCoord(pos, frame=aaf)
         return pos
 
+    def coords_at(self, t):
+        """Return coords as they will be at time t.
+
+        If t is an array, the result has t's shape followed by the shape
+        of coords (though it may only broadcast to that shape).
+        """
+        return self.coords
+
     def __iter__(self):
         return iter(self.coords)
 
@@ -91,6 +102,7 @@ class grid_iterator(iterator):
         else:
             rotation = 0
         steps = np.arange(start, stop+step, step)
+        self.row_length = len(steps)
         sc = directional_offset_by(
             directional_offset_by(self.center, rotation*u.degree, steps*u.degree),
             (rotation+90)*u.degree, np.expand_dims(steps, 1)*u.degree)
@@ -100,6 +112,19 @@ class grid_iterator(iterator):
     def coords(self):
         return self._coords
 
+    @property
+    def rows(self):
+        """Grid positions as (longitude, latitude) arrays of shape (rows, row_length)."""
+        return (self._coords.l.degree.reshape(-1, self.row_length),
+                self._coords.b.degree.reshape(-1, self.row_length))
+
+    def to_sky(self, lon, lat, t):
+        return SkyCoord(l=lon*u.degree, b=lat*u.degree, frame='galactic')
+
+    def from_sky(self, sc):
+        sc = sc.galactic
+        return sc.l.degree, sc.b.degree
+
     def format_filename(self, pos):
         return 'latlon_%05.1f_%05.1f' % (pos['latitude'], pos['longitude'])
 
@@ -115,9 +140,18 @@ class solar_grid_iterator(iterator):
 
     @property
     def coords(self):
-        t = get_time()
+        return self.coords_at(get_time())
+
+    def coords_at(self, t):
         body = get_body(self.body_name, time=t)
         grid = np.mgrid[self.start:(self.stop+self.step):self.step, self.start:(self.stop+self.step):self.step]
+        if not t.isscalar:
+            # SkyOffsetFrame needs a scalar origin, so offset each body position directly.
+            lon, lat = np.deg2rad(grid[0].flatten()), np.deg2rad(grid[1].flatten())
+            return directional_offset_by(
+                body,
+                np.arctan2(np.cos(lat)*np.sin(lon), np.sin(lat))*u.radian,
+                np.arccos(np.cos(lat)*np.cos(lon))*u.radian)
         return SkyCoord(grid[0]*u.degree, grid[1]*u.degree, frame=SkyOffsetFrame(origin=body, obstime=t)).flatten()
 
     def __iter__(self):
@@ -127,23 +161,91 @@ class solar_grid_iterator(iterator):
             return SkyCoord(point.lon, point.lat, frame=SkyOffsetFrame(origin=body, obstime=t))
         return (correct(point) for point in self.coords)
 
+    @property
+    def row_length(self):
+        return len(self.iter_source)
+
+    @property
+    def rows(self):
+        """Grid offsets as (longitude, latitude) arrays of shape (rows, row_length)."""
+        grid = np.mgrid[self.start:(self.stop+self.step):self.step, self.start:(self.stop+self.step):self.step]
+        return grid[0], grid[1]
+
+    def to_sky(self, lon, lat, t):
+        body = get_body(self.body_name, time=t)
+        return SkyCoord(lon*u.degree, lat*u.degree, frame=SkyOffsetFrame(origin=body, obstime=t))
+
+    def from_sky(self, sc):
+        body = get_body(self.body_name, time=sc.obstime)
+        # Drop sc's AltAz attributes so the frames compare equal.
+        dlon, dlat = body.spherical_offsets_to(SkyCoord(sc.transform_to(body.frame).frame))
+        return dlon.to_value(u.degree), dlat.to_value(u.degree)
+
     def format_filename(self, pos):
         return 'offset_%05.1f_%05.1f' % (pos['skyoffset_latitude'], pos['skyoffset_longitude'])
 
     def format_title(self, pos):
         return '%s offset lon=%.1f lat=%.1f az=%.1f el=%.1f' % (self.body_name, pos['skyoffset_longitude'].degree, pos['latitude'].degree, pos['azimuth'].degree, pos['elevation'].degree)
 
-POSITION_FIELDS = ('time', 'azimuth', 'elevation', 'longitude', 'latitude', 'ra', 'dec', 'rci_azimuth', 'rci_elevation')
-
 class Mode(Enum):
     gal = 'gal'
     az = 'az'
     grid = 'grid'
     solar_grid = 'solar_grid'
+    otf_grid = 'otf_grid'
+    otf_solar_grid = 'otf_solar_grid'
+    drift = 'drift'
 
     def __str__(self):
         return self.value
 
+# On-the-fly modes and the stop-and-stare mode whose grid they map.
+OTF_MODES = {
+    Mode.otf_grid: Mode.grid,
+    Mode.otf_solar_grid: Mode.solar_grid,
+}
+# Per-observation stage timings written by stop-and-stare surveys, in
+# seconds: slew and settle as reported by the telescope (slews start as
+# soon as the previous integration ends), wait (time blocked on the
+# slew after logging the previous point), integrate, and process (from
+# the end of integration until the point is logged).
+TIMINGS_FILE = 'timings.csv'
+TIMINGS_FIELDS = ('number', 'darksky', 'slew', 'settle', 'wait', 'integrate', 'process')
+# Seconds between position updates while scanning a row on the fly.
+OTF_UPDATE_INTERVAL = 0.5
+# Longest sub-integration, in seconds, that still resolves a drift scan.
+DRIFT_MAX_PERIOD = 0.1
+# Seconds allowed for the slew before a drift scan starts.
+DRIFT_SLEW_ALLOWANCE = 30
+# Seconds between collecting sub-integrations during a drift scan.
+DRIFT_POLL_INTERVAL = 5
+# Extra share of a survey's predicted duration covered by its Track.
+TRACK_MARGIN = 1.1
+
+class DarkskyCache(object):
+    """Darksky references that nearby observations can share.
+
+    References are keyed by the elevation bin of the observation they
+    were taken for and can be reused for max_age seconds.
+    """
+    def __init__(self, max_age, el_bin):
+        self.max_age = max_age
+        self.el_bin = el_bin
+        self.entries = {}
+
+    def _key(self, el):
+        return int(el // self.el_bin)
+
+    def get(self, el, t):
+        """Return the number of a reference usable at elevation el and Unix time t, or None."""
+        entry = self.entries.get(self._key(el))
+        if entry is not None and t - entry[1] <= self.max_age:
+            return entry[0]
+
+    def put(self, el, t, number):
+        """Record that observation number's darksky reference was taken at Unix time t."""
+        self.entries[self._key(el)] = (number, t)
+
 class Survey:
     logger = logging.getLogger("survey")
 
@@ -154,27 +256,75 @@ class Survey:
             Mode.az: azimuth_iterator,
             Mode.grid: grid_iterator,
             Mode.solar_grid: solar_grid_iterator,
+            Mode.otf_grid: grid_iterator,
+            Mode.otf_solar_grid: solar_grid_iterator,
+            Mode.drift: solar_grid_iterator,
         }[args.mode]
 
         self.iterator = iterator_cls(**vars(args))
         self.repeat = args.repeat or 1
         self.last_row = {}
         self.want_abort = threading.Event()
+        # Indices into the repeated coords in observing order, or None for row order.
+        self.order = None
+        # Predicted positions of the coords while a stop-and-stare survey runs.
+        self.track = None
+        # Observations recorded so far by a stop-and-stare survey.
+        self.store = None
+        # Darksky references shared between stop-and-stare observations, if enabled.
+        self.darksky_cache = None
+        if args.darksky_offset and args.darksky_max_age:
+            self.darksky_cache = DarkskyCache(args.darksky_max_age, args.darksky_el_bin)
 
     def run(self, tb):
         try:
             os.mkdir(self.args.output_dir)
         except OSError:
             pass
+        if self.args.resume and (self.args.mode in OTF_MODES or self.args.mode == Mode.drift):
+            raise ValueError("can't resume a %s survey" % (self.args.mode,))
+        if (self.args.target_snr is not None or self.args.target_noise is not None) and (self.args.mode in OTF_MODES or self.args.mode == Mode.drift):
+            raise ValueError("%s surveys don't support adaptive integration" % (self.args.mode,))
+        if self.args.freq_switch_offset:
+            if self.args.mode in OTF_MODES or self.args.mode == Mode.drift:
+                raise ValueError("%s surveys don't support frequency switching" % (self.args.mode,))
+            if self.args.darksky_offset or self.args.target_snr is not None or self.args.target_noise is not None:
+                raise ValueError("frequency switching can't be combined with darksky observations or adaptive integration")
+        if tb.products:
+            if self.args.mode in OTF_MODES or self.args.mode == Mode.drift:
+                raise ValueError("%s surveys don't support spectral products" % (self.args.mode,))
+            if self.args.freq_switch_offset:
+                raise ValueError("frequency switching can't be combined with spectral products")
+        if self.args.capture_time:
+            if self.args.mode in OTF_MODES or self.args.mode == Mode.drift:
+                raise ValueError("%s surveys don't support IQ capture" % (self.args.mode,))
+            if not hasattr(tb, 'capture_valve'):
+                raise ValueError("this flowgraph can't capture IQ")
         band=0
         tb.client.set_band_rx(band, not self.args.ref)
-        self._run_survey(tb)
+        if self.args.mode in OTF_MODES:
+            self._run_otf(tb)
+        elif self.args.mode == Mode.drift:
+            self._run_drift(tb)
+        else:
+            if self.args.resume:
+                self._resume()
+            self._track_at(get_time())
+            if not self.args.resume and self.args.order != 'row':
+                self.order = self._plan(tb)
+            self._run_survey(tb)
         tb.client.set_band_rx(band, False)
         tb.park()
 
     @property
     def coord_groups(self):
-        pos = self.iterator.coords_now._apply(np.tile, self.repeat)
+        if self.track is not None:
+            predicted = self._predicted(('ra', 'dec'))
+            pos = SkyCoord(ra=predicted['ra']*u.degree, dec=predicted['dec']*u.degree, frame='icrs')
+        else:
+            pos = self.iterator.coords_now._apply(np.tile, self.repeat)
+            if self.order is not None:
+                pos = pos[self.order]
         number = self.last_row.get('number', -1)
         done_pos = pos[:number+1]
         remaining_pos = pos[number+1:]
@@ -182,165 +332,782 @@ class Survey:
 
     @property
     def time_remaining(self):
-        pos_altaz = self.coord_groups[0]
-        if pos_altaz.frame.name != 'altaz':
-            aaf = altaz_frame(get_time())
-            pos_altaz = pos_altaz.transform_to(aaf)
-        above_horizon = len(pos_altaz[pos_altaz.alt >= EL_OFFSET*u.degree])
-        if self.args.darksky_offset:
-            above_horizon *= 2
+        if self.args.mode == Mode.drift:
+            cuts = len(self.iterator.iter_source) * self.repeat - (self.last_row.get('number', -1) + 1)
+            return TimeDelta((cuts * (self.args.int_time + DRIFT_SLEW_ALLOWANCE)) * u.second)
+        if self.track is not None:
+            el = self._predicted(('el',))['el'][self.last_row.get('number', -1)+1:]
+            above_horizon = np.count_nonzero(el >= EL_OFFSET)
+        else:
+            pos_altaz = self.coord_groups[0]
+            if pos_altaz.frame.name != 'altaz':
+                aaf = altaz_frame(get_time())
+                pos_altaz = pos_altaz.transform_to(aaf)
+            above_horizon = len(pos_altaz[pos_altaz.alt >= EL_OFFSET*u.degree])
+        if self.args.mode in OTF_MODES:
+            # One slew to the start of each row, then int_time per point while scanning.
+            rows = np.ceil(above_horizon / self.iterator.row_length)
+            return TimeDelta((above_horizon * self.args.int_time + rows * 5) * u.second)
+        above_horizon *= 1 + self._darksky_share
         return TimeDelta((above_horizon * (self.args.int_time + 5)) * u.second)
 
     @property
-    def coords(self):
-        return itertools.chain(*((self.iterator,)*self.repeat))
+    def _order(self):
+        """Indices into the repeated coords in observing order."""
+        if self.order is not None:
+            return self.order
+        return range(len(self.iterator.coords) * self.repeat)
+
+    @property
+    def _darksky_share(self):
+        """Expected darksky observations per point."""
+        if not self.args.darksky_offset:
+            return 0
+        if self.darksky_cache is None:
+            return 1
+        # About one reference per max_age seconds, more when the elevation changes bins.
+        return min(1, (self.args.int_time + 5) / self.args.darksky_max_age)
+
+    @property
+    def _dwell(self):
+        """Seconds spent observing each point."""
+        return self.args.int_time * (1 + self._darksky_share)
+
+    def _track_at(self, t):
+        """Return a Track that covers time t, replacing self.track if it doesn't.
+
+        A new track first covers the remaining points without slews,
+        then is extended to the time a Schedule of them on that track
+        predicts, slews included.
+        """
+        track = self.track
+        if track is None or (t - track.start).sec > track.end:
+            remaining = np.asarray(self._order)[self.last_row.get('number', -1)+1:]
+            duration = max(len(remaining), 1) * (self._dwell + schedule.SETTLE_TIME)
+            track = self._new_track(t, duration)
+            if len(remaining):
+                remaining = remaining % len(track)
+                predicted = schedule.Schedule(
+                    track, remaining, self._dwell, track.azel(remaining[0], 0), min_el=EL_OFFSET,
+                    az_rate=self.args.az_rate, el_rate=self.args.el_rate)
+                if predicted.duration > track.end:
+                    track = self._new_track(t, predicted.duration * TRACK_MARGIN)
+            self.track = track
+        return track
+
+    def _new_track(self, t, duration):
+        """Return a Track of duration seconds from time t."""
+        obswl = (self.args.sdr_frequency*u.Hz).to(u.cm, u.spectral())
+        start = time.time()
+        track = schedule.Track(self.iterator, t, duration, obswl=obswl)
+        self.logger.info('Predicted positions for %d sec of survey in %.1f sec, accurate to %.4f°',
+                         duration, time.time() - start, track.error)
+        return track
+
+    def _predicted(self, names):
+        """Return the named track columns for every scheduled point now, in observing order."""
+        track = self.track
+        return track.at(np.asarray(self._order) % len(track), (get_time() - track.start).sec, names)
+
+    def _plan(self, tb):
+        """Choose the observing order for a stop-and-stare survey.
+
+        Returns:
+            indices into the repeated coords
+        """
+        n = len(self.iterator.coords)
+        planned, naive = schedule.plan(
+            self._track_at(get_time()), n, self.repeat, self.args.order, self._dwell,
+            (tb.client.azimuth_position, tb.client.elevation_position),
+            min_el=EL_OFFSET, row_length=getattr(self.iterator, 'row_length', None),
+            az_rate=self.args.az_rate, el_rate=self.args.el_rate)
+        with open(os.path.join(self.args.output_dir, 'schedule.txt'), 'w') as file:
+            file.write('%s order: predicted slew time %.0f sec, %d points below the horizon\n' % (self.args.order, planned.slew_time, len(planned.missed)))
+            file.write('row order: predicted slew time %.0f sec, %d points below the horizon\n' % (naive.slew_time, len(naive.missed)))
+            file.write('Order: %s\n' % (' '.join(str(i) for i in planned.order),))
+        if planned.duration > self.track.end:
+            # The track was sized for row order.
+            self.track = self._new_track(self.track.start, planned.duration * TRACK_MARGIN)
+        return planned.order
+
+    def _resume(self):
+        """Pick up an interrupted survey from the store in its output directory."""
+        store = storage.ObservationStore.open(os.path.join(self.args.output_dir, storage.STORE_DIR))
+        if self.args.darksky_offset and len(store):
+            last = store.row(-1)
+            if not last['darksky'] and last.get('darksky_number', last['number']) == last['number']:
+                # Observe the last point again rather than leave it without its darksky.
+                store.truncate(len(store) - 1)
+        if self.darksky_cache is not None and len(store):
+            table = store.table()
+            elevations = {row['number']: row['elevation'].degree for row in table[~table['darksky']]}
+            for row in table[table['darksky']]:
+                if row['number'] in elevations:
+                    self.darksky_cache.put(elevations[row['number']], row['time'].to_value(u.second), row['number'])
+        order = store.meta.get('order')
+        if order is not None:
+            self.order = np.array(order)
+        if len(store):
+            self.last_row = store.row(-1)
+        self.store = store
+        self.logger.info('Resuming survey after %d of %d observations', self.last_row.get('number', -1) + 1, len(self._order))
+
+    def _create_store(self):
+        """Create the store for a new stop-and-stare survey."""
+        args = {k: str(v) if isinstance(v, Enum) else v for k, v in vars(self.args).items() if k not in ('output_dir', 'resume')}
+        return storage.ObservationStore.create(
+            os.path.join(self.args.output_dir, storage.STORE_DIR),
+            capacity=len(self._order) * (2 if self.args.darksky_offset else 1),
+            meta={
+                # Used by --resume to restart with the same arguments and order.
+                'args': args,
+                'order': None if self.order is None else [int(i) for i in self.order],
+            })
 
     def abort(self):
         self.want_abort.set()
 
-    def _run_survey(self, tb, ref_frequency=HYDROGEN_FREQ):
-        savefolder = self.args.output_dir
-        int_time = self.args.int_time
-        darksky_offset = self.args.darksky_offset
+    def _tune(self, tb):
+        """Apply the survey's frequency, gain and spectrometer settings to tb.
 
+        Raises ValueError, before changing anything, if the survey's
+        bandwidth isn't the flowgraph's. Raises ValueError if tb can't
+        switch to the survey's spectrometer settings (e.g. in
+        dual-channel mode) and TimeoutError if the new spectrometer
+        produces no sub-integration, in both cases after restoring the
+        old settings.
+
+        Returns:
+            (frequency, spectrometer settings) to pass to
+            _restore_tuning afterwards
+        """
+        tb.set_bandwidth(self.args.bandwidth)
         old_freq = tb.get_sdr_frequency()
-        old_bandwidth = tb.get_bandwidth()
+        old_settings = tb.spectrometer_settings()
         if self.args.sdr_frequency != old_freq:
             tb.set_sdr_frequency(self.args.sdr_frequency)
-        if self.args.bandwidth != old_bandwidth:
-            tb.set_bandwidth(self.args.bandwidth)
+        # Long enough for the new spectrometer's first sub-integration.
+        timeout = (self.args.sub_int_time or tb.get_integration_time()) + OBSERVE_TIMEOUT_MARGIN
+        try:
+            tb.configure_spectrometer(self.args.channels, self.args.window, self.args.sub_int_time, timeout=timeout)
+        except (TimeoutError, ValueError):
+            self._restore_tuning(tb, (old_freq, old_settings))
+            raise
 
         tb.set_sdr_gain(self.args.gain)
+        return old_freq, old_settings
+
+    def _restore_tuning(self, tb, old_tuning):
+        old_freq, old_settings = old_tuning
+        if old_freq != tb.get_sdr_frequency():
+            tb.set_sdr_frequency(old_freq)
+        tb.configure_spectrometer(*old_settings, wait=False)
+
+    def _targets(self, obswl):
+        """Yield the remaining stop-and-stare targets in observing order.
+
+        Each target's position is computed when it is requested, just
+        before the dish is sent there. Targets below the horizon are
+        skipped, as are darksky targets while the darksky cache holds a
+        reference for the position; the caller caches each darksky
+        reference once its row is stored.
+
+        Yields:
+            dicts of number, darksky, pos, pos_altaz, time (of the
+            position), source_el (elevation of the on-source
+            observation, for the darksky cache), sky (columns for the
+            row), corrections (for freqs_to_vel) and row (the rest of
+            the row's columns so far)
+        """
+        darksky_offset = self.args.darksky_offset
+        cache = self.darksky_cache
+        points = self.iterator.coords
+        done = self.last_row.get('number', -1)
+        for number, index in enumerate(self._order):
+            if number <= done:
+                continue
+            index %= len(points)
+            pos = points[index]
+            # Elevation and row of the on-source observation.
+            el = source_row = None
+            for darksky in (False, True):
+                if darksky and not darksky_offset:
+                    continue
+                if darksky and cache is not None and el is not None:
+                    # Looked up only now: with the slew started early, the
+                    # on-source observation is taken but not yet stored, and
+                    # the previous darksky reference is stored and cached.
+                    reference = cache.get(el, get_time().unix)
+                    if reference is not None:
+                        source_row['darksky_number'] = reference
+                        continue
+                apytime=get_time()
+                aaf = altaz_frame(apytime, obswl=obswl)
+                if pos.frame.name == 'altaz':
+                    # Replace altaz frame with one that has obstime and location
+                    pos = SkyCoord(pos, frame=aaf)
+                # Look up the position instead of transforming it.
+                track = self._track_at(apytime)
+                predicted = track.at(index, (apytime - track.start).sec)
+                pos_altaz = SkyCoord(az=predicted['az']*u.degree, alt=predicted['el']*u.degree, frame=aaf)
+                sky = {
+                    'longitude': Longitude(predicted['l']*u.degree),
+                    'latitude': Latitude(predicted['b']*u.degree),
+                    'ra': Longitude(predicted['ra']*u.degree),
+                    'dec': Latitude(predicted['dec']*u.degree),
+                }
+                corrections = None
+                if 'v_bary' in predicted:
+                    corrections = (predicted['v_bary']*u.km/u.s, predicted['v_proj']*u.km/u.s)
+
+                row = {}
+
+                if isinstance(pos.frame, SkyOffsetFrame):
+                    row.update({
+                        'body_name': self.args.body_name,
+                        'skyoffset_latitude': pos.lat,
+                        'skyoffset_longitude': pos.lon,
+                    })
+
+                if darksky:
+                    pos_altaz = directional_offset_by(pos_altaz, 90*u.degree, darksky_offset*u.degree)
+                    pos = pos_altaz
+                    sky = {
+                        'longitude': pos.galactic.l,
+                        'latitude': pos.galactic.b,
+                        'ra': pos.icrs.ra,
+                        'dec': pos.icrs.dec,
+                    }
+                if pos_altaz.alt < EL_OFFSET*u.degree:
+                    self.logger.warning("Can't observe at %s; target alt %s is below the horizon", pos, pos_altaz.alt)
+                    continue
+
+                if pos.location is None:
+                    pos.location = galcoord.radome_observer.location
+                if pos.obstime is None:
+                    pos.obstime = apytime
+
+                if cache is not None:
+                    if not darksky:
+                        el, source_row = pos_altaz.alt.degree, row
+                    row['darksky_number'] = number
+
+                yield {
+                    'number': number,
+                    'darksky': darksky,
+                    'source_el': el,
+                    'pos': pos,
+                    'pos_altaz': pos_altaz,
+                    'time': apytime,
+                    'sky': sky,
+                    'corrections': corrections,
+                    'row': row,
+                }
+
+    def _run_survey(self, tb, ref_frequency=HYDROGEN_FREQ):
+        savefolder = self.args.output_dir
+        int_time = self.args.int_time
+        darksky_offset = self.args.darksky_offset
+
+        old_tuning = self._tune(tb)
         freq=tb.get_sdr_frequency()*u.Hz
         gain=tb.get_sdr_gain()*u.dB
         freq_offset=tb.get_output_vector_bandwidth()*u.Hz/2
         freq_range=np.linspace(freq-freq_offset, freq+freq_offset, tb.get_num_channels())
+        product_freqs = {name: (branch.freqs(freq.to_value(u.Hz))*u.Hz).to(u.MHz) for name, branch in tb.products.items()}
 
         #########################################
         # BEGIN COMMANDS #
         #########################################
 
-        file=open(os.path.join(savefolder, 'info.txt'), 'w')
-        csvwriter = csv.writer(open(os.path.join(savefolder, 'vectors.csv'), 'w'))
-        file.write('Integration time '+str(int_time)+' seconds. Center frequency '+str(freq)+' MHz. \n \n')
-        file.write('Original arguments:\n' + str(self.args))
+        resume = self.store is not None
+        file=open(os.path.join(savefolder, 'info.txt'), 'a' if resume else 'w')
+        if resume:
+            file.write('\n\nResumed at %s after %d observations.\n' % (get_time().iso, self.last_row.get('number', -1) + 1))
+        else:
+            file.write('Integration time '+str(int_time)+' seconds. Center frequency '+str(freq)+' MHz. \n \n')
+            if self.args.target_snr is not None or self.args.target_noise is not None:
+                file.write('Adaptive integration of %s to %d seconds until SNR %s or noise %s. \n \n' % (
+                    self.args.min_int_time, int_time, self.args.target_snr, self.args.target_noise))
+            if self.args.freq_switch_offset:
+                file.write('Frequency switched by %s Hz every %s seconds. \n \n' % (self.args.freq_switch_offset, self.args.freq_switch_period))
+            for name, branch in tb.products.items():
+                product = branch.product
+                file.write('Spectral product %s: %d channels over %g Hz at %g Hz, %.3g second sub-integrations. \n \n' % (
+                    name, product.num_channels, branch.if_samp_rate, freq.to_value(u.Hz) + product.offset, branch.sub_integration_time()))
+            file.write('Original arguments:\n' + str(self.args))
+            self.store = self._create_store()
         file.close()
+        vectors = storage.VectorWriter(os.path.join(savefolder, storage.VECTORS_FILE), freq, freq_range, int_time,
+                                       keep=len(self.store) if resume else None)
 
-        csvwriter.writerow(['# Integration time: %d seconds Center frequency: %s' % (int_time, freq)])
-        freq_count = 2
-        csvwriter.writerow(list(POSITION_FIELDS) + [str(f) for f in freq_range]*freq_count)
-
-        # all_data is a list of dictionaries containg all information about a run;
+        # The store holds a row with all information about each observation;
         # 'data' contains the raw data, 'freqs' contains the frequency for each sample
         # 'time' contains the observation time
         # 'rci_azimuth' and 'rci_elevation' contain the actual azimuth and elevation for the observation
         # all other fields come from pos
-        all_data = []
+        store = self.store
 
+        obswl = freq.to(u.cm, u.spectral())
+        # Plots are rendered while the dish moves on to the next point.
+        plotter = plot.BackgroundPlotter()
+        timings_file = open(os.path.join(savefolder, TIMINGS_FILE), 'a' if resume else 'w')
+        timings = csv.writer(timings_file)
+        if not resume:
+            timings.writerow(TIMINGS_FIELDS)
+        survey_start = time.monotonic()
+        integrated = 0
+        reused = 0
+        adaptive = self.args.target_snr is not None or self.args.target_noise is not None
+        # Darksky references integrate for as long as their on-source observation.
+        on_source = {}
+        targets = self._targets(obswl)
         try:
-            for number, pos in enumerate(self.coords):
-                for darksky in (False, True):
-                    if darksky and not darksky_offset:
-                        continue
-                    if self.want_abort.is_set():
-                        return
-                    apytime=get_time()
-                    aaf = altaz_frame(apytime, obswl=freq.to(u.cm, u.spectral()))
-                    if pos.frame.name == 'altaz':
-                        # Replace altaz frame with one that has obstime and location
-                        pos = SkyCoord(pos, frame=aaf)
-                        pos_altaz = pos
-                    else:
-                        pos_altaz = pos.transform_to(aaf)
-
-                    row = {}
-
-                    if isinstance(pos.frame, SkyOffsetFrame):
-                        row.update({
-                            'body_name': self.args.body_name,
-                            'skyoffset_latitude': pos.lat,
-                            'skyoffset_longitude': pos.lon,
-                        })
+            target = next(targets, None)
+            if target is not None:
+                slew = tb.start_point(target['pos_altaz'].az.degree, target['pos_altaz'].alt.degree)
+            while target is not None:
+                if self.want_abort.is_set():
+                    return
+                wait_start = time.monotonic()
+                slew_time, settle_time = tb.wait_pointed(slew)
+                wait_time = time.monotonic() - wait_start
 
-                    if darksky:
-                        pos_altaz = directional_offset_by(pos_altaz, 90*u.degree, darksky_offset*u.degree)
-                        pos = pos_altaz
-                    if pos_altaz.alt < EL_OFFSET*u.degree:
-                        self.logger.warning("Can't observe at %s; target alt %s is below the horizon", pos, pos_altaz.alt)
-                        continue
-                    tb.point(pos_altaz.az.degree, pos_altaz.alt.degree)
+                pos, pos_altaz, apytime = target['pos'], target['pos_altaz'], target['time']
+                number, darksky = target['number'], target['darksky']
+                self.logger.info("Observing at coordinates %s.", pos)
+                if self.args.capture_time:
+                    tb.start_capture(
+                        os.path.join(savefolder, 'observation_%d%s' % (number, '_darksky' if darksky else '')),
+                        self.args.capture_time,
+                        pointing={
+                            'number': number,
+                            'azimuth': float(pos_altaz.az.degree),
+                            'elevation': float(pos_altaz.alt.degree),
+                            'rci_azimuth': tb.client.azimuth_position,
+                            'rci_elevation': tb.client.elevation_position,
+                        })
+                product_starts = tb.next_product_sub_integrations()
+                obs_start = time.time()
+                stats = reference = None
+                if self.args.freq_switch_offset:
+                    data, reference, seconds = tb.observe_switched(
+                        int_time, self.args.freq_switch_offset, self.args.freq_switch_period,
+                        timeout=int_time+OBSERVE_TIMEOUT_MARGIN)
+                    reference = reference*(u.mW/u.Hz)
+                elif adaptive and not (darksky and number in on_source):
+                    data, seconds, stats = tb.observe_adaptive(
+                        int_time, self.args.min_int_time, self.args.target_snr, self.args.target_noise,
+                        timeout=int_time+OBSERVE_TIMEOUT_MARGIN)
+                else:
+                    seconds = on_source.pop(number, int_time) if darksky else int_time
+                    data = tb.observe(seconds, timeout=seconds+OBSERVE_TIMEOUT_MARGIN)
+                data = data*(u.mW/u.Hz)
+                products = tb.product_spectra(product_starts, seconds, timeout=OBSERVE_TIMEOUT_MARGIN)
+                obs_end = time.time()
+                if self.args.capture_time:
+                    tb.stop_capture()
+                if adaptive and not darksky:
+                    on_source = {number: seconds}
+                rci_azimuth, rci_elevation = tb.client.azimuth_position, tb.client.elevation_position
+                integrated += obs_end - obs_start
 
-                    if pos.location is None:
-                        pos.location = radome_observer.location
-                    if pos.obstime is None:
-                        pos.obstime = apytime
+                # Start slewing to the next target while this one is logged.
+                current, target = target, next(targets, None)
+                if target is not None:
+                    slew = tb.start_point(target['pos_altaz'].az.degree, target['pos_altaz'].alt.degree)
 
-                    self.logger.info("Observing at coordinates %s.", pos)
-                    data=tb.observe(int_time)*(u.mW/u.Hz)
+                if self.args.sub_int_time:
+                    # Keep the sub-integrations behind this observation (in mW/Hz).
+                    times, counters, subints = tb.sub_integrations(obs_start, obs_end)
+                    np.savez(
+                        os.path.join(savefolder, 'observation_%d%s_subint.npz' % (number, '_darksky' if darksky else '')),
+                        time=times, counter=counters, data=subints, freqs=freq_range.to_value(u.MHz))
 
-                    apytime.format = 'unix'
+                apytime.format = 'unix'
+                row = current['row']
+                row.update({
+                    'mode': str(self.args.mode),
+                    'gain': gain,
+                    'number': number,
+                    'data': data,
+                    'average_power': np.mean(data),
+                    # TODO when Astropy supports the unit in FITS files: 'average_power_log': np.mean(data).to(u.dB(u.mW / u.Hz)),
+                    'freqs': freq_range,
+                    'time': apytime.value*u.second,
+                    'temperature': pos_altaz.frame.temperature,
+                    'relative_humidity': pos_altaz.frame.relative_humidity,
+                    'pressure': pos_altaz.frame.pressure,
+                    'azimuth': pos_altaz.az,
+                    'elevation': pos_altaz.alt,
+                    'rci_azimuth': rci_azimuth*u.degree,
+                    'rci_elevation': rci_elevation*u.degree,
+                    'int_time': seconds*u.second,
+                })
+                if stats is not None:
+                    row['snr'] = stats.snr()
+                    row['noise'] = stats.noise()
+                for name, spectrum in products.items():
+                    spectrum = spectrum*(u.mW/u.Hz)
                     row.update({
-                        'mode': str(self.args.mode),
-                        'gain': gain,
-                        'number': number,
-                        'data': data,
-                        'average_power': np.mean(data),
-                        # TODO when Astropy supports the unit in FITS files: 'average_power_log': np.mean(data).to(u.dB(u.mW / u.Hz)),
-                        'freqs': freq_range,
-                        'time': apytime.value*u.second,
-                        'temperature': pos_altaz.frame.temperature,
-                        'relative_humidity': pos_altaz.frame.relative_humidity,
-                        'pressure': pos_altaz.frame.pressure,
-                        'azimuth': pos_altaz.az,
-                        'elevation': pos_altaz.alt,
-                        'longitude': pos.galactic.l,
-                        'latitude': pos.galactic.b,
-                        'ra': pos.icrs.ra,
-                        'dec': pos.icrs.dec,
-                        'rci_azimuth': tb.client.azimuth_position*u.degree,
-                        'rci_elevation': tb.client.elevation_position*u.degree,
+                        name + '_data': spectrum,
+                        name + '_average_power': np.mean(spectrum),
+                        name + '_freqs': product_freqs[name],
                     })
-                    # TODO: When we move to AstroPy 3+ (with Python 3+) we can
-                    # just write time, pos and pos_altaz directly to the table.
-                    if darksky_offset:
-                        row['darksky'] = darksky
+                if reference is not None:
+                    # The reference spectrum was taken freq_switch_offset Hz higher.
+                    row['reference_data'] = reference
+                    row['calibrated_data'] = data - reference
+                row.update(current['sky'])
+                # TODO: When we move to AstroPy 3+ (with Python 3+) we can
+                # just write time, pos and pos_altaz directly to the table.
+                if darksky_offset:
+                    row['darksky'] = darksky
+                    if row.get('darksky_number', number) != number:
+                        reused += 1
 
-                    vel_range = None
-                    if ref_frequency is not None and pos.frame.name != 'altaz':
-                        vel_range=freqs_to_vel(ref_frequency, freq_range.to(u.MHz), pos)
-                        row['vels'] = vel_range
+                vel_range = None
+                if ref_frequency is not None and pos.frame.name != 'altaz':
+                    vel_range=freqs_to_vel(ref_frequency, freq_range.to(u.MHz), pos, corrections=current['corrections'])
+                    row['vels'] = vel_range
+                    for name in products:
+                        row[name + '_vels'] = freqs_to_vel(ref_frequency, product_freqs[name].to(u.MHz), pos, corrections=current['corrections'])
 
-                    self.last_row = row
-                    all_data.append(row)
+                self.last_row = row
+                store.append(row)
+                vectors.write(row)
+                if darksky and self.darksky_cache is not None and current['source_el'] is not None:
+                    # Shared only once it is recorded.
+                    self.darksky_cache.put(current['source_el'], apytime.unix, number)
 
-                    if not darksky:
-                        # Only generate legacy data and plots for non-darksky data.
-                        apytime.format = 'fits'
-                        csvrow = [str(row[x]) for x in POSITION_FIELDS]
-                        if vel_range is not None:
-                            csvrow += [str(f) for f in vel_range]
-                        csvrow += [str(f) for f in data]
-                        csvwriter.writerow(csvrow)
+                if not darksky:
+                    # Only generate plots for non-darksky data.
+                    apytime.format = 'fits'
 
-                        prefix=os.path.join(savefolder, 'observation_%d' % (number))
+                    prefix=os.path.join(savefolder, 'observation_%d' % (number))
 
-                        plot.plot_freq(freq, freq_range, data, self.iterator.format_title(row) + ' ' + str(apytime), prefix+'_freq.pdf')
+                    plotter.submit(plot.plot_freq, freq, freq_range, data, self.iterator.format_title(row) + ' ' + str(apytime), prefix+'_freq.pdf')
 
-                        if 'vels' in row:
-                            plot.plot_velocity(vel_range, data, self.iterator.format_title(row) + ' '+ str(apytime), prefix+'_vel.pdf')
+                    if 'vels' in row:
+                        plotter.submit(plot.plot_velocity, vel_range, data, self.iterator.format_title(row) + ' '+ str(apytime), prefix+'_vel.pdf')
 
-                    self.logger.info('Data logged.')
+                timings.writerow(['%d' % number, '%d' % darksky] + ['%.3f' % t for t in (
+                    slew_time, settle_time, wait_time, obs_end - obs_start, time.time() - obs_end)])
+                timings_file.flush()
+                self.logger.info('Data logged.')
 
         finally:
-            if old_freq != tb.get_sdr_frequency():
-                tb.set_sdr_frequency(old_freq)
-            if old_bandwidth != tb.get_bandwidth():
-                tb.set_bandwidth(old_bandwidth)
+            if self.args.capture_time:
+                tb.stop_capture()
+            vectors.close()
+            timings_file.close()
+            elapsed = time.monotonic() - survey_start
+            if elapsed:
+                self.logger.info('Integrated for %.0f of %.0f sec (duty cycle %.1f%%).', integrated, elapsed, 100*integrated/elapsed)
+            if self.darksky_cache is not None:
+                self.logger.info('Saved %d darksky observations by reusing cached references.', reused)
+                with open(os.path.join(savefolder, 'info.txt'), 'a') as file:
+                    file.write('\nSaved %d darksky observations by reusing cached references.\n' % (reused,))
+            self._restore_tuning(tb, old_tuning)
+            plotter.close()
+            if not len(store):
+                self.logger.warning('No observations found! Not saving data.')
+            else:
+                all_data = store.table()
+
+                plot.save_data(all_data, savefolder)
+
+                plot.plot(all_data, savefolder=savefolder)
+
+    def _run_otf(self, tb, ref_frequency=HYDROGEN_FREQ):
+        """Map the iterator's grid on the fly.
+
+        Each row of the grid is scanned continuously, alternating
+        direction, with the commanded position advancing one grid step
+        every int_time seconds. The sub-integrations and dish positions
+        recorded along the way are gridded back onto the grid points,
+        producing the same rows as _run_survey.
+        """
+        savefolder = self.args.output_dir
+        int_time = self.args.int_time
+
+        old_tuning = self._tune(tb)
+        freq=tb.get_sdr_frequency()*u.Hz
+        gain=tb.get_sdr_gain()*u.dB
+        freq_offset=tb.get_output_vector_bandwidth()*u.Hz/2
+        freq_range=np.linspace(freq-freq_offset, freq+freq_offset, tb.get_num_channels())
+        obswl = freq.to(u.cm, u.spectral())
+
+        with open(os.path.join(savefolder, 'info.txt'), 'w') as file:
+            file.write('On-the-fly map, '+str(int_time)+' seconds per point. Center frequency '+str(freq)+' MHz. \n \n')
+            file.write('Original arguments:\n' + str(self.args))
+
+        row_lons, row_lats = self.iterator.rows
+        grid_lon, grid_lat = row_lons.flatten(), row_lats.flatten()
+        grid_vectors = _unit_vectors(grid_lon, grid_lat)
+        # Sums over the sub-integrations that fall nearest each grid point.
+        sums = {
+            'data': np.zeros((len(grid_lon), len(freq_range))),
+            'count': np.zeros(len(grid_lon)),
+            'time': np.zeros(len(grid_lon)),
+            'rci_azimuth_x': np.zeros(len(grid_lon)),
+            'rci_azimuth_y': np.zeros(len(grid_lon)),
+            'rci_elevation': np.zeros(len(grid_lon)),
+        }
+        period = tb.sub_integration_time()
+
+        all_data = []
+        try:
+            scan_number = 0
+            for _ in range(self.repeat):
+                for row, (lons, lats) in enumerate(zip(row_lons, row_lats)):
+                    if self.want_abort.is_set():
+                        return
+                    if scan_number % 2:
+                        lons, lats = lons[::-1], lats[::-1]
+                    scan = self._scan_row(tb, lons, lats, obswl)
+                    if scan is not None:
+                        times, vectors, positions = scan
+                        np.savez(os.path.join(savefolder, 'otf_scan_%d.npz' % (scan_number)),
+                                 time=times, data=vectors, positions=positions, freqs=freq_range.to_value(u.MHz))
+                        self._grid_otf_scan(times - period/2, vectors, positions, obswl, grid_vectors, sums)
+                    scan_number += 1
+                    self.last_row = {'number': scan_number*self.iterator.row_length - 1}
+        finally:
+            self._restore_tuning(tb, old_tuning)
+            observed = np.flatnonzero(sums['count'])
+            for number in observed:
+                count = sums['count'][number]
+                apytime = Time(sums['time'][number] / count, format='unix')
+                pos = self.iterator.to_sky(grid_lon[number], grid_lat[number], apytime)
+                if pos.location is None:
+                    pos.location = galcoord.radome_observer.location
+                if pos.obstime is None:
+                    pos.obstime = apytime
+                pos_altaz = pos.transform_to(altaz_frame(apytime, obswl=obswl))
+                data = sums['data'][number] / count * (u.mW/u.Hz)
+                row = {}
+                if isinstance(pos.frame, SkyOffsetFrame):
+                    row.update({
+                        'body_name': self.args.body_name,
+                        'skyoffset_latitude': pos.lat,
+                        'skyoffset_longitude': pos.lon,
+                    })
+                row.update({
+                    'mode': str(OTF_MODES[self.args.mode]),
+                    'gain': gain,
+                    'number': number,
+                    'data': data,
+                    'average_power': np.mean(data),
+                    'freqs': freq_range,
+                    'time': apytime.value*u.second,
+                    'int_time': count*period*u.second,
+                    'temperature': pos_altaz.frame.temperature,
+                    'relative_humidity': pos_altaz.frame.relative_humidity,
+                    'pressure': pos_altaz.frame.pressure,
+                    'azimuth': pos_altaz.az,
+                    'elevation': pos_altaz.alt,
+                    'longitude': pos.galactic.l,
+                    'latitude': pos.galactic.b,
+                    'ra': pos.icrs.ra,
+                    'dec': pos.icrs.dec,
+                    'rci_azimuth': Angle(np.arctan2(sums['rci_azimuth_y'][number], sums['rci_azimuth_x'][number])*u.radian).wrap_at(360*u.degree).to(u.degree),
+                    'rci_elevation': sums['rci_elevation'][number] / count * u.degree,
+                })
+                if ref_frequency is not None:
+                    row['vels'] = freqs_to_vel(ref_frequency, freq_range.to(u.MHz), pos)
+                all_data.append(row)
             if not all_data:
                 self.logger.warning('No observations found! Not saving data.')
             else:
+                self.logger.info('Gridded %d sub-integrations onto %d of %d points.', sums['count'].sum(), len(observed), len(grid_lon))
                 all_data = QTable(all_data)
 
                 plot.save_data(all_data, savefolder)
 
                 plot.plot(all_data, savefolder=savefolder)
+
+    def _scan_row(self, tb, lons, lats, obswl):
+        """Scan continuously along one row of grid points.
+
+        The scan starts and ends half a grid step beyond the outer
+        points so that they are covered as fully as the inner ones.
+
+        Returns:
+            (sub-integration times, vectors, dish positions) recorded
+            during the scan, or None if the row is below the horizon.
+        """
+        n = len(lons)
+        duration = n * self.args.int_time
+        lons = np.rad2deg(np.unwrap(np.deg2rad(lons)))
+        if n > 1:
+            # Extrapolate half a step beyond each end.
+            index = np.concatenate(([-0.5], np.arange(n), [n-0.5]))
+            lons = np.concatenate(([1.5*lons[0] - 0.5*lons[1]], lons, [1.5*lons[-1] - 0.5*lons[-2]]))
+            lats = np.concatenate(([1.5*lats[0] - 0.5*lats[1]], lats, [1.5*lats[-1] - 0.5*lats[-2]]))
+        else:
+            index = np.array([-0.5, 0.5])
+            lons, lats = np.repeat(lons, 2), np.repeat(lats, 2)
+
+        def target(f):
+            t = get_time()
+            sky = self.iterator.to_sky(np.interp(f, index, lons), np.interp(f, index, lats), t)
+            return sky.transform_to(altaz_frame(t, obswl=obswl))
+
+        start, end = target(index[0]), target(index[-1])
+        if min(start.alt, end.alt) < EL_OFFSET*u.degree:
+            self.logger.warning("Can't scan row from %s to %s; it is below the horizon", start, end)
+            return None
+        tb.point(start.az.degree, start.alt.degree)
+        self.logger.info('Scanning row from (%s, %s) to (%s, %s) over %d sec.', start.az, start.alt, end.az, end.alt, duration)
+        with tb.recording_positions() as positions:
+            scan_start = time.time()
+            while not self.want_abort.is_set():
+                elapsed = time.time() - scan_start
+                if elapsed >= duration:
+                    break
+                pos_altaz = target(index[0] + (index[-1] - index[0]) * elapsed / duration)
+                tb.client.set_azimuth_position(pos_altaz.az.degree)
+                tb.client.set_elevation_position(pos_altaz.alt.degree)
+                self.want_abort.wait(OTF_UPDATE_INTERVAL)
+            end = target(index[-1])
+            tb.point(end.az.degree, end.alt.degree)
+            scan_end = time.time()
+        times, counters, vectors = tb.sub_integrations(scan_start, scan_end)
+        return times, vectors, np.array(positions)
+
+    def _grid_otf_scan(self, times, vectors, positions, obswl, grid_vectors, sums):
+        """Add sub-integrations from one scan to their nearest grid points.
+
+        Args:
+            times: Unix time at the middle of each sub-integration
+            vectors: sub-integration spectra
+            positions: (time, azimuth, elevation) dish positions recorded during the scan
+            obswl: observing wavelength, for refraction
+            grid_vectors: unit vectors for the grid points in the iterator's frame
+            sums: dict of per-grid-point sums to update
+        """
+        if not len(times) or len(positions) < 2:
+            return
+        az = np.rad2deg(np.interp(times, positions[:, 0], np.unwrap(np.deg2rad(positions[:, 1]))))
+        el = np.interp(times, positions[:, 0], positions[:, 2])
+        apytime = Time(times, format='unix')
+        sc = SkyCoord(az=az*u.degree, alt=el*u.degree, frame=altaz_frame(apytime, obswl=obswl))
+        lon, lat = self.iterator.from_sky(sc)
+        dots = _unit_vectors(lon, lat) @ grid_vectors.T
+        nearest = np.argmax(dots, axis=1)
+        # Drop samples outside the grid's outer cells.
+        separation = np.rad2deg(np.arccos(np.clip(dots[np.arange(len(nearest)), nearest], -1, 1)))
+        keep = separation <= self.args.step * np.sqrt(0.5)
+        nearest = nearest[keep]
+        np.add.at(sums['data'], nearest, vectors[keep])
+        np.add.at(sums['count'], nearest, 1)
+        np.add.at(sums['time'], nearest, times[keep])
+        np.add.at(sums['rci_azimuth_x'], nearest, np.cos(np.deg2rad(az[keep])))
+        np.add.at(sums['rci_azimuth_y'], nearest, np.sin(np.deg2rad(az[keep])))
+        np.add.at(sums['rci_elevation'], nearest, el[keep])
+
+    def _run_drift(self, tb):
+        """Record total power while the sky drifts through the beam.
+
+        For each cross-scan offset in the iterator's range, the dish is
+        parked where the body (offset in latitude) will be halfway
+        through an int_time second cut, and the band-averaged power of
+        every sub-integration is recorded while the body drifts past.
+        Positions are computed for all samples at once after each cut.
+        """
+        savefolder = self.args.output_dir
+        int_time = self.args.int_time
+
+        old_tuning = self._tune(tb)
+        freq=tb.get_sdr_frequency()*u.Hz
+        obswl = freq.to(u.cm, u.spectral())
+        period = tb.sub_integration_time()
+        if period > DRIFT_MAX_PERIOD:
+            self.logger.warning('Sub-integrations are %g sec; use --sub-int-time=%g or less to resolve the beam', period, DRIFT_MAX_PERIOD)
+
+        with open(os.path.join(savefolder, 'info.txt'), 'w') as file:
+            file.write('Drift scan, '+str(int_time)+' seconds per cut. Center frequency '+str(freq)+' MHz. \n \n')
+            file.write('Original arguments:\n' + str(self.args))
+
+        plotter = plot.BackgroundPlotter()
+        try:
+            for number, offset in enumerate(np.tile(self.iterator.iter_source, self.repeat)):
+                if self.want_abort.is_set():
+                    return
+                drift = self._drift_cut(tb, offset, obswl)
+                if drift is not None:
+                    drift.meta.update({
+                        'NUMBER': number,
+                        'BODY': self.args.body_name,
+                        'OFFSET': offset,
+                        'FREQ': freq.to_value(u.Hz),
+                        'BANDWDTH': tb.get_output_vector_bandwidth(),
+                        'GAIN': tb.get_sdr_gain(),
+                        'PERIOD': period,
+                    })
+                    drift.write(os.path.join(savefolder, 'drift_%d.fits' % (number)), overwrite=True)
+                    plotter.submit(plot.plot_drift, drift, '%s drift, latitude offset %.1f' % (self.args.body_name, offset), os.path.join(savefolder, 'drift_%d.pdf' % (number)))
+                self.last_row = {'number': number}
+        finally:
+            self._restore_tuning(tb, old_tuning)
+            plotter.close()
+
+    def _drift_cut(self, tb, offset, obswl):
+        """Park ahead of the body and record one drift cut.
+
+        Returns:
+            QTable with one row per sub-integration, or None if the
+            cut would be below the horizon.
+        """
+        duration = self.args.int_time
+        t_mid = get_time() + TimeDelta((DRIFT_SLEW_ALLOWANCE + duration/2) * u.second)
+        target = self.iterator.to_sky(0, offset, t_mid).transform_to(altaz_frame(t_mid, obswl=obswl))
+        if target.alt < EL_OFFSET*u.degree:
+            self.logger.warning("Can't drift scan at %s; target alt %s is below the horizon", target, target.alt)
+            return None
+        tb.point(target.az.degree, target.alt.degree)
+        end = t_mid.unix + duration/2
+        self.logger.info('Drift scanning for %d sec.', end - time.time())
+        chunks = []
+        with tb.recording_positions() as positions:
+            counter = tb.next_sub_integration()
+            while True:
+                remaining = end - time.time()
+                if remaining <= 0 or self.want_abort.is_set():
+                    break
+                self.want_abort.wait(min(DRIFT_POLL_INTERVAL, remaining))
+                times, counters, vectors = tb.sub_integrations_since(counter)
+                if len(counters):
+                    counter = counters[-1] + 1
+                    chunks.append((times, counters, vectors.mean(axis=1)))
+        if not chunks:
+            return None
+        times, counters, power = (np.concatenate(x) for x in zip(*chunks))
+        times = times - tb.sub_integration_time()/2
+        positions = np.array(positions)
+        if len(positions) >= 2:
+            az = np.rad2deg(np.interp(times, positions[:, 0], np.unwrap(np.deg2rad(positions[:, 1])))) % 360
+            el = np.interp(times, positions[:, 0], positions[:, 2])
+        else:
+            az = np.full(len(times), target.az.degree)
+            el = np.full(len(times), target.alt.degree)
+        sc = SkyCoord(az=az*u.degree, alt=el*u.degree, frame=altaz_frame(Time(times, format='unix'), obswl=obswl))
+        icrs = sc.icrs
+        dlon, dlat = self.iterator.from_sky(sc)
+        return QTable({
+            'time': times*u.second,
+            'counter': counters,
+            'power': power.astype(np.float32)*(u.mW/u.Hz),
+            'azimuth': az.astype(np.float32)*u.degree,
+            'elevation': el.astype(np.float32)*u.degree,
+            'ra': icrs.ra.to(u.degree).astype(np.float32),
+            'dec': icrs.dec.to(u.degree).astype(np.float32),
+            'skyoffset_longitude': dlon.astype(np.float32)*u.degree,
+            'skyoffset_latitude': dlat.astype(np.float32)*u.degree,
+        })
+
+def _unit_vectors(lon, lat):
+    """Return Cartesian unit vectors for lon, lat in degrees."""
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)), axis=-1)
@@ -0,0 +1,574 @@
+"""Control of the dish and the integration chain, independent of the SDR.
+
+run.radiotelescope combines Telescope with the LimeSDR flowgraph and
+simulator.SimulatedTelescope combines it with a synthetic one.
+"""
+
+# Prepare for Python 3
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import numpy as np
+import capture
+import spectrometer
+import stats
+
+# Degrees from the target at which the dish counts as pointed.
+POINTING_TOLERANCE = 0.5
+# Seconds to wait for an RCI status update before checking again.
+POINT_STATUS_TIMEOUT = 2
+# Seconds the dish may sit stopped off target before the position is resent.
+POINT_RESEND_INTERVAL = 5
+# Seconds of sub-integrations to keep in memory.
+SUB_INT_HISTORY = 600
+# Seconds of sub-integrations between checks of an adaptive integration's targets.
+ADAPTIVE_CHECK_INTERVAL = 1
+# Sub-integrations discarded after each frequency switch, while the
+# vectors computed at the old frequency drain from the flowgraph.
+FREQ_SWITCH_BLANK = 2
+# Seconds to wait for captured samples to reach the file after a capture stops.
+CAPTURE_DRAIN_TIMEOUT = 1
+
+# What configure_spectrometer can change: channels per spectrum, the
+# FFT window (one of spectrometer.WINDOWS) and the requested
+# sub-integration time in seconds.
+SpectrometerSettings = namedtuple('SpectrometerSettings', ['num_channels', 'window_name', 'integration_time'])
+# How long a configure_spectrometer switch held the flowgraph's lock,
+# and how long it took until the first sub-integration from the new
+# chain arrived (None if it didn't wait), in seconds.
+SwitchLatency = namedtuple('SwitchLatency', ['locked', 'first_vector'])
+# A chain of blocks from the calibrated IF to the integration block.
+_Chain = namedtuple('_Chain', ['settings', 'if_samp_rate', 'blocks', 'integration_dec_rate'])
+
+class _Slew(object):
+    """A move started by start_point and the monotonic times the dish reached and settled on its target."""
+    def __init__(self, az, el, tolerance, start):
+        self.az = az
+        self.el = el
+        self.tolerance = tolerance
+        self.start = start
+        self.on_target = None
+        self.settled = None
+        self.stop = threading.Event()
+
+class Telescope(object):
+    """Pointing and integration for a flowgraph built from flowgraph.grc.
+
+    Mix this in ahead of a flowgraph class that provides
+    integration_block and the getters and setters that grcc generates
+    for flowgraph.grc's variables; client is an rci.client.Client or a
+    stand-in with the same interface. To switch spectrometers with
+    configure_spectrometer, the flowgraph also sets spectrometer_method
+    and implements spectrometer_chain(), which returns its blocks from
+    the calibrated IF to the one that feeds integration_block.
+    """
+    logger = logging.getLogger('radiotelescope')
+    # The window of the flowgraph's own spectrometer, as in flowgraph.grc.
+    window_name = 'blackmanharris'
+
+    def __init__(self, client, pointing_tolerance=POINTING_TOLERANCE, history=SUB_INT_HISTORY, **kwargs):
+        super(Telescope, self).__init__(**kwargs)
+        self.client = client
+        self.pointing_tolerance = pointing_tolerance
+        self.darksky = None
+        self.history = history
+        # spectrometer.product_branch by product name.
+        self.products = {}
+        self._capture = None
+        self._capture_lock = threading.Lock()
+        # The flowgraph's own chain once configure_spectrometer has
+        # switched away from it, the chain in use when it isn't the
+        # flowgraph's own, and the spectrometers built for switching by
+        # (SpectrometerSettings, IF sample rate).
+        self._own_chain = None
+        self._chain = None
+        self._spectrometers = {}
+        # Blocks fed from the flowgraph's own spectrometer by tap_spectra.
+        self.spectrum_taps = []
+        self.switch_latency = None
+        # Host time of the last retune and the counter of the first
+        # sub-integration computed entirely after it.
+        self._retune = None
+        # The last move started by start_point.
+        self._slew = None
+        period = self.sub_integration_time()
+        self.integration_block.set_history(int(np.ceil(history / period)), period)
+
+    def sub_integration_time(self):
+        """Return the number of seconds covered by each vector from the integration chain."""
+        return self.get_integration_dec_rate() * self.get_num_channels() / self.get_if_samp_rate()
+
+    def get_num_channels(self):
+        if self._chain is None:
+            return super(Telescope, self).get_num_channels()
+        return self._chain.settings.num_channels
+
+    def get_integration_time(self):
+        if self._chain is None:
+            return super(Telescope, self).get_integration_time()
+        return self._chain.settings.integration_time
+
+    def get_integration_dec_rate(self):
+        if self._chain is None:
+            return super(Telescope, self).get_integration_dec_rate()
+        return self._chain.integration_dec_rate
+
+    def spectrometer_settings(self):
+        """Return the SpectrometerSettings of the chain that feeds integration_block."""
+        if self._chain is None:
+            return SpectrometerSettings(self.get_num_channels(), self.window_name, self.get_integration_time())
+        return self._chain.settings
+
+    def prepare_spectrometer(self, num_channels, window_name, integration_time):
+        """Build a spectrometer for configure_spectrometer ahead of time.
+
+        Spectrometers are kept for the IF sample rate they were built
+        for, so switching back to a setting reuses its FFT plans and
+        filter taps. Raises ValueError for settings the spectrometer
+        can't have.
+        """
+        if_samp_rate = self.get_if_samp_rate()
+        key = (SpectrometerSettings(num_channels, window_name, integration_time), if_samp_rate)
+        if key not in self._spectrometers:
+            dec_rate = spectrometer.integration_dec_rate(integration_time, if_samp_rate, num_channels)
+            if dec_rate < 1:
+                raise ValueError('sub-integrations of %g sec are shorter than one %d channel spectrum' % (integration_time, num_channels))
+            self._spectrometers[key] = spectrometer.spectrometer(
+                num_channels, dec_rate, if_samp_rate, window_name,
+                fft_threads=self.rate_plan.fft_threads, method=self.spectrometer_method)
+        return self._spectrometers[key]
+
+    def configure_spectrometer(self, num_channels=None, window_name=None, integration_time=None, wait=True, timeout=None):
+        """Switch integration_block to a spectrometer with other settings while the SDR keeps streaming.
+
+        Settings that are None stay as they are. The new chain is built
+        (or taken from prepare_spectrometer's) before the flowgraph is
+        locked, so the lock is only held while the blocks are
+        reconnected. integration_block is replaced by a new one, so
+        sub-integration counters and history start over; products keep
+        their own settings. Call again after changing the bandwidth.
+        Unless wait is false, waits for the new chain's first
+        sub-integration and raises TimeoutError if that takes longer
+        than timeout seconds.
+
+        Returns:
+            SwitchLatency, also kept in switch_latency, or None if
+            nothing changed
+        """
+        current = self.spectrometer_settings()
+        settings = SpectrometerSettings(
+            num_channels or current.num_channels,
+            window_name or current.window_name,
+            integration_time or current.integration_time)
+        if_samp_rate = self.get_if_samp_rate()
+        if self._own_chain is None:
+            self._own_chain = _Chain(current, if_samp_rate, self.spectrometer_chain(), self.get_integration_dec_rate())
+        own = self._own_chain
+        old = self._chain or own
+        if (settings, if_samp_rate) == (old.settings, old.if_samp_rate):
+            return None
+        if (settings, if_samp_rate) == (own.settings, own.if_samp_rate):
+            new = own
+        else:
+            spectra = self.prepare_spectrometer(*settings)
+            new = _Chain(settings, if_samp_rate, [own.blocks[0], spectra], spectra.integration_dec_rate)
+        block = type(self.integration_block)(num_channels=settings.num_channels)
+        period = new.integration_dec_rate * settings.num_channels / if_samp_rate
+        block.set_history(int(np.ceil(self.history / period)), period)
+
+        start = time.monotonic()
+        self.lock()
+        try:
+            self.disconnect(old.blocks[-1], self.integration_block)
+            # The flowgraph's own spectrometer keeps running for its taps.
+            if old is not own or not self.spectrum_taps:
+                self.disconnect(*old.blocks)
+            if new is not own or not self.spectrum_taps:
+                self.connect(*new.blocks)
+            self.connect(new.blocks[-1], block)
+        finally:
+            self.unlock()
+        locked = time.monotonic() - start
+        self.integration_block = block
+        self._chain = None if new is own else new
+        self._retune = None
+
+        first_vector = None
+        if wait:
+            if not block.wait_received(1, timeout):
+                raise TimeoutError('no sub-integration from the new spectrometer within %s sec' % (timeout,))
+            first_vector = time.monotonic() - start
+        self.switch_latency = SwitchLatency(locked, first_vector)
+        self.logger.info('Switched to %d channels, %s window, %.3g sec sub-integrations; locked for %.2f ms',
+                         settings.num_channels, settings.window_name, period, locked*1e3)
+        if first_vector is not None:
+            self.logger.info('First sub-integration after %.2f sec', first_vector)
+        return self.switch_latency
+
+    def tap_spectra(self, block):
+        """Also feed the flowgraph's own spectra to block, e.g. for a live display.
+
+        Taps keep the flowgraph's own spectrometer running, with its
+        own settings, while configure_spectrometer has integration_block
+        on another. Call before the flowgraph starts.
+        """
+        self.connect(self.spectrometer_chain()[-1], block)
+        self.spectrum_taps.append(block)
+
+    def sub_integrations(self, start_time, end_time):
+        """Return (times, counters, vectors) for sub-integrations received between start_time and end_time.
+
+        times are host Unix timestamps and counters number the vectors
+        since the flowgraph started.
+        """
+        times, counters, vectors = self.integration_block.history()
+        mask = (times >= start_time) & (times < end_time)
+        return times[mask], counters[mask], vectors[mask]
+
+    def next_sub_integration(self):
+        """Return the counter that the next sub-integration will have."""
+        return self.integration_block.received
+
+    def sub_integrations_since(self, counter):
+        """Return (times, counters, vectors) for sub-integrations numbered counter or later."""
+        return self.integration_block.history(counter)
+
+    def snapshot(self, int_time, timeout=None): #straight snapshot over a certain integration time.
+        """Integrate for int_time seconds and return the averaged vector.
+
+        The result is the mean of the sub-integrations that arrive over
+        the next int_time seconds; integrations longer than the
+        sub-integration history use the integration block's
+        accumulator instead. Returns as soon as the last vector has
+        been accumulated. Raises TimeoutError if that takes longer than
+        timeout seconds.
+        """
+        self.logger.info('Snapshot %d sec', int_time)
+        block = self.integration_block
+        count = max(1, int(round(int_time / self.sub_integration_time())))
+        vec = None
+        if count > block.history_capacity:
+            block.integrate(count)
+            vec = block.wait_results(timeout)
+        else:
+            start = self.next_sub_integration()
+            if block.wait_received(start + count, timeout):
+                vec = block.history(start, start + count)[2].mean(axis=0, dtype=np.float64)
+        if vec is None:
+            raise TimeoutError('integration of %d sec did not complete within %s sec' % (int_time, timeout))
+        return np.array(vec)
+
+    observe = snapshot
+
+    def observe_adaptive(self, max_time, min_time=0, target_snr=None, target_noise=None, timeout=None):
+        """Integrate until a target is reached and return the averaged vector.
+
+        Running per-channel statistics of the sub-integrations are
+        updated every ADAPTIVE_CHECK_INTERVAL seconds. Integration
+        stops once the line's SNR reaches target_snr or the fractional
+        noise in the line-free channels falls to target_noise (see
+        stats.RunningSpectrum), but never before min_time or after
+        max_time seconds. Raises TimeoutError if the sub-integrations
+        take longer than timeout seconds to arrive.
+
+        Returns:
+            (vector, seconds integrated, stats.RunningSpectrum)
+        """
+        period = self.sub_integration_time()
+        block = self.integration_block
+        max_count = max(2, int(round(max_time / period)))
+        min_count = min(max_count, max(2, int(round(min_time / period))))
+        step = max(1, int(round(ADAPTIVE_CHECK_INTERVAL / period)))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        running = stats.RunningSpectrum()
+        start = counter = self.next_sub_integration()
+        while counter - start < max_count:
+            stop = start + min(max_count, max(min_count, counter - start + step))
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not block.wait_received(stop, remaining):
+                raise TimeoutError('adaptive integration of up to %s sec did not complete within %s sec' % (max_time, timeout))
+            running.update(block.history(counter, stop)[2])
+            counter = stop
+            if running.count < min_count:
+                continue
+            if target_snr is not None and running.snr() >= target_snr:
+                break
+            if target_noise is not None and running.noise() <= target_noise:
+                break
+        self.logger.info('Integrated %.1f sec (SNR %.1f, noise %.2g)', running.count * period, running.snr(), running.noise())
+        return running.mean, running.count * period, running
+
+    def observe_switched(self, int_time, offset, period, timeout=None):
+        """Integrate for int_time seconds while frequency switching.
+
+        Every period seconds the SDR is retuned between its current
+        frequency (the signal phase) and offset Hz above it (the
+        reference phase), and the integration block accumulates each
+        phase into its own spectrum. FREQ_SWITCH_BLANK sub-integrations
+        are discarded after each retune, so each phase gets a little
+        less than int_time/2 seconds of data. Raises TimeoutError if
+        the integration takes longer than timeout seconds.
+
+        Returns:
+            (signal vector, reference vector, seconds integrated per phase)
+        """
+        self.logger.info('Frequency switched snapshot %d sec, %g Hz every %g sec', int_time, offset, period)
+        block = self.integration_block
+        sub_int_time = self.sub_integration_time()
+        count = max(1, int(round(period / sub_int_time)) - FREQ_SWITCH_BLANK)
+        cycles = max(1, int(round(int_time / (2 * period))))
+        frequency = self.get_sdr_frequency()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        block.start_switching()
+        try:
+            for _ in range(cycles):
+                for phase, phase_frequency in enumerate((frequency, frequency + offset)):
+                    self.set_sdr_frequency(phase_frequency)
+                    stop = block.switch_phase(phase, count, FREQ_SWITCH_BLANK)
+                    remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                    if not block.wait_received(stop, remaining):
+                        raise TimeoutError('frequency switched integration of %d sec did not complete within %s sec' % (int_time, timeout))
+        finally:
+            self.set_sdr_frequency(frequency)
+        signal, reference = block.switched_results()
+        return np.array(signal), np.array(reference), cycles * count * sub_int_time
+
+    def add_product(self, branch, source):
+        """Compute branch's spectral product from source's calibrated IF.
+
+        branch is a spectrometer.product_branch; its sub-integrations
+        go to an integration block of its own, which keeps the same
+        history as the main one. Call before the flowgraph starts.
+        """
+        block = branch.integration_block = type(self.integration_block)(num_channels=branch.product.num_channels)
+        period = branch.sub_integration_time()
+        block.set_history(int(np.ceil(self.history / period)), period)
+        self.connect(source, branch, block)
+        self.products[branch.product.name] = branch
+
+    def next_product_sub_integrations(self):
+        """Return the counter that each product's next sub-integration will have, by name."""
+        return {name: branch.integration_block.received for name, branch in self.products.items()}
+
+    def product_spectra(self, starts, seconds, timeout=None):
+        """Return each product's mean spectrum over seconds, by name.
+
+        starts is next_product_sub_integrations() from when the
+        observation began. Observations longer than the
+        sub-integration history use its last sub-integrations. Raises
+        TimeoutError if they take longer than timeout seconds to arrive.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        spectra = {}
+        for name, branch in self.products.items():
+            block = branch.integration_block
+            stop = starts[name] + max(1, int(round(seconds / branch.sub_integration_time())))
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not block.wait_received(stop, remaining):
+                raise TimeoutError('spectral product %s did not complete within %s sec' % (name, timeout))
+            start = max(starts[name], stop - block.history_capacity)
+            spectra[name] = np.array(block.history(start, stop)[2].mean(axis=0, dtype=np.float64))
+        return spectra
+
+    def point(self, az, el, tolerance=None):
+        """Point the dish at a particular azimuth and elevation.
+
+        Blocks until the dish reports that it has stopped moving
+        within tolerance degrees of the target.
+
+        Returns:
+            (slew time, settle time) in seconds
+        """
+        return self.wait_pointed(self.start_point(az, el, tolerance))
+
+    def start_point(self, az, el, tolerance=None):
+        """Command the dish to move to az, el without waiting for it.
+
+        A thread follows the RCI status updates from then on and notes
+        when the dish comes within tolerance degrees of the target and
+        when it stops there, so the times wait_pointed reports don't
+        include whatever the caller does in between.
+
+        Returns:
+            the move, for wait_pointed
+        """
+        if tolerance is None:
+            tolerance = self.pointing_tolerance
+        if self._slew is not None:
+            self._slew.stop.set()
+        self.logger.info('Moving to position %s, %s.', az, el)
+        slew = self._slew = _Slew(az, el, tolerance, time.monotonic())
+        self.client.set_azimuth_position(az)
+        self.client.set_elevation_position(el)
+        threading.Thread(target=self._follow_slew, args=(slew,), name='slew', daemon=True).start()
+        return slew
+
+    def _follow_slew(self, slew):
+        with self.client._cv:
+            while not slew.stop.is_set():
+                now = time.monotonic()
+                if self.pointing_error(slew.az, slew.el) <= slew.tolerance:
+                    if slew.on_target is None:
+                        slew.on_target = now
+                    if not self.client.status.get('Moving'):
+                        slew.settled = now
+                        self.client._cv.notify_all()
+                        return
+                else:
+                    slew.on_target = None
+                self.client._cv.wait(POINT_STATUS_TIMEOUT)
+
+    def wait_pointed(self, slew):
+        """Wait for a move started by start_point to finish.
+
+        Blocks until the dish reports that it has stopped moving
+        within the move's tolerance of the target. The position is
+        resent if the dish sits stopped off target for
+        POINT_RESEND_INTERVAL seconds.
+
+        Returns:
+            (slew time, settle time) in seconds since start_point
+        """
+        last_command = slew.start
+        try:
+            with self.client._cv:
+                while slew.settled is None:
+                    now = time.monotonic()
+                    if (not self.client.status.get('Moving') and now - last_command > POINT_RESEND_INTERVAL
+                            and self.pointing_error(slew.az, slew.el) > slew.tolerance):
+                        # Stopped somewhere else; the command may have been lost.
+                        self.logger.debug('Stopped at (%g, %g), resending position.', self.client.azimuth_position, self.client.elevation_position)
+                        self.client.set_azimuth_position(slew.az)
+                        self.client.set_elevation_position(slew.el)
+                        last_command = now
+                    self.client._cv.wait(POINT_STATUS_TIMEOUT)
+        finally:
+            slew.stop.set()
+        slew_time, settle_time = slew.on_target - slew.start, slew.settled - slew.on_target
+        self.logger.info('Slewed in %.1f sec, settled in %.1f sec.', slew_time, settle_time)
+        return slew_time, settle_time
+
+    def pointing_error(self, az, el):
+        """Return the largest axis error in degrees between (az, el) and the dish position."""
+        daz = (self.client.azimuth_position - az + 180) % 360 - 180
+        delev = (self.client.elevation_position - el + 180) % 360 - 180
+        return max(abs(daz), abs(delev))
+
+    @contextmanager
+    def recording_positions(self):
+        """Record the dish position from every RCI status update.
+
+        Yields a list that fills with (Unix time, azimuth, elevation)
+        tuples until the context exits.
+        """
+        positions = []
+        stop = threading.Event()
+        def record():
+            with self.client._cv:
+                while not stop.is_set():
+                    self.client._cv.wait(POINT_STATUS_TIMEOUT)
+                    positions.append((time.time(), self.client.azimuth_position, self.client.elevation_position))
+        thread = threading.Thread(target=record, name='positions', daemon=True)
+        thread.start()
+        try:
+            yield positions
+        finally:
+            stop.set()
+            thread.join()
+
+    def set_sdr_frequency(self, sdr_frequency):
+        if sdr_frequency == self.get_sdr_frequency():
+            return
+        with self._capture_lock:
+            super(Telescope, self).set_sdr_frequency(sdr_frequency)
+            # The next sub-integration may hold samples from before the
+            # retune; the one after it is the first made only of new ones.
+            self._retune = (time.time(), self.next_sub_integration() + 1)
+            if self._capture is not None:
+                recording, start, _ = self._capture
+                recording.retune(self.capture_valve.nitems_written(0) - start, time.time(), sdr_frequency)
+
+    def set_bandwidth(self, bandwidth):
+        """Raise ValueError unless bandwidth is the flowgraph's.
+
+        The LimeSDR's sample rate and the filters' decimations come from
+        rateplan.plan(bandwidth) when the flowgraph is built, and no
+        other bandwidth has the same plan, so changing it means
+        restarting with --bandwidth.
+        """
+        if bandwidth != self.get_bandwidth():
+            raise ValueError('the bandwidth is fixed at %g Hz while the flowgraph runs; restart with --bandwidth %g' % (
+                self.get_bandwidth(), bandwidth))
+
+    def retune_latency(self, timeout=0):
+        """Return the seconds from the last retune until the first sub-integration of only new samples arrived.
+
+        The sub-integration in progress at the retune is excluded, and
+        the time is the one the integration block recorded when the
+        next one reached it. Waits up to timeout seconds (None for no
+        limit) for it, and returns None if it hasn't arrived or there
+        has been no retune.
+        """
+        if self._retune is None:
+            return None
+        retuned, counter = self._retune
+        if timeout != 0 and not self.integration_block.wait_received(counter + 1, timeout):
+            return None
+        arrived = self.integration_block.arrival_time(counter)
+        if arrived is None:
+            return None
+        return arrived - retuned
+
+    def start_capture(self, name, duration=None, pointing=None):
+        """Start recording the SDR's raw samples to the SigMF recording name.
+
+        The recording stops after duration seconds, or at
+        stop_capture. pointing is a dict of coordinates saved in the
+        metadata. Needs the capture_valve and capture_sink blocks of
+        flowgraph.grc.
+        """
+        with self._capture_lock:
+            if self._capture is not None:
+                raise RuntimeError('already capturing to %s' % (self._capture[0].name,))
+            recording = capture.Recording(
+                name, self.get_samp_rate(), self.get_bandwidth(), self.get_sdr_gain(),
+                self.get_offset_frequency(), pointing)
+            self.capture_sink.open(capture.data_path(name))
+            start = self.capture_valve.nitems_written(0)
+            self.capture_valve.set_enabled(True)
+            recording.retune(0, time.time(), self.get_sdr_frequency())
+            timer = None
+            if duration:
+                timer = threading.Timer(duration, self.stop_capture)
+                timer.daemon = True
+                timer.start()
+            self._capture = (recording, start, timer)
+        self.logger.info('Capturing IQ to %s', capture.data_path(name))
+
+    def stop_capture(self):
+        """Stop the current capture, if any, and write its metadata."""
+        with self._capture_lock:
+            if self._capture is None:
+                return
+            recording, start, timer = self._capture
+            self._capture = None
+            if timer is not None:
+                timer.cancel()
+            self.capture_valve.set_enabled(False)
+            # Each complex sample reaches the file sink as two shorts.
+            written = 2 * self.capture_valve.nitems_written(0)
+            deadline = time.monotonic() + CAPTURE_DRAIN_TIMEOUT
+            while self.capture_sink.nitems_read(0) < written and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.capture_sink.close()
+            samples = recording.write()
+        self.logger.info('Captured %d samples (%.1f sec) to %s', samples, samples / recording.samp_rate, capture.data_path(recording.name))
+
+    def park(self):
+        self.logger.info("Parking")
+        self.point(250,50)
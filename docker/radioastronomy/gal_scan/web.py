@@ -11,6 +11,7 @@ from bokeh.util import logconfig
 from gnuradio import gr, blocks
 from astropy import units as u
 import bokehgui
+import argparse
 import base64
 import collections
 import datetime
@@ -31,7 +32,7 @@ from tornado.escape import xhtml_escape
 from zipstream import AioZipStream
 from zipstream import consts as zconsts
 import rci.client
-from galcoord import radome_observer
+import galcoord
 import run
 from weather import Weather
 from bokeh_models import Skymap, Knob, DownloadButton, UploadButton, ActiveButton, SortedDataTable, ActionMenuColumn, ActionMenuClick
@@ -104,10 +105,11 @@ class vec_sink_f(bokehgui.vec_sink_f):
         self.plot.add_tools(hover, crosshair)
 
 class SessionHandler(Handler):
-    def __init__(self, lw, runs_dir):
+    def __init__(self, lw, runs_dir, tbkwargs={}):
         super().__init__()
         self.lw = lw
         self.runs_dir = runs_dir
+        self.tbkwargs = tbkwargs
         with open('messier.json') as f:
             objects = json.load(f)
             self.messier = [{
@@ -120,10 +122,13 @@ class SessionHandler(Handler):
         self.client = rci.client.Client(client_name='gal_scan')
         self.client.set_offsets(run.AZ_OFFSET, run.EL_OFFSET)
 
-        self.tb = run.radiotelescope(client=self.client)
-        self.mag_to_zW = blocks.multiply_const_vff([1e18] * self.tb.get_num_channels())
-        self.tb.connect((self.tb.blocks_multiply_const_vxx_0, 0), (self.mag_to_zW, 0))
-        null_sink = blocks.null_sink(gr.sizeof_float*self.tb.get_num_channels())
+        self.tb = run.radiotelescope(client=self.client, **self.tbkwargs)
+        # The live plot shows the flowgraph's own spectra, even while a
+        # survey has the integration block on another spectrometer.
+        self.num_channels = self.tb.get_num_channels()
+        self.mag_to_zW = blocks.multiply_const_vff([1e18] * self.num_channels)
+        self.tb.tap_spectra(self.mag_to_zW)
+        null_sink = blocks.null_sink(gr.sizeof_float*self.num_channels)
         self.tb.connect(self.mag_to_zW, null_sink)
 
         self.started = False
@@ -176,19 +181,24 @@ class SessionHandler(Handler):
                 d['active'].insert(0, True)
             return d
 
-    def enqueue_action(self, name, callable, allow_queue=False, **kwargs):
+    def enqueue_action(self, name, callable, allow_queue=False, replace=None, **kwargs):
         with self.actions_cv:
             if self.actions:
                 # Don't allow manual commands if a survey is queued
                 if not allow_queue and sum(1 for a in self.actions if a.get('survey')):
                     logging.warning("Busy; ignoring manual command")
                     return
+                # Only the last of a run of knob changes needs applying
+                for a in [a for a in self.actions if replace is not None and a.get('replace') == replace]:
+                    logging.info("Replacing queued %s", a['name'])
+                    self.actions.remove(a)
                 logging.info("Busy; enqueueing %s", name)
             a = {
                 'id': str(uuid.uuid4()),
                 'time': time.time(),
                 'name': name,
                 'callable': callable,
+                'replace': replace,
             }
             a.update(kwargs)
             self.actions.append(a)
@@ -231,19 +241,22 @@ class SessionHandler(Handler):
         self.enqueue_action(
             name="set gain to %d" % gain,
             callable=functools.partial(self.tb.set_sdr_gain, gain),
+            replace='gain',
         )
 
     def set_frequency(self, f):
         self.enqueue_action(
             name="set frequency to %f" % f,
             callable=functools.partial(self.tb.set_sdr_frequency, f),
+            replace='frequency',
         )
 
     def set_bandwidth(self, f):
-        self.enqueue_action(
-            name="set bandwidth to %f" % f,
-            callable=functools.partial(self.tb.set_bandwidth, f),
-        )
+        # The bandwidth can't change while the flowgraph runs, so there is nothing to enqueue.
+        try:
+            self.tb.set_bandwidth(f)
+        except ValueError as e:
+            logging.warning("Not changing bandwidth: %s", e)
 
     def set_rx(self, rx):
         self.enqueue_action(
@@ -284,7 +297,7 @@ class SessionHandler(Handler):
 
     def modify_document(self, doc):
         self.tb.lock()
-        sink = bokehgui.vec_sink_f_proc(self.tb.get_num_channels(), "", 1)
+        sink = bokehgui.vec_sink_f_proc(self.num_channels, "", 1)
         self.tb.connect((self.mag_to_zW, 0), (sink, 0))
         self.tb.unlock()
 
@@ -311,7 +324,7 @@ class SessionHandler(Handler):
         plot.set_y_label("Power at feed (zW / Hz)")
         plot.set_x_label("Frequency (MHz)")
         def set_x_values():
-            plot.set_x_values(np.linspace(self.tb.get_sdr_frequency()-(self.tb.get_output_vector_bandwidth()/2), self.tb.get_sdr_frequency()+(self.tb.get_output_vector_bandwidth()/2), self.tb.get_num_channels())/1e6)
+            plot.set_x_values(np.linspace(self.tb.get_sdr_frequency()-(self.tb.get_output_vector_bandwidth()/2), self.tb.get_sdr_frequency()+(self.tb.get_output_vector_bandwidth()/2), self.num_channels)/1e6)
         set_x_values()
         plot.enable_axis_labels(True)
         plot.set_layout(1,0)
@@ -355,16 +368,18 @@ class SessionHandler(Handler):
         bandwidth = Knob(title="filter bandwidth", writable=False, value=self.tb.get_bandwidth(), digits=7, decimals=0, unit="Hz")
         bandwidth.on_change('value', lambda name, old, new: self.set_bandwidth(new))
 
+        retune = Knob(title="retune to valid data", digits=3, decimals=2, unit="s")
+
         reset = Button(label="Reset")
         def on_reset():
             gain.value = run.flowgraph_defaults['sdr_gain']
             frequency.value = run.flowgraph_defaults['sdr_frequency']
-            bandwidth.value = run.flowgraph_defaults['bandwidth']
         reset.on_click(on_reset)
 
         manual = Panel(title="Manual", child=column(
             row(rx, gain),
             row(frequency, bandwidth),
+            retune,
             reset,
         ))
 
@@ -380,6 +395,9 @@ class SessionHandler(Handler):
                 bokeh_args['tags'] = ['args']
                 if 'default' in arg:
                     bokeh_args['value'] = arg['default']
+                if key == 'bandwidth':
+                    # Surveys can only use the flowgraph's bandwidth.
+                    bokeh_args['value'] = self.tb.get_bandwidth()
                 if 'help' in arg:
                     bokeh_args['title'] = arg['help']
                     if 'metavar' in arg:
@@ -423,12 +441,12 @@ class SessionHandler(Handler):
             automated_panels.append(Panel(title=group, child=grid(panel_models, ncols=2)))
         for panel in automated_panels:
             if panel.title.startswith("mode="):
-                mode_str = panel.title.split('=')[1]
+                modes = panel.title.split('=')[1].split(',')
                 run_models['mode'].js_on_change(
                     'value',
                     CustomJS(
-                        args=dict(panel=panel, mode=mode_str),
-                        code="""panel.select(Bokeh.require("models/widgets/control").Control).forEach(c => c.disabled = (this.value != mode))""",
+                        args=dict(panel=panel, modes=modes),
+                        code="""panel.select(Bokeh.require("models/widgets/control").Control).forEach(c => c.disabled = !modes.includes(this.value))""",
                     )
                 )
 
@@ -474,9 +492,12 @@ class SessionHandler(Handler):
             try:
                 output_dir = os.path.join(self.runs_dir, "run_"+datetime.datetime.now().replace(microsecond=0).isoformat())
                 args = get_args(output_dir)
+                self.tb.set_bandwidth(args.bandwidth)
                 self.enqueue_run(args)
             except SystemExit:
                 pass
+            except ValueError as e:
+                logging.warning("Not starting scan: %s", e)
         start.on_click(on_start)
         automated = Panel(title="Plan", child=column(Tabs(tabs=automated_panels), plan_p, row(load, save, start)))
 
@@ -627,6 +648,9 @@ class SessionHandler(Handler):
                 skymap.targetAzel = (status['CommandAzPos'], status['CommandElPos'])
             else:
                 skymap.targetAzel = None
+            latency = self.tb.retune_latency()
+            if latency is not None:
+                retune.value = latency
             azimuth.value = status['AzPos']
             elevation.value = status['ElPos']
             rx_active = status['Sequencer']['Bands'][0]['CommandRX']
@@ -749,12 +773,19 @@ class DirectoryHandler(tornado.web.RequestHandler):
 
 def wx_received(wx):
     # TODO: Does this need locking?
+    radome_observer = galcoord.radome_observer
     radome_observer.temperature = wx['temperature']
     radome_observer.relative_humidity = wx['relative_humidity']
     radome_observer.pressure = wx['pressure']
     logging.info("Performing refraction correction for %s %s %s", radome_observer.temperature, radome_observer.relative_humidity, radome_observer.pressure)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Galactic sky scan web interface')
+    group = parser.add_argument_group('RF')
+    for arg_name, kwargs in run.arg_groups['RF'].items():
+        group.add_argument('--'+arg_name, **{k: v for k, v in kwargs.items() if k != 'bokeh'})
+    # The flowgraph is built once, so its bandwidth is the one every survey uses.
+    tbkwargs = run.top_block_kwargs(run.parse_args([RUNS_DIR], vars(parser.parse_args())))
     logconfig.basicConfig(
         format="%(asctime)-15s %(levelname)-8s [%(name)s] [%(module)s:%(funcName)s] %(message)s",
         level=logging.DEBUG,
@@ -765,7 +796,7 @@ if __name__ == '__main__':
     wx = Weather(callback=wx_received)
     wx.start()
     server = Server(
-        {'/': Application(SessionHandler(lw=lw, runs_dir=RUNS_DIR))},
+        {'/': Application(SessionHandler(lw=lw, runs_dir=RUNS_DIR, tbkwargs=tbkwargs))},
         allow_websocket_origin=[socket.getfqdn().lower()+":5006"],
         extra_patterns=[
             (r'/runs/()', DirectoryHandler, {'path': RUNS_DIR}),